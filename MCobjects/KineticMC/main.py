@@ -0,0 +1,392 @@
+from MCobjects.Metropolis.strategy import Exchange
+from MCobjects.Metropolis.main import Metropolis
+from cores.memoryStepObject import MemoryStepObject
+from cores.neighborTopology import NeighborTopology
+from cores.rateTree import RateTree
+from model.energyBackend import EnergyBackend
+from model.modelRegistry import ModelRegistry
+from logger.runLogger import RunLogger
+from utilitys.phaseTimer import PhaseTimer
+
+from prettytable import PrettyTable
+import numpy as np
+import math
+import time
+import os
+
+
+class KineticMC(object):
+    '''
+    Description
+    -----------
+        1. 空位扩散的无拒绝 (BKL / residence-time) 动力学蒙特卡洛, 内存模式 (chgnet/mattersim),
+            空位以 vac_as 元素表示 (同 vac_dope=True, 需要初始文件夹中的 0.POSCAR)
+        2. 事件为空位与 hop_cutoff 内同一子晶格原子的交换: 由 NeighborTopology (CSR) 一次性列出全部有向位点对
+            (第 e 个事件为 indices[e] 上的原子跳入其起点上的空位), 只有起点为空位、终点为可迁移原子的事件速率不为 0;
+            各速率保存在 RateTree 中, 选择事件与更新速率均为 O(log N)
+        3. 速率 k = ν exp(-E_a/kT), 势垒取 KRA 近似 E_a = E_KRA + ΔE/2 (且不小于 max(ΔE, 0), 正反跳跃满足细致平衡),
+            ΔE 为跳跃前后由能量后端计算的能量差
+        4. ΔE 按局部环境缓存: 键为跳跃元素与两端 env_cutoff 内各位点 (到两端的距离, 元素) 的有序集合,
+            局部环境相同的跳跃只计算一次能量 (同一 KineticMC 对象的多次 run 之间共享, 与温度无关);
+            键与跳跃方向无关 (两端按固定顺序排列), 反向跳跃取 -ΔE, 正反方向的局部环境相同时 ΔE = 0;
+            每次跳跃后只重新计算两端 hop_cutoff + env_cutoff 内各空位的速率
+        5. 当前能量由缓存的 ΔE 累加, 每 exact_every 次跳跃 (以及计算缺失的 ΔE 之前) 重新计算一次, 消除累积误差
+        6. 位点固定在初始晶格上 (from_contcar=False), 弛豫只影响能量
+        7. 每一步时间增加 Δt = -ln(u)/R (R 为总速率), 记录在搜索总目录下的 kmc_record.txt
+
+    Attributes
+    ----------
+        1. self.E_kra: float or dict
+            KRA 势垒 (eV), dict 时为 元素 -> 势垒
+        2. self.attempt_frequency: float
+            尝试频率 ν (Hz)
+        3. self.hop_cutoff: float
+            跳跃距离上限 (Å), 一般取在最近邻与次近邻距离之间
+        4. self.env_cutoff: float
+            局部环境半径 (Å)
+        5. self.delta_E_cache: dict
+            局部环境 -> ΔE (eV, 键的正方向)
+        6. self.hits / self.misses: int
+            ΔE 缓存的命中统计
+        7. self.time: float
+            模拟时间 (s)
+    '''
+    RECORD_FILENAME = 'kmc_record.txt'
+    # 局部环境中距离的分辨率 (Å)
+    DISTANCE_RESOLUTION = 0.01
+
+    def __init__(self, E_kra=0.5, attempt_frequency:float=1e13, hop_cutoff:float=3.0, env_cutoff:float=4.0):
+        self.E_kra = E_kra
+        self.attempt_frequency = attempt_frequency
+        self.hop_cutoff = hop_cutoff
+        self.env_cutoff = env_cutoff
+        self.delta_E_cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.time = 0.0
+
+    def run(self, poscar_path:str, num_loops:int, T:float,
+            sublattice_symbols_lst:list, load_path=None, load_model:str=None,
+            elements_str_for_vaspkit:str=None,
+            load=False,
+            *,
+            vac_as = 'V',
+            diffusion_specie:str=None,
+            max_time:float=None,
+            exact_every:int=100,
+            seed=None,
+            energy_cache:bool=False,
+            relax_mode:str='full',
+            local_radius:float=6.0,
+            relax_policy:str='none',
+            relax_steps:int=50,
+            max_relax_steps:int=500,
+            save_every:int=None,
+            legacy_folders:bool=False,
+            store_positions:bool=False,
+            time_save:bool=True,
+            verbosity:str='info',
+            profile:str=None) -> dict:
+        '''
+        Description
+        -----------
+            1. poscar_path 为初始文件夹中的 POSCAR (同 Metropolis.run, 读取同目录下含空位的 0.POSCAR)
+            2. 执行 num_loops 次跳跃, 或模拟时间达到 max_time (s) 为止
+            3. diffusion_specie 不为 None 时只有该元素跳跃
+            4. relax_policy 默认为 'none' (交换后晶格的单点能, 缺失的 ΔE 以 predict_batch 批量计算),
+                其余参数 (energy_cache, relax_mode, save_every, legacy_folders, verbosity, profile ...) 同 Metropolis.run
+            5. load=True 时由 steps.log 的计数器与 kmc_record.txt 的最后时间继续
+            6. exact_every: 每 exact_every 次跳跃重新计算一次当前结构的能量 (None 时只在计算缺失的 ΔE 之前重新计算)
+
+        Return
+        ------
+            1. summary: dict
+                step_object, time (s), hops (本次跳跃数), delta_E_cache (命中统计)
+        '''
+        assert (elements_str_for_vaspkit is not None)
+        assert (load_model in ('chgnet', 'mattersim'))
+        run_logger = RunLogger.from_poscar_path(poscar_path, verbosity=verbosity)
+        Metropolis.start_profiling(profile)
+        rng = np.random.default_rng(seed) if seed is not None else None
+        cache = None
+        if energy_cache:
+            cache = Metropolis.open_energy_cache(poscar_path, load_model, load_path,
+                                                 vac_dope=True, vac_as=vac_as,
+                                                 relax_mode=relax_mode, relax_policy=relax_policy,
+                                                 relax_steps=relax_steps)
+        trajectory = Metropolis.open_trajectory(poscar_path, sublattice_symbols_lst, vac_dope=True, vac_as=vac_as,
+                                                append=load, store_positions=store_positions)
+
+        print('一、初始化(计算初始文件)','\n')
+        energy_backend = EnergyBackend.from_name(load_model, load_path=load_path,
+                                                 relax_mode=relax_mode, local_radius=local_radius,
+                                                 relax_policy=relax_policy, relax_steps=relax_steps,
+                                                 max_relax_steps=max_relax_steps)
+        energy_backend.preload()
+        step_object = MemoryStepObject.from_folder(poscar_path=poscar_path,
+                                                   energy_backend=energy_backend,
+                                                   sublattice_symbols_lst=sublattice_symbols_lst,
+                                                   elements_str_for_vaspkit=elements_str_for_vaspkit,
+                                                   from_contcar=False, load=load,
+                                                   vac_dope=True, vac_as=vac_as,
+                                                   diffusion_specie=diffusion_specie,
+                                                   save_every=save_every,
+                                                   rng=rng,
+                                                   energy_cache=cache,
+                                                   trajectory=trajectory,
+                                                   save_accepted=legacy_folders)
+        record_path = os.path.join(step_object.vasp_folders_path, self.RECORD_FILENAME)
+        self.time = self.read_time(record_path) if load else 0.0
+        self.namespace = '{0}:{1}:{2}'.format(load_model, load_path,
+                                              energy_backend.provenance(local_centers=np.zeros((1, 3))))
+        self.build_events(step_object, sublattice_symbols_lst, vac_as, diffusion_specie)
+        self.energy_exact = True
+        step_object.energy = self.update_sites(step_object, step_object.state.indexes_of(vac_as), T,
+                                               step_object.energy)
+
+        print('二、执行动力学蒙特卡洛','\n')
+        hops = 0
+        with open(record_path, 'a' if load else 'w') as record_file:
+            for _ in range(num_loops):
+                if (max_time is not None) and (self.time >= max_time):
+                    break
+                with PhaseTimer.phase("kmc_step"):
+                    hopped = self.kmc_step(step_object, T, record_file, time_save=time_save,
+                                           exact_every=exact_every)
+                if not hopped:
+                    print('没有可以发生的跳跃, 停止搜索')
+                    break
+                hops += 1
+                print(f'进入循环，第{_+1}次, t = {self.time:.6e} s')
+
+        step_object.close()
+        trajectory.close()
+        self.report()
+        ModelRegistry.report()
+        if cache is not None:
+            cache.report()
+            cache.close()
+        Metropolis.finish_run(run_logger, profile)
+        return {"step_object": step_object,
+                "time": self.time,
+                "hops": hops,
+                "delta_E_cache": self.stats()}
+
+    def build_events(self, step_object:MemoryStepObject, sublattice_symbols_lst:list, vac_as:str='V',
+                     diffusion_specie:str=None):
+        '''
+        列出 hop_cutoff 内的全部有向位点对 (事件), 建立速率树与局部环境/受影响范围的邻居拓扑
+        '''
+        state = step_object.state
+        sublattice = next((symbols for symbols in sublattice_symbols_lst if vac_as in symbols), None)
+        if sublattice is None:
+            raise ValueError("vac_as {0!r} is not in any sublattice: {1}".format(vac_as, sublattice_symbols_lst))
+        if vac_as not in state.species_index:
+            raise ValueError("No vacancy ({0}) in structure {1}".format(vac_as, step_object.current_index))
+        self.vac_as = vac_as
+        self.vac_code = state.species_index[vac_as]
+        self.mobile = np.zeros(len(state.species), dtype=bool)
+        for specie in sublattice:
+            if (specie != vac_as) and (specie in state.species_index) \
+                    and (diffusion_specie is None or specie == diffusion_specie):
+                self.mobile[state.species_index[specie]] = True
+        lattice_mask = np.isin(state.occupation, [state.species_index[specie] for specie in sublattice
+                                                  if specie in state.species_index])
+
+        hop_topology = NeighborTopology.from_structure(state, cutoff=self.hop_cutoff)
+        self.indptr = hop_topology.indptr
+        self.targets = hop_topology.indices
+        self.sources = np.repeat(np.arange(len(state)), np.diff(self.indptr))
+        self.hoppable = lattice_mask[self.sources] & lattice_mask[self.targets]
+        self.env_topology = NeighborTopology.from_structure(state, cutoff=self.env_cutoff)
+        self.affect_topology = NeighborTopology.from_structure(state, cutoff=self.hop_cutoff + self.env_cutoff)
+
+        self.tree = RateTree(np.zeros(len(self.targets)))
+        self.delta_E = np.zeros(len(self.targets))
+        self.environments = {}
+        self.species = state.species
+
+    def kmc_step(self, step_object:MemoryStepObject, T:float, record_file, time_save:bool=True,
+                 exact_every:int=None) -> bool:
+        '''
+        BKL 的一步: 按速率选择一个跳跃并执行, 时间增加 -ln(u)/R, 更新受影响的速率; 没有可以发生的跳跃时返回 False;
+        每 exact_every 步重新计算当前结构的能量
+        '''
+        start_time = time.time()
+        total_rate = self.tree.total
+        if total_rate <= 0:
+            return False
+        rng = step_object.rng
+        edge = self.tree.find(rng.random() * total_rate)
+        dt = -math.log(1.0 - rng.random()) / total_rate
+
+        vacancy_index, atom_index = int(self.sources[edge]), int(self.targets[edge])
+        specie = step_object.state.symbol(atom_index)
+        rate, delta_E = self.tree[edge], float(self.delta_E[edge])
+        step_object.apply_trial([(self.vac_as, vacancy_index, specie, atom_index)])
+        self.energy_exact = False
+        with PhaseTimer.phase("kmc_update"):
+            E_2 = self.update_sites(step_object, self.affected_sites(vacancy_index, atom_index), T,
+                                    step_object.energy + delta_E)
+        if exact_every and (not self.energy_exact) and ((step_object.total_steps + 1) % exact_every == 0):
+            E_2, _ = step_object.evaluate(step_object.structure)
+            self.energy_exact = True
+        self.time += dt
+        execution_time = time.time() - start_time if time_save else None
+
+        step_object.provenance = 'kmc'
+        step_object.walk(E_2, step_object.structure, rate / total_rate, execution_time)
+        record_file.write("{0}\t{1:.6e}\t{2:.6e}\t{3}\t{4}\t{5}\t{6:.6f}\t{7:.6f}\t{8:.6f}\t{9:.6e}\n".format(
+            step_object.total_steps, self.time, dt, specie, atom_index, vacancy_index, float(E_2), delta_E,
+            self.barrier(specie, delta_E), total_rate))
+        return True
+
+    def affected_sites(self, first_index:int, second_index:int) -> np.ndarray:
+        '''
+        跳跃两端 hop_cutoff + env_cutoff 内的位点: 以其中的空位为起点的跳跃, 局部环境可能包含两端之一
+        '''
+        return np.unique(np.concatenate(([first_index, second_index],
+                                         self.affect_topology.neighbors(first_index),
+                                         self.affect_topology.neighbors(second_index))))
+
+    def update_sites(self, step_object:MemoryStepObject, sites:np.ndarray, T:float, energy:float) -> float:
+        '''
+        Description
+        -----------
+            1. 重新计算以 sites 中各空位为起点的跳跃速率, 不是空位的位点的出边速率置 0
+            2. 缓存中没有的 ΔE 由能量后端计算; 若当前能量由缓存的 ΔE 累加得到 (self.energy_exact=False),
+                先重新计算当前结构的能量
+
+        Return
+        ------
+            1. energy: float
+                当前结构的能量 (未重新计算时为传入的 energy)
+        '''
+        occupation = step_object.state.occupation
+        edges, keys, signs = [], [], []
+        for site in sites:
+            is_vacancy = occupation[site] == self.vac_code
+            for edge in range(self.indptr[site], self.indptr[site + 1]):
+                if not self.hoppable[edge]:
+                    continue
+                if is_vacancy and self.mobile[occupation[self.targets[edge]]]:
+                    key, sign = self.environment_key(step_object, edge)
+                    edges.append(edge)
+                    keys.append(key)
+                    signs.append(sign)
+                else:
+                    self.tree.update(edge, 0.0)
+
+        missing = {}
+        for key, edge, sign in zip(keys, edges, signs):
+            if (key not in self.delta_E_cache) and (key not in missing):
+                if sign == 0:
+                    #正反方向的局部环境相同: ΔE = -ΔE
+                    self.delta_E_cache[key] = 0.0
+                else:
+                    missing[key] = (edge, sign)
+        self.misses += len(missing)
+        self.hits += len(edges) - len(missing)
+        if missing:
+            if not self.energy_exact:
+                energy, _ = step_object.evaluate(step_object.structure)
+            self.energy_exact = True
+            self.compute_delta_E(step_object, missing, energy)
+
+        for key, edge, sign in zip(keys, edges, signs):
+            delta_E = sign * self.delta_E_cache[key]
+            self.delta_E[edge] = delta_E
+            self.tree.update(edge, self.hop_rate(self.species[occupation[self.targets[edge]]], delta_E, T))
+        return energy
+
+    def compute_delta_E(self, step_object:MemoryStepObject, missing:dict, energy:float):
+        '''
+        计算缺失的 ΔE (局部环境 -> (代表事件, 方向)): relax_policy='none' 时批量单点能, 否则逐个弛豫
+        (relax_mode='local' 时只弛豫两端附近的原子); 以键的正方向保存
+        '''
+        structures, centers = [], []
+        for edge, _ in missing.values():
+            state = step_object.state.copy()
+            state.swap(self.sources[edge], self.targets[edge])
+            structures.append(state.to_structure())
+            centers.append(state.cart_coords[[self.sources[edge], self.targets[edge]]])
+        if step_object.energy_backend.relax_policy == 'none':
+            energies = step_object.predict_batch(structures)
+        else:
+            energies = [step_object.evaluate(structure, local_centers=local_centers)[0]
+                        for structure, local_centers in zip(structures, centers)]
+        for (key, (_, sign)), final_energy in zip(missing.items(), energies):
+            self.delta_E_cache[key] = sign * (float(final_energy) - float(energy))
+
+    def environment_key(self, step_object:MemoryStepObject, edge:int):
+        '''
+        Description
+        -----------
+            1. 事件 edge 的局部环境: 跳跃元素、跳跃距离以及两端 env_cutoff 内各位点 (到空位的距离, 到原子的距离, 元素)
+                排序后的序列
+            2. 反向跳跃 (原子跳回原位) 的序列为交换两个距离后的序列, 键取两者中较小的一个, 与跳跃方向无关
+
+        Return
+        ------
+            1. key: tuple
+            2. sign: int
+                1 (事件即键的正方向) / -1 (反方向) / 0 (正反方向的序列相同)
+        '''
+        if edge not in self.environments:
+            source, target = self.sources[edge], self.targets[edge]
+            env = np.setdiff1d(np.union1d(self.env_topology.neighbors(source), self.env_topology.neighbors(target)),
+                               [source, target])
+            distance_row = step_object.exchanger.get_distance_row
+            quantize = lambda distances: np.rint(np.asarray(distances) / self.DISTANCE_RESOLUTION).astype(np.int64)
+            self.environments[edge] = (env, quantize(distance_row(source, env)), quantize(distance_row(target, env)),
+                                       int(quantize(distance_row(source, [target]))[0]))
+        env, source_distances, target_distances, hop_length = self.environments[edge]
+        occupation = step_object.state.occupation
+        codes = occupation[env].astype(np.int64)
+        forward = np.stack((source_distances, target_distances, codes), axis=1)
+        backward = np.stack((target_distances, source_distances, codes), axis=1)
+        forward = forward[np.lexsort(forward.T[::-1])].tobytes()
+        backward = backward[np.lexsort(backward.T[::-1])].tobytes()
+        sign = 0 if forward == backward else (1 if forward < backward else -1)
+        key = (self.namespace, self.species, int(occupation[self.targets[edge]]), hop_length, min(forward, backward))
+        return key, sign
+
+    def barrier(self, specie:str, delta_E:float) -> float:
+        '''
+        KRA 势垒 E_a = E_KRA + ΔE/2, 不小于 max(ΔE, 0)
+        '''
+        E_kra = self.E_kra[specie] if isinstance(self.E_kra, dict) else self.E_kra
+        return max(E_kra + delta_E / 2.0, delta_E, 0.0)
+
+    def hop_rate(self, specie:str, delta_E:float, T:float) -> float:
+        return self.attempt_frequency * math.exp(- self.barrier(specie, delta_E) / (Exchange.k * T))
+
+    @staticmethod
+    def read_time(record_path:str) -> float:
+        '''
+        kmc_record.txt 最后一条记录的模拟时间
+        '''
+        if not os.path.exists(record_path):
+            return 0.0
+        last_line = None
+        with open(record_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    last_line = line
+        return float(last_line.split('\t')[1]) if last_line else 0.0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"Entries": len(self.delta_E_cache),
+                "Lookups": lookups,
+                "Hits": self.hits,
+                "Misses": self.misses,
+                "Hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def report(self):
+        table = PrettyTable(["Time(s)", "Events", "Total_rate", "Environments", "Lookups", "Hit_rate"])
+        stats = self.stats()
+        table.add_row(["{0:.6e}".format(self.time), len(self.tree), "{0:.6e}".format(self.tree.total),
+                       stats["Entries"], stats["Lookups"], "{0:.3f}".format(stats["Hit_rate"])])
+        print(table)
+        return table
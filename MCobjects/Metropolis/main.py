@@ -1,11 +1,25 @@
 from doctest import FAIL_FAST
 from tracemalloc import start
 from MCobjects.Metropolis.strategy import Exchange
+from MCobjects.Metropolis.schedule import TemperatureSchedule
 from cores.stepObject import StructureState
 from cores.stepObject import StepObject
+from cores.memoryStepObject import MemoryStepObject
 from calculators.vaspCalculators import VaspTask
+from calculators.vaspJobManager import VaspJobManager
 from model.mattersim_ import mattersim_predict
+from model.modelRegistry import ModelRegistry
+from model.energyBackend import EnergyBackend
+from cores.energyCache import EnergyCache
+from cores.trajectoryStore import TrajectoryStore
+from cores.checkpoint import Checkpoint
+from logger.runLogger import RunLogger
+from utilitys.phaseTimer import PhaseTimer
+from model.clusterExpansion import ClusterExpansion
+from pymatgen.core import Structure
 
+import numpy
+import asyncio
 import time
 import os
 
@@ -20,7 +34,7 @@ class Metropolis(object):
         self.dxec = dxec
 
 
-    def run(self, poscar_path:str, num_loops:int, T:float,
+    def run(self, poscar_path:str, num_loops:int, T,
             sublattice_symbols_lst:list,load_CHGnet=False,load_path=None,load_model:str=None,
             from_contcar=True,
             elements_str_for_vaspkit:str=None,
@@ -31,24 +45,208 @@ class Metropolis(object):
             open_diffusion = False,
             diffusion_specie:str=None,
             time_save:bool=True,
-            exchange_times:int=1):
-        
+            exchange_times:int=1,
+            in_memory:bool=False,
+            save_every:int=None,
+            num_trials:int=1,
+            chemical_potentials:dict=None,
+            mutation_probability:float=0.5,
+            seed=None,
+            energy_cache:bool=False,
+            cache_matcher:bool=False,
+            async_vasp:bool=False,
+            spare_nodefiles:list=None,
+            surrogate:bool=False,
+            surrogate_min_samples:int=20,
+            surrogate_confidence:float=2.0,
+            surrogate_freeze_after:int=None,
+            relax_mode:str='full',
+            local_radius:float=6.0,
+            full_relax_every:int=None,
+            relax_policy:str='converge',
+            relax_steps:int=50,
+            max_relax_steps:int=500,
+            accepted_relax_policy:str=None,
+            legacy_folders:bool=False,
+            store_positions:bool=True,
+            vac_process_files:bool=False,
+            checkpoint_every:int=1,
+            verbosity:str='info',
+            profile:str=None,
+            checkpoint:Checkpoint=None):
+        '''
+        T 为温度 (K) 或温度表 (模拟退火, 见 MCobjects.Metropolis.schedule: LinearSchedule, GeometricSchedule,
+        AdaptiveSchedule, ReheatingSchedule), 每一步以温度表的当前温度判断是否接受, 步后推进温度表;
+        每一步的温度记录在 steps.jsonl (内存模式下还有 mc_record.txt 的最后一列), 温度表的状态写入检查点
+
+        in_memory=True 时(仅 chgnet/mattersim), 结构与能量常驻内存,
+        只有被接受的结构(或每 save_every 步)写入步数文件夹
+
+        num_trials>1 时(内存模式), 每步生成 num_trials 个试探结构, 批量计算单点能,
+        以 multiple-try Metropolis 判据决定是否接受
+
+        chemical_potentials 不为 None 时(内存模式, 半巨正则系综), 给出各元素的化学势 μ (eV, 只有同一子晶格内的差值有意义,
+        可包括空位 vac_as, 需 vac_dope=True); 每步以 mutation_probability 的概率将一个位点替换为同一子晶格中的另一种元素
+        (见 `ExchangeAtoms.choose_mutation`), 以 Exchange.semi_grand_mark 判据 min(1, exp(-(ΔE-Δμ)/kT)) 决定是否接受,
+        其余步为通常的交换; 一条链即可在给定 μ 下得到平衡组成 (各步组成见 `TrajectoryReader.compositions`)
+
+        seed 不为 None 时, 交换原子与接受判据(内存模式下还包括弛豫扰动)使用
+        numpy.random.default_rng(seed), 同一 seed 的搜索可复现
+
+        energy_cache=True 时(chgnet/mattersim), 弛豫结果按结构指纹存入搜索总目录下的 energy_cache.sqlite,
+        再次出现的构型直接读取能量与 CONTCAR; cache_matcher=True 时额外以 StructureMatcher 识别对称等价构型
+
+        async_vasp=True 时(DFT), 以 asyncio 流水线运行 VASP (见 `self._run_vasp_pipeline`):
+        计算试探结构的同时预先生成下一个试探结构的输入文件; spare_nodefiles 给出额外的节点文件时,
+        预先生成的试探结构直接在空闲节点上开始计算
+
+        surrogate=True 时, 以步数文件夹中已有的能量拟合团簇展开代理模型 (见 model.clusterExpansion),
+        每步先按代理模型的 ΔE 做 delayed acceptance 第一阶段判断, 被拒绝的交换不计算真实能量;
+        通过后以 Exchange.delayed_mark 修正 (async_vasp 与 num_trials>1 时不使用); 代理模型每加入一个样本重新拟合,
+        链只渐近地满足细致平衡, surrogate_freeze_after 不为 None 时拟合样本数达到该值后固定模型, 此后平稳分布不变
+
+        relax_mode='local' 时(chgnet/mattersim), 以上一个已弛豫结构为起点, 只弛豫交换位点 local_radius (Å)
+        内的原子 (ASE FixAtoms 固定其余原子), 不弛豫晶胞; full_relax_every 不为 None 时,
+        每接受 full_relax_every 步对当前结构做一次完整弛豫
+
+        relax_policy (chgnet/mattersim) 决定试探结构的能量: 'none' 为交换后晶格的单点能,
+        'fixed_steps' 为最多弛豫 relax_steps 步, 'converge' 为弛豫至收敛 (最多 max_relax_steps 步); accepted_relax_policy 不为 None 时,
+        初始结构与被接受的结构再以该策略重新计算 (如单点能筛选 + 只弛豫被接受的结构),
+        每一步的能量来源记录在 mc_record.txt / 各步数文件夹的 energy_provenance.txt 中
+
+        每一步(占据、能量、接受概率、耗时、能量来源, store_positions=True 时还有弛豫后的晶格与坐标)
+        追加到搜索总目录下的 trajectory.bin (见 cores.trajectoryStore); legacy_folders=False 时
+        chgnet/mattersim 不再保留每一步的文件夹 (文件模式只保留 0 与当前/试探结构的文件夹, 内存模式不写出被接受的结构),
+        DFT 的步数文件夹总是保留
+
+        vac_dope=True 时, 含空位的完整晶格与去除空位的真实结构在内存中由空位掩码互相转换
+        (见 `LatticeState.mask`), 不再经过 process 文件夹中的临时文件; vac_process_files=True 时仍写出
+        process 文件夹、n.vasp 与 n.CONTCAR (文件模式)
+
+        搜索过程的日志由一个 RunLogger 写入搜索总目录下的 run.log 与 steps.jsonl (每步一行 JSON,
+        见 logger.runLogger), 文件只打开一次、缓冲写出; verbosity='debug' 时另外记录每次抽样的调试信息;
+        各步数文件夹中的 Accept.txt / time_record.txt 只在 legacy_folders=True 时写出
+
+        结构生成、弛豫、单点能、VASP、模型加载与文件写出等阶段的耗时由 utilitys.phaseTimer.PhaseTimer 记录,
+        搜索结束时输出各阶段的耗时表与直方图; profile='cprofile' 时另外在搜索总目录下写出 profile.pstats,
+        profile='trace' 时写出 trace.json (Chrome trace, 以 chrome://tracing 或 Perfetto 打开)
+
+        checkpoint_every 不为 None 时, 每 checkpoint_every 个循环(以及开始与结束时)在搜索总目录下原子地写出
+        checkpoint.json (见 cores.checkpoint.Checkpoint), 中断后以 `self.resume(搜索总目录)` 逐位续算;
+        checkpoint 由 `self.resume` 传入, 不需要手动设置
+        '''
+        run_kwargs = self.checkpoint_kwargs(locals())
         assert (elements_str_for_vaspkit is not None)
+        loops_done = 0
+        if checkpoint is not None:
+            load = True
+            loops_done = checkpoint.loops_done
+            checkpoint.restore_run_root(load_model)
+        #续算时温度表从检查点中的状态继续, 而不是从 run 参数中的起始状态
+        schedule = TemperatureSchedule.ensure(T)
+        if (checkpoint is not None) and (checkpoint.get("schedule") is not None):
+            schedule = TemperatureSchedule.from_state(checkpoint["schedule"])
+        run_logger = RunLogger.from_poscar_path(poscar_path, verbosity=verbosity,
+                                                steps_offset=None if checkpoint is None
+                                                else checkpoint.get("steps_log_offset"))
+        self.start_profiling(profile)
+        rng = numpy.random.default_rng(seed) if seed is not None else None
+        cache = None
+        if energy_cache and load_model:
+            cache = self.open_energy_cache(poscar_path, load_model, load_path,
+                                           vac_dope=vac_dope, vac_as=vac_as, use_matcher=cache_matcher,
+                                           relax_mode=relax_mode, relax_policy=relax_policy,
+                                           relax_steps=relax_steps)
+            if (checkpoint is not None) and (checkpoint["energy_cache"] is not None):
+                cache.rollback(checkpoint["energy_cache"])
+        trajectory = self.open_trajectory(poscar_path, sublattice_symbols_lst, vac_dope=vac_dope, vac_as=vac_as,
+                                          append=load, store_positions=store_positions)
+        if (checkpoint is not None) and (checkpoint["trajectory_records"] is not None):
+            trajectory.truncate(checkpoint["trajectory_records"])
+        surrogate_model = None
+        if chemical_potentials:
+            assert (num_trials == 1), 'chemical_potentials does not support num_trials > 1'
+            assert vac_dope or (vac_as not in chemical_potentials), 'vacancy chemical potential requires vac_dope=True'
+        #代理模型以固定组成的样本拟合, 半巨正则模式下不使用
+        if surrogate and not (async_vasp and not load_model) and num_trials == 1 and not chemical_potentials:
+            surrogate_model = self.open_surrogate(poscar_path, vac_dope=vac_dope, vac_as=vac_as,
+                                                  min_samples=surrogate_min_samples,
+                                                  confidence=surrogate_confidence,
+                                                  freeze_after=surrogate_freeze_after,
+                                                  state=None if checkpoint is None else checkpoint["surrogate"])
+        if in_memory or num_trials > 1 or chemical_potentials:
+            step_object = self._run_in_memory(poscar_path=poscar_path, num_loops=num_loops, schedule=schedule,
+                                       sublattice_symbols_lst=sublattice_symbols_lst,
+                                       load_path=load_path, load_model=load_model,
+                                       from_contcar=from_contcar,
+                                       elements_str_for_vaspkit=elements_str_for_vaspkit,
+                                       load=load, vac_dope=vac_dope, vac_as=vac_as,
+                                       open_diffusion=open_diffusion,
+                                       diffusion_specie=diffusion_specie,
+                                       time_save=time_save,
+                                       exchange_times=exchange_times,
+                                       save_every=save_every,
+                                       num_trials=num_trials,
+                                       chemical_potentials=chemical_potentials,
+                                       mutation_probability=mutation_probability,
+                                       rng=rng,
+                                       energy_cache=cache,
+                                       surrogate=surrogate_model,
+                                       relax_mode=relax_mode,
+                                       local_radius=local_radius,
+                                       full_relax_every=full_relax_every,
+                                       relax_policy=relax_policy,
+                                       relax_steps=relax_steps,
+                                       max_relax_steps=max_relax_steps,
+                                       accepted_relax_policy=accepted_relax_policy,
+                                       trajectory=trajectory,
+                                       save_accepted=legacy_folders,
+                                       checkpoint_every=checkpoint_every,
+                                       checkpoint=checkpoint,
+                                       run_kwargs=run_kwargs,
+                                       run_logger=run_logger)
+            self.finish_run(run_logger, profile)
+            return step_object
         #补丁,对初始文件进行计算
         if load_model=='chgnet':
             load_CHGnet=True
         print('一、初始化(计算初始文件)','\n')
+        #模型在整个搜索过程中只加载一次
+        ModelRegistry.preload(load_model, load_path=load_path)
+        #初始结构与被接受的结构使用相同的能量来源, 与试探结构的策略不同时不使用能量缓存
+        initial_relax_policy = accepted_relax_policy or relax_policy
+        initial_cache = cache if initial_relax_policy == relax_policy else None
+        next_poscar_path = None
+        next_local_centers = None
+        if checkpoint is not None:
+            #续算: 当前结构与已生成的试探结构取自检查点, 当前结构的能量已经计算过
+            state = checkpoint["step_object"]
+            vasp_folders_path = checkpoint.vasp_folders_path
+            poscar_path = os.path.join(vasp_folders_path, str(state["current_index"]), state["current_poscar"])
+            next_poscar_path = os.path.join(vasp_folders_path, str(state["next_index"]), state["next_poscar"])
+            if state["next_local_centers"] is not None:
+                next_local_centers = numpy.array(state["next_local_centers"])
         structure_state = StructureState(poscar_path=poscar_path,
                                          vac_dope=vac_dope,
                                          load_CHGnet=load_CHGnet,
-                                         load_path=load_path)
+                                         load_path=load_path,
+                                         energy_cache=initial_cache,
+                                         relax_policy=initial_relax_policy,
+                                         relax_steps=relax_steps,
+                                         max_relax_steps=max_relax_steps,
+                                         rng=rng)
         #补丁,对初始文件进行计算
         if load_model=='chgnet':
             structure_state.load_model(load_CHGnet = load_CHGnet,
                                         load_path=load_path)
-        elif load_model=='mattersim':
-            mattersim_predict.load(structure_state.poscar_path,
-                                   load_path=load_path)
+        elif (load_model=='mattersim') and not ((checkpoint is not None) and os.path.exists(structure_state.CHG_out_path)):
+            structure_state.energy = float(mattersim_predict.load(structure_state.poscar_path,
+                                                                  load_path=load_path,
+                                                                  energy_cache=initial_cache,
+                                                                  relax_policy=initial_relax_policy,
+                                                                  relax_steps=relax_steps,
+                                                                  max_relax_steps=max_relax_steps,
+                                                                  rng=rng).energy)
 
         print('二、执行交换生成结构','\n')
         step_object = StepObject(current_structure_state=structure_state,
@@ -59,64 +257,563 @@ class Metropolis(object):
                                 vac_dope=vac_dope,vac_as = vac_as,
                                 open_diffusion=open_diffusion,
                                 diffusion_specie=diffusion_specie,
-                                exchange_times=exchange_times,)
+                                exchange_times=exchange_times,
+                                rng=rng,
+                                energy_cache=cache,
+                                relax_mode=relax_mode,
+                                local_radius=local_radius,
+                                full_relax_every=full_relax_every,
+                                relax_policy=relax_policy,
+                                relax_steps=relax_steps,
+                                max_relax_steps=max_relax_steps,
+                                accepted_relax_policy=accepted_relax_policy,
+                                trajectory=trajectory,
+                                keep_folders=legacy_folders or not load_model,
+                                vac_process_files=vac_process_files,
+                                next_poscar_path=next_poscar_path,
+                                next_local_centers=next_local_centers,
+                                lazy_energy=surrogate_model is not None)
+        if checkpoint is not None:
+            checkpoint.restore_rng(rng)
+        save_checkpoint = lambda loop, force=False: self.save_checkpoint(
+            step_object, run_kwargs, loop, loops_done+num_loops, checkpoint_every,
+            energy_cache=cache, surrogate=surrogate_model, trajectory=trajectory, run_logger=run_logger,
+            schedule=schedule, force=force)
 
         print('三、执行循环搜索','\n')
         print(step_object.current_structure_state.vasp_folder_path)
+        if async_vasp and not load_model:
+            asyncio.run(self._run_vasp_pipeline(step_object, num_loops=num_loops, schedule=schedule,
+                                                vac_dope=vac_dope, time_save=time_save, rng=rng,
+                                                spare_nodefiles=spare_nodefiles,
+                                                save_checkpoint=save_checkpoint, loops_done=loops_done,
+                                                legacy_folders=legacy_folders))
+            trajectory.close()
+            self.finish_run(run_logger, profile)
+            return step_object
         for _ in range(num_loops):
-            start_time=time.time() 
-            if not load_model:
-                step_object.current_structure_state.get_energy()
-                E_1 = step_object.current_structure_state.energy
+            save_checkpoint(loops_done+_)
+            with PhaseTimer.phase("mc_step"):
+                start_time=time.time() 
+                #chgnet 的试探结构在上一步生成时已计算能量, 其用时计入本步
+                energy_time = step_object.next_structure_state.energy_time
+                T = schedule.T
+                delta_E_surrogate = None
+                if surrogate_model is not None:
+                    trial_lattice_structure = step_object.next_structure_state.get_lattice_structure()
+                    delta_E_surrogate = surrogate_model.screen_delta(
+                        step_object.current_structure_state.get_lattice_structure(), trial_lattice_structure)
+                if delta_E_surrogate is not None:
+                    screened,possibility = Exchange.screen_mark(delta_E_surrogate, T=T, rng=rng)
+                    surrogate_model.record(screened)
+                    if not screened:
+                        #续算前已生成并计算过能量的试探结构, 其能量同样加入代理模型的样本
+                        if load_model and os.path.exists(step_object.next_structure_state.CHG_out_path):
+                            surrogate_model.add(trial_lattice_structure,
+                                                float(step_object.next_structure_state.get_already_predict_energy()))
+                        if legacy_folders:
+                            accept_path = os.path.join(step_object.next_structure_state.vasp_folder_path,'Accept.txt')
+                            with open(accept_path, 'a') as f:
+                                f.write(f'代理模型第一阶段拒绝, 概率为：{possibility:.6f}\n')
+                        print(f'进入循环，第{_+1}次 (代理模型拒绝)')
+                        step_object.record_trajectory(None, None, possibility, False, time.time()-start_time, T=T)
+                        step_object.walk_anew()
+                        schedule.update(False, step_object.current_energy())
+                        continue
+                #E_1 即上一个被接受的 E_2 (拒绝时不变), 保存在内存中
+                E_1 = step_object.current_energy()
+                if not load_model:
+                    print(f'--------------{E_1}--------------')
+                    # 计算 E_2: 利用 集群(vasp) 或 机器学习模型(ML model)
+                    next_structure_vasp_folder = step_object.next_structure_state.vasp_folder_path
+                    vasp_task = VaspTask(next_structure_vasp_folder)
+                    vasp_task.generate_input_files(gen_poscar=False,vac_dope=vac_dope)
+                    vasp_task.mpirun(pbs_nodefile=self.pbs_nodefile,
+                                    np=self.np,
+                                    dxec=self.dxec)
+                    #计算 E_2
+                    step_object.next_structure_state.get_energy()
+                    E_2 = step_object.next_structure_state.energy
+
+
+                if load_model =='chgnet':
+                    if not os.path.exists(os.path.join(step_object.next_structure_state.vasp_folder_path,'relaxation_output.txt')):
+                        E_2 = step_object.next_structure_state.get_CHG_energy()
+                    else:
+                        E_2 = step_object.next_structure_state.get_already_predict_energy()
+                    step_object.next_structure_state.energy = float(E_2)
+
+                if load_model =='mattersim':
+                    if not os.path.exists(os.path.join(step_object.next_structure_state.vasp_folder_path,'relaxation_output.txt')):
+                        get_E2 = mattersim_predict.load(step_object.next_structure_state.poscar_path,
+                                                        load_path=load_path,
+                                                        energy_cache=cache,
+                                                        local_centers=step_object.next_structure_state.local_centers
+                                                        if relax_mode == 'local' else None,
+                                                        local_radius=local_radius,
+                                                        relax_policy=relax_policy,
+                                                        relax_steps=relax_steps,
+                                                        max_relax_steps=max_relax_steps,
+                                                        rng=rng)
+                        E_2 = get_E2.energy
+                    else:
+                        E_2 = step_object.next_structure_state.get_already_predict_energy()
+                    step_object.next_structure_state.energy = float(E_2)
+
+                end_time = time.time()
+                execution_time=end_time - start_time + energy_time
+                step_object.record_initial(E_1)
+
+                #书写交换概率
+                if surrogate_model is not None:
+                    surrogate_model.add(trial_lattice_structure, float(E_2))
+                if delta_E_surrogate is not None:
+                    exchange_mark,possibility = Exchange.delayed_mark(E_1=float(E_1), E_2=float(E_2), T=T,
+                                                                      delta_E_surrogate=delta_E_surrogate, rng=rng)
+                else:
+                    exchange_mark,possibility = Exchange.mark(E_1=float(E_1), E_2=float(E_2), T=T, rng=rng)
+                if legacy_folders:
+                    self.write_step_files(step_object, possibility, execution_time if time_save else None)
+                print(f'进入循环，第{_+1}次')
+
+                step_object.record_trajectory(E_1, E_2, possibility, exchange_mark, execution_time, T=T)
+            
+                if exchange_mark:
+                    step_object.walk()
+                else:
+                    step_object.walk_anew()
+                schedule.update(exchange_mark, float(E_2) if exchange_mark else float(E_1))
+
+        save_checkpoint(loops_done+num_loops, force=True)
+        trajectory.close()
+        self.finish_run(run_logger, profile)
+        if load_model:
+            ModelRegistry.report()
+        if surrogate_model is not None:
+            surrogate_model.report()
+        if cache is not None:
+            step_object.save_info()
+            cache.report()
+            cache.close()
+
+
+    async def _run_vasp_pipeline(self, step_object:StepObject, num_loops:int, schedule:TemperatureSchedule, *,
+                                 vac_dope=False, time_save:bool=True, rng=None,
+                                 spare_nodefiles:list=None, save_checkpoint=None, loops_done:int=0,
+                                 legacy_folders:bool=False):
+        '''
+        Description
+        -----------
+            1. DFT 模式的异步流水线: mpirun 由 VaspJobManager 以 asyncio 子进程启动, 以进程退出判断计算结束
+            2. 试探结构计算期间, 预先生成各分支(见 `StepObject.speculative_branches`)的下一个试探结构及其输入文件
+            3. 有空闲节点(spare_nodefiles)时, 预先生成的试探结构立即开始计算;
+                判据给出后, 被采用的分支移入搜索目录继续计算, 另一分支的计算被终止并删除
+            4. save_checkpoint(loop, force) 在每个循环开始与结束时调用 (见 `self.save_checkpoint`);
+                续算时正在计算的试探结构重新提交
+        '''
+        manager = VaspJobManager(pbs_nodefile=self.pbs_nodefile, np=self.np, dxec=self.dxec,
+                                 spare_nodefiles=spare_nodefiles, vac_dope=vac_dope)
+        step_object.discard_candidate()
+
+        step_object.record_initial(step_object.current_energy())
+        vasp_task = await manager.prepare(step_object.next_structure_state.vasp_folder_path)
+        job = manager.submit(vasp_task)
+        for _ in range(num_loops):
+            if save_checkpoint is not None:
+                save_checkpoint(loops_done+_)
+            with PhaseTimer.phase("mc_step"):
+                start_time=time.time()
+                E_1 = step_object.current_energy()
                 print(f'--------------{E_1}--------------')
-                # 计算 E_2: 利用 集群(vasp) 或 机器学习模型(ML model)
-                next_structure_vasp_folder = step_object.next_structure_state.vasp_folder_path
-                vasp_task = VaspTask(next_structure_vasp_folder)
-                vasp_task.generate_input_files(gen_poscar=False,vac_dope=vac_dope)
-                vasp_task.mpirun(pbs_nodefile=self.pbs_nodefile,
-                                np=self.np,
-                                dxec=self.dxec)
+                candidates = {}
+                for branch in step_object.speculative_branches():
+                    candidate_state = step_object.prepare_candidate(branch)
+                    candidate_task = await manager.prepare(candidate_state.vasp_folder_path,
+                                                           vasp_folders_path=step_object.vasp_folders_path)
+                    candidate_job = manager.submit(candidate_task) if manager.has_free_slot() else None
+                    candidates[branch] = (candidate_state, candidate_task, candidate_job)
+
+                await job
                 #计算 E_2
-                step_object.next_structure_state.get_energy()
-                E_2 = step_object.next_structure_state.energy
-
-
-            if load_model =='chgnet':
-                if not os.path.exists(os.path.join(step_object.current_structure_state.vasp_folder_path,'relaxation_output.txt')):
-                    E_1 = step_object.current_structure_state.get_CHG_energy()
-                E_1 = step_object.current_structure_state.get_already_predict_energy()
-                if not os.path.exists(os.path.join(step_object.next_structure_state.vasp_folder_path,'relaxation_output.txt')):
-                    E_2 = step_object.next_structure_state.get_CHG_energy()
-                E_2 = step_object.next_structure_state.get_already_predict_energy()
-
-            if load_model =='mattersim':
-                if not os.path.exists(os.path.join(step_object.current_structure_state.vasp_folder_path,'relaxation_output.txt')):
-                    get_E1 = mattersim_predict.load(step_object.current_structure_state.poscar_path,
-                                                    load_path=load_path)
-                    E_1 = get_E1.energy
-                E_1 = step_object.current_structure_state.get_already_predict_energy()
-                if not os.path.exists(os.path.join(step_object.next_structure_state.vasp_folder_path,'relaxation_output.txt')):
-                    get_E2 = mattersim_predict.load(step_object.next_structure_state.poscar_path,
-                                                    load_path=load_path)
-                    E_2 = get_E2.energy
-                E_2 = step_object.next_structure_state.get_already_predict_energy()
-
-            end_time = time.time()
-            execution_time=end_time - start_time
-
-            #书写交换概率
-            exchange_mark,possibility = Exchange.mark(E_1=float(E_1), E_2=float(E_2), T=T)
-            accept_path = os.path.join(step_object.next_structure_state.vasp_folder_path,'Accept.txt')
-            with open(accept_path, 'a') as f:
-                f.write(f'本次搜索继承概率为：{possibility:.6f}\n')
+                E_2 = step_object.next_structure_state.get_energy()
+                execution_time = time.time() - start_time
+
+                T = schedule.T
+                exchange_mark,possibility = Exchange.mark(E_1=float(E_1), E_2=float(E_2), T=T, rng=rng)
+                schedule.update(exchange_mark, float(E_2) if exchange_mark else float(E_1))
+                if legacy_folders:
+                    self.write_step_files(step_object, possibility, execution_time if time_save else None)
+                print(f'进入循环，第{_+1}次')
+
+                step_object.record_trajectory(E_1, E_2, possibility, exchange_mark, execution_time, T=T)
+
+                branch = 'accept' if exchange_mark else 'reject'
+                for other_branch, (candidate_state, _candidate_task, candidate_job) in candidates.items():
+                    if other_branch != branch:
+                        if candidate_job is not None:
+                            await manager.cancel(candidate_job)
+                        step_object.discard_candidate(candidate_state)
+
+                next_structure_state = None
+                if branch in candidates:
+                    candidate_state, vasp_task, job = candidates[branch]
+                    next_structure_state = step_object.promote_candidate(candidate_state)
+                    vasp_task.relocate(next_structure_state.vasp_folder_path)
+
+                if exchange_mark:
+                    step_object.walk(next_structure_state=next_structure_state)
+                else:
+                    step_object.walk_anew(next_structure_state=next_structure_state)
+
+                if next_structure_state is None:
+                    vasp_task = await manager.prepare(step_object.next_structure_state.vasp_folder_path)
+                    job = None
+                if job is None:
+                    job = manager.submit(vasp_task)
+
+        #最后一个试探结构不再需要
+        await manager.cancel(job)
+        step_object.discard_candidate()
+        if save_checkpoint is not None:
+            save_checkpoint(loops_done+num_loops, force=True)
+
+    def _run_in_memory(self, poscar_path:str, num_loops:int, schedule:TemperatureSchedule,
+                       sublattice_symbols_lst:list, load_path=None, load_model:str=None,
+                       from_contcar=True,
+                       elements_str_for_vaspkit:str=None,
+                       load=False,
+                       *,
+                       vac_dope = False,
+                       vac_as = 'V',
+                       open_diffusion = False,
+                       diffusion_specie:str=None,
+                       time_save:bool=True,
+                       exchange_times:int=1,
+                       save_every:int=None,
+                       num_trials:int=1,
+                       chemical_potentials:dict=None,
+                       mutation_probability:float=0.5,
+                       rng=None,
+                       energy_cache:EnergyCache=None,
+                       surrogate:ClusterExpansion=None,
+                       relax_mode:str='full',
+                       local_radius:float=6.0,
+                       full_relax_every:int=None,
+                       relax_policy:str='converge',
+                       relax_steps:int=50,
+                       max_relax_steps:int=500,
+                       accepted_relax_policy:str=None,
+                       trajectory:TrajectoryStore=None,
+                       save_accepted:bool=True,
+                       checkpoint_every:int=1,
+                       checkpoint:Checkpoint=None,
+                       run_kwargs:dict=None,
+                       run_logger:RunLogger=None):
+
+        assert (load_model in ('chgnet', 'mattersim'))
+        print('一、初始化(计算初始文件)','\n')
+        energy_backend = EnergyBackend.from_name(load_model, load_path=load_path,
+                                                 relax_mode=relax_mode, local_radius=local_radius,
+                                                 relax_policy=relax_policy, relax_steps=relax_steps,
+                                                 max_relax_steps=max_relax_steps)
+        energy_backend.preload()
+        step_kwargs = dict(sublattice_symbols_lst=sublattice_symbols_lst,
+                           elements_str_for_vaspkit=elements_str_for_vaspkit,
+                           from_contcar=from_contcar, load=load,
+                           vac_dope=vac_dope, vac_as=vac_as,
+                           open_diffusion=open_diffusion,
+                           diffusion_specie=diffusion_specie,
+                           exchange_times=exchange_times,
+                           save_every=save_every,
+                           rng=rng,
+                           energy_cache=energy_cache,
+                           surrogate=surrogate,
+                           full_relax_every=full_relax_every,
+                           accepted_relax_policy=accepted_relax_policy,
+                           trajectory=trajectory,
+                           save_accepted=save_accepted)
+        loops_done = 0
+        if checkpoint is None:
+            step_object = MemoryStepObject.from_folder(poscar_path=poscar_path,
+                                                       energy_backend=energy_backend,
+                                                       **step_kwargs)
+            if num_trials > 1:
+                #multiple-try 模式在固定几何下比较单点能
+                step_object.energy = float(step_object.predict_batch([step_object.structure])[0])
+        else:
+            #续算: 当前结构与能量取自检查点
+            loops_done = checkpoint.loops_done
+            step_object = MemoryStepObject.from_checkpoint(checkpoint, energy_backend=energy_backend, **step_kwargs)
+            checkpoint.restore_rng(rng)
+
+        print('二、执行循环搜索','\n')
+        for _ in range(num_loops):
+            self.save_checkpoint(step_object, run_kwargs, loops_done+_, loops_done+num_loops, checkpoint_every,
+                                 energy_cache=energy_cache, surrogate=step_object.surrogate, trajectory=trajectory,
+                                 run_logger=run_logger, schedule=schedule)
+            with PhaseTimer.phase("mc_step"):
+                accepted = self.memory_step(step_object, schedule.T, num_trials=num_trials, time_save=time_save,
+                                            chemical_potentials=chemical_potentials,
+                                            mutation_probability=mutation_probability)
+            schedule.update(accepted, step_object.energy)
             print(f'进入循环，第{_+1}次')
 
-            if time_save:
-                time_path = os.path.join(step_object.next_structure_state.vasp_folder_path,'time_record.txt')       #储存处理
-                with open(time_path, 'a') as f:
-                    f.write(f'{execution_time:.6f}\n')
-            
-            if exchange_mark:
-                step_object.walk()
-            else:
-                step_object.walk_anew()
\ No newline at end of file
+        self.save_checkpoint(step_object, run_kwargs, loops_done+num_loops, loops_done+num_loops, checkpoint_every,
+                             energy_cache=energy_cache, surrogate=step_object.surrogate, trajectory=trajectory,
+                             run_logger=run_logger, schedule=schedule, force=True)
+        step_object.close()
+        if trajectory is not None:
+            trajectory.close()
+        ModelRegistry.report()
+        if surrogate is not None:
+            surrogate.report()
+        if energy_cache is not None:
+            energy_cache.report()
+            energy_cache.close()
+        return step_object
+
+    def resume(self, run_root:str, num_loops:int=None, **kwargs):
+        '''
+        Description
+        -----------
+            1. 由搜索总目录下的 checkpoint.json 续算: 以检查点中的 run 参数 (kwargs 可覆盖) 继续搜索
+            2. num_loops 为 None 时运行检查点中剩余的循环数
+            3. 检查点之后写出的步数文件夹、轨迹记录、mc_record.txt 记录与能量缓存记录被删除,
+                随机数状态还原后与未中断的搜索逐位一致 (覆盖会改变轨迹的参数时除外)
+        '''
+        checkpoint = Checkpoint.from_run_root(run_root)
+        run_kwargs = dict(checkpoint["run_kwargs"])
+        run_kwargs.update(kwargs)
+        if num_loops is None:
+            num_loops = checkpoint.num_loops - checkpoint.loops_done
+        print(f'由检查点续算: 已完成{checkpoint.loops_done}个循环, 继续{num_loops}个循环')
+        return self.run(num_loops=num_loops, checkpoint=checkpoint, **run_kwargs)
+
+    @staticmethod
+    def start_profiling(profile:str=None):
+        '''
+        每次搜索重新开始分阶段计时; profile 为 None, 'cprofile' 或 'trace'
+        '''
+        if profile not in (None, 'cprofile', 'trace'):
+            raise ValueError(f"profile must be None, 'cprofile' or 'trace', got {profile!r}")
+        PhaseTimer.clear()
+        if profile == 'cprofile':
+            PhaseTimer.start_profile()
+        elif profile == 'trace':
+            PhaseTimer.start_trace()
+
+    @staticmethod
+    def finish_run(run_logger:RunLogger, profile:str=None):
+        '''
+        搜索结束: 输出分阶段耗时表, 写出 profile.pstats / trace.json, 关闭 run.log 与 steps.jsonl
+        '''
+        PhaseTimer.report()
+        if profile == 'cprofile':
+            PhaseTimer.stop_profile(os.path.join(run_logger.vasp_folders_path, "profile.pstats"))
+        elif profile == 'trace':
+            PhaseTimer.write_trace(os.path.join(run_logger.vasp_folders_path, "trace.json"))
+        run_logger.close()
+
+    @staticmethod
+    @PhaseTimer.timed("write_step_files")
+    def write_step_files(step_object:StepObject, possibility:float, execution_time:float=None):
+        '''
+        legacy_folders=True 时在试探结构的步数文件夹中写出 Accept.txt (接受概率) 与 time_record.txt (耗时)
+        '''
+        vasp_folder_path = step_object.next_structure_state.vasp_folder_path
+        with open(os.path.join(vasp_folder_path,'Accept.txt'), 'a') as f:
+            f.write(f'本次搜索继承概率为：{possibility:.6f}\n')
+        if execution_time is not None:
+            with open(os.path.join(vasp_folder_path,'time_record.txt'), 'a') as f:    #储存处理
+                f.write(f'{execution_time:.6f}\n')
+
+    @staticmethod
+    def checkpoint_kwargs(run_locals:dict) -> dict:
+        '''
+        写入检查点的 run 参数; seed 只决定是否使用独立的随机数生成器, 其状态由检查点还原;
+        温度表记为其起始状态 (当前状态另存于检查点中)
+        '''
+        run_kwargs = {key: value for key, value in run_locals.items()
+                      if key not in ('self', 'num_loops', 'load', 'checkpoint')}
+        if isinstance(run_kwargs["T"], TemperatureSchedule):
+            run_kwargs["T"] = run_kwargs["T"].state()
+        seed = run_kwargs["seed"]
+        if seed is not None:
+            run_kwargs["seed"] = int(seed) if isinstance(seed, (int, numpy.integer)) else 0
+        return run_kwargs
+
+    @staticmethod
+    def save_checkpoint(step_object, run_kwargs:dict, loops_done:int, num_loops:int, checkpoint_every:int=None,
+                        energy_cache:EnergyCache=None, surrogate:ClusterExpansion=None,
+                        trajectory:TrajectoryStore=None, run_logger:RunLogger=None,
+                        schedule:TemperatureSchedule=None, force:bool=False):
+        '''
+        每 checkpoint_every 个循环 (以及 force=True 时) 写出检查点;
+        文件模式下写出后(或不写检查点时)删除不再需要的步数文件夹 (见 `StepObject.prune`)
+        '''
+        if checkpoint_every:
+            if not (force or loops_done % checkpoint_every == 0):
+                return
+            Checkpoint(step_object.vasp_folders_path).capture(step_object, run_kwargs, loops_done, num_loops,
+                                                              energy_cache=energy_cache, surrogate=surrogate,
+                                                              trajectory=trajectory,
+                                                              run_logger=run_logger,
+                                                              schedule=schedule).save()
+        if isinstance(step_object, StepObject):
+            step_object.prune()
+
+    @staticmethod
+    def open_energy_cache(poscar_path:str, load_model:str, load_path=None,
+                          vac_dope=False, vac_as='V', use_matcher:bool=False,
+                          relax_mode:str='full', relax_policy:str='converge',
+                          relax_steps:int=50) -> EnergyCache:
+        '''
+        在搜索总目录下打开(或建立) energy_cache.sqlite, 以初始文件夹中的结构(含空位)作为参考位点;
+        局部弛豫的能量依赖于弛豫起点, 单点能/固定步数弛豫的能量依赖于策略, 均与收敛的完整弛豫分开存放;
+        写入的记录以搜索总目录标记 (run_id), 续算时只回滚本搜索的记录
+        '''
+        vasp_folder_path = os.path.dirname(poscar_path)
+        vasp_folders_path = os.path.dirname(vasp_folder_path)
+        namespace = f'{load_model}:{load_path}'
+        if relax_policy != 'converge':
+            namespace += ':' + EnergyBackend.describe_policy(relax_policy, relax_steps)
+        if relax_mode == 'local':
+            namespace += ':local'
+        cache = EnergyCache.from_run_root(vasp_folders_path,
+                                          namespace=namespace,
+                                          use_matcher=use_matcher,
+                                          vac_as=vac_as,
+                                          run_id=os.path.abspath(vasp_folders_path))
+        cache.set_reference(Metropolis.reference_structure(poscar_path, vac_dope=vac_dope))
+        return cache
+
+    @staticmethod
+    def reference_structure(poscar_path:str, vac_dope=False) -> Structure:
+        '''
+        初始文件夹中的结构, vac_dope 时为含空位的 n.POSCAR
+        '''
+        vasp_folder_path = os.path.dirname(poscar_path)
+        if vac_dope:
+            structure_index = os.path.basename(vasp_folder_path)
+            return Structure.from_file(os.path.join(vasp_folder_path, structure_index+'.POSCAR'))
+        return Structure.from_file(poscar_path)
+
+    @staticmethod
+    def open_trajectory(poscar_path:str, sublattice_symbols_lst:list, vac_dope=False, vac_as='V',
+                        append:bool=False, store_positions:bool=True) -> TrajectoryStore:
+        '''
+        在搜索总目录下建立(append=True 时续写) trajectory.bin, 以初始文件夹中的结构(含空位)作为参考位点
+        '''
+        vasp_folders_path = os.path.dirname(os.path.dirname(poscar_path))
+        species = [symbol for symbols in sublattice_symbols_lst for symbol in symbols]
+        return TrajectoryStore.from_run_root(vasp_folders_path,
+                                             Metropolis.reference_structure(poscar_path, vac_dope=vac_dope),
+                                             species=species, vac_as=vac_as,
+                                             append=append, store_positions=store_positions)
+
+    @staticmethod
+    def open_surrogate(poscar_path:str, vac_dope=False, vac_as='V', state:dict=None, **kwargs) -> ClusterExpansion:
+        '''
+        以搜索总目录中已有的步数文件夹拟合团簇展开代理模型; state 不为 None 时 (续算) 由检查点还原
+        '''
+        vasp_folders_path = os.path.dirname(os.path.dirname(poscar_path))
+        if state is not None:
+            surrogate = ClusterExpansion.from_checkpoint(vasp_folders_path, state, vac_dope=vac_dope, vac_as=vac_as,
+                                                         **kwargs)
+            print(f'代理模型: 由检查点还原{len(surrogate.samples)}个样本')
+            return surrogate
+        surrogate = ClusterExpansion.from_run_root(vasp_folders_path, vac_dope=vac_dope, vac_as=vac_as, **kwargs)
+        print(f'代理模型: 由已有的{len(surrogate.samples)}个结构拟合')
+        return surrogate
+
+    @classmethod
+    def memory_step(cls, step_object:MemoryStepObject, T:float, num_trials:int=1,
+                    time_save:bool=True, chemical_potentials:dict=None, mutation_probability:float=0.5) -> bool:
+        '''
+        内存模式下的一步 Metropolis (num_trials>1 时为 multiple-try, chemical_potentials 不为 None 时
+        以 mutation_probability 的概率为半巨正则的元素替换), 返回是否接受
+        '''
+        start_time=time.time()
+        step_object.temperature = T
+        if num_trials > 1:
+            return cls._multiple_try_step(step_object, T, num_trials, start_time, time_save)
+        if chemical_potentials and step_object.whether_mutate(mutation_probability):
+            return cls._semi_grand_step(step_object, T, chemical_potentials, start_time, time_save)
+
+        E_1 = step_object.energy
+        E_s1 = step_object.predict_surrogate()
+        trial_structure = step_object.propose()
+
+        delta_E_surrogate = None
+        if E_s1 is not None:
+            delta_E_surrogate = step_object.surrogate.shrink(step_object.predict_surrogate() - E_s1)
+            screened,possibility = Exchange.screen_mark(delta_E_surrogate, T=T, rng=step_object.rng)
+            step_object.surrogate.record(screened)
+            if not screened:
+                execution_time = time.time() - start_time if time_save else None
+                step_object.walk_screened(possibility, execution_time)
+                return False
+
+        E_2, relaxed_structure = step_object.evaluate(trial_structure, local_centers=step_object.local_centers())
+        step_object.learn(E_2)
+        execution_time = time.time() - start_time if time_save else None
+
+        if delta_E_surrogate is not None:
+            exchange_mark,possibility = Exchange.delayed_mark(E_1=float(E_1), E_2=float(E_2), T=T,
+                                                              delta_E_surrogate=delta_E_surrogate,
+                                                              rng=step_object.rng)
+        else:
+            exchange_mark,possibility = Exchange.mark(E_1=float(E_1), E_2=float(E_2), T=T, rng=step_object.rng)
+
+        if exchange_mark:
+            step_object.walk(E_2, relaxed_structure, possibility, execution_time)
+        else:
+            step_object.walk_anew(E_2, relaxed_structure, possibility, execution_time)
+        return exchange_mark
+
+    @staticmethod
+    def _semi_grand_step(step_object:MemoryStepObject, T:float, chemical_potentials:dict,
+                         start_time:float, time_save:bool=True):
+        '''
+        半巨正则的一步: 原位替换一个位点的元素, 计算能量后以 Exchange.semi_grand_mark 判据接受或拒绝
+        '''
+        E_1 = step_object.energy
+        trial_structure, delta_mu = step_object.propose_mutation(chemical_potentials)
+        E_2, relaxed_structure = step_object.evaluate(trial_structure, local_centers=step_object.local_centers())
+        execution_time = time.time() - start_time if time_save else None
+
+        exchange_mark,possibility = Exchange.semi_grand_mark(E_1=float(E_1), E_2=float(E_2), delta_mu=delta_mu,
+                                                             T=T, rng=step_object.rng)
+        if exchange_mark:
+            step_object.walk(E_2, relaxed_structure, possibility, execution_time)
+        else:
+            step_object.walk_anew(E_2, relaxed_structure, possibility, execution_time)
+        return exchange_mark
+
+    @staticmethod
+    def _multiple_try_step(step_object:MemoryStepObject, T:float, num_trials:int,
+                           start_time:float, time_save:bool=True):
+        '''
+        Multiple-try Metropolis 的一步:
+            1. 由当前结构生成 num_trials 个试探结构, 批量计算单点能, 按 Boltzmann 权重选出一个
+            2. 由被选结构生成 num_trials-1 个参考结构, 批量计算单点能, 与当前结构一起构成参考集
+            3. 以 Exchange.multiple_try_mark 判据接受或拒绝
+        '''
+        E_1 = step_object.energy
+        trial_pairs_lst, trial_structures = step_object.propose_batch(num_trials)
+        E_trials = step_object.predict_batch(trial_structures)
+        chosen = Exchange.select(E_trials, T, rng=step_object.rng)
+
+        step_object.apply_trial(trial_pairs_lst[chosen])
+        _, reference_structures = step_object.propose_batch(num_trials - 1)
+        E_references = list(step_object.predict_batch(reference_structures)) + [E_1]
+
+        E_2 = float(E_trials[chosen])
+        exchange_mark,possibility = Exchange.multiple_try_mark(E_trials, E_references, T, rng=step_object.rng)
+        execution_time = time.time() - start_time if time_save else None
+
+        if exchange_mark:
+            step_object.walk(E_2, step_object.structure, possibility, execution_time)
+        else:
+            step_object.walk_anew(E_2, step_object.structure, possibility, execution_time)
+        return exchange_mark
@@ -0,0 +1,256 @@
+from prettytable import PrettyTable
+import math
+
+
+class TemperatureSchedule(object):
+    '''
+    Description
+    -----------
+        1. Metropolis.run 的温度表 (模拟退火): 每一步以 self.T 作为 Exchange.mark 等判据的温度,
+            步后以 `self.update(accepted, energy)` 推进
+        2. `self.state()` 为可 JSON 序列化的字典 (构造参数 + 当前状态), 写入检查点,
+            续算时由 `TemperatureSchedule.from_state` 还原, 与未中断的退火逐位一致
+        3. `TemperatureSchedule.ensure(T)`: 数值为恒温 (ConstantSchedule), 字典为 `self.state()`
+
+    Attributes
+    ----------
+        1. self.T_start: float
+            起始温度 (K), 重新升温时可改变 (见 ReheatingSchedule)
+        2. self.T: float
+            当前温度 (K)
+        3. self.step: int
+            已推进的步数
+    '''
+    name = None
+
+    def __init__(self, T_start: float):
+        self.T_start = float(T_start)
+        self.T = self.T_start
+        self.step = 0
+
+    def __repr__(self):
+        table = PrettyTable(["Schedule", "Step", "T_start", "T"])
+        table.add_row([self.name, self.step, self.T_start, "{0:.2f}".format(self.T)])
+        print(table)
+        return ""
+
+    def __str__(self):
+        return self.__repr__()
+
+    @classmethod
+    def registry(cls) -> dict:
+        schedules = {}
+        for subclass in cls.__subclasses__():
+            schedules[subclass.name] = subclass
+            schedules.update(subclass.registry())
+        return schedules
+
+    @classmethod
+    def ensure(cls, T) -> 'TemperatureSchedule':
+        if isinstance(T, TemperatureSchedule):
+            return T
+        if isinstance(T, dict):
+            return cls.from_state(T)
+        return ConstantSchedule(T)
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'TemperatureSchedule':
+        schedules = cls.registry()
+        if state["name"] not in schedules:
+            raise ValueError("Unknown temperature schedule {0!r}".format(state["name"]))
+        schedule = schedules[state["name"]](**state["params"])
+        schedule.load_state(state)
+        return schedule
+
+    def params(self) -> dict:
+        '''
+        构造参数 (`from_state` 以此重建)
+        '''
+        return {"T_start": self.T_start}
+
+    def state(self) -> dict:
+        return {"name": self.name, "params": self.params(), "T": self.T, "step": self.step}
+
+    def load_state(self, state: dict):
+        self.T = float(state["T"])
+        self.step = int(state["step"])
+
+    def temperature(self) -> float:
+        '''
+        第 self.step 步的温度 (解析的温度表)
+        '''
+        return self.T_start
+
+    def update(self, accepted: bool, energy: float = None):
+        '''
+        推进一步; accepted 为本步是否接受, energy 为本步之后的当前能量
+        '''
+        self.step += 1
+        self.T = self.temperature()
+
+    def reset(self, T_start: float = None):
+        '''
+        从头开始 (T_start 不为 None 时以它为新的起始温度)
+        '''
+        if T_start is not None:
+            self.T_start = float(T_start)
+        self.step = 0
+        self.T = self.temperature()
+
+
+class ConstantSchedule(TemperatureSchedule):
+    '''
+    恒温, 等同于以数值给出 T
+    '''
+    name = 'constant'
+
+
+class LinearSchedule(TemperatureSchedule):
+    '''
+    num_steps 步内由 T_start 线性降至 T_end, 之后保持 T_end
+    '''
+    name = 'linear'
+
+    def __init__(self, T_start: float, T_end: float, num_steps: int):
+        super().__init__(T_start)
+        self.T_end = float(T_end)
+        self.num_steps = int(num_steps)
+
+    def params(self) -> dict:
+        return {"T_start": self.T_start, "T_end": self.T_end, "num_steps": self.num_steps}
+
+    def temperature(self) -> float:
+        fraction = min(self.step / self.num_steps, 1.0)
+        return self.T_start + (self.T_end - self.T_start) * fraction
+
+
+class GeometricSchedule(TemperatureSchedule):
+    '''
+    num_steps 步内由 T_start 按固定比例降至 T_end (每步乘以 (T_end/T_start)^(1/num_steps)), 之后保持 T_end
+    '''
+    name = 'geometric'
+
+    def __init__(self, T_start: float, T_end: float, num_steps: int):
+        if not (T_start > 0 and T_end > 0):
+            raise ValueError("Geometric schedule requires positive temperatures, got {0} -> {1}".format(T_start, T_end))
+        super().__init__(T_start)
+        self.T_end = float(T_end)
+        self.num_steps = int(num_steps)
+
+    def params(self) -> dict:
+        return {"T_start": self.T_start, "T_end": self.T_end, "num_steps": self.num_steps}
+
+    def temperature(self) -> float:
+        fraction = min(self.step / self.num_steps, 1.0)
+        return self.T_start * (self.T_end / self.T_start) ** fraction
+
+
+class AdaptiveSchedule(TemperatureSchedule):
+    '''
+    Description
+    -----------
+        1. 每 interval 步统计接受率: 不低于 target_acceptance 时 (温度仍远高于有序化的能量尺度) T 乘以 fast_cooling,
+            否则 T 乘以 slow_cooling, 直到 T_min
+        2. 高温段快速降温、接近冻结时缓慢降温, 与固定降温速率相比, 达到低能有序结构所需的能量计算更少
+    '''
+    name = 'adaptive'
+
+    def __init__(self, T_start: float, T_min: float = 1.0, interval: int = 20, target_acceptance: float = 0.2,
+                 fast_cooling: float = 0.8, slow_cooling: float = 0.97):
+        super().__init__(T_start)
+        self.T_min = float(T_min)
+        self.interval = int(interval)
+        self.target_acceptance = float(target_acceptance)
+        self.fast_cooling = float(fast_cooling)
+        self.slow_cooling = float(slow_cooling)
+        self.accepted = 0
+
+    def params(self) -> dict:
+        return {"T_start": self.T_start, "T_min": self.T_min, "interval": self.interval,
+                "target_acceptance": self.target_acceptance,
+                "fast_cooling": self.fast_cooling, "slow_cooling": self.slow_cooling}
+
+    def state(self) -> dict:
+        return dict(super().state(), accepted=self.accepted)
+
+    def load_state(self, state: dict):
+        super().load_state(state)
+        self.accepted = int(state["accepted"])
+
+    def update(self, accepted: bool, energy: float = None):
+        self.step += 1
+        self.accepted += int(accepted)
+        if self.step % self.interval == 0:
+            acceptance = self.accepted / self.interval
+            cooling = self.fast_cooling if acceptance >= self.target_acceptance else self.slow_cooling
+            self.T = max(self.T * cooling, self.T_min)
+            self.accepted = 0
+
+    def reset(self, T_start: float = None):
+        if T_start is not None:
+            self.T_start = float(T_start)
+        self.step = 0
+        self.accepted = 0
+        self.T = self.T_start
+
+
+class ReheatingSchedule(TemperatureSchedule):
+    '''
+    Description
+    -----------
+        1. 包装另一个温度表: 当前能量连续 patience 步没有低于最低能量 (差值小于 tolerance 视为没有降低) 时,
+            重新升温: 内层温度表从头开始, 起始温度乘以 reheat_factor
+        2. 最多重新升温 max_reheats 次 (None 时不限), 用于跳出退火过程中的局部极小
+    '''
+    name = 'reheating'
+
+    def __init__(self, schedule, patience: int = 200, reheat_factor: float = 1.0, max_reheats: int = None,
+                 tolerance: float = 1e-6):
+        self.schedule = TemperatureSchedule.ensure(schedule)
+        super().__init__(self.schedule.T_start)
+        self.T = self.schedule.T
+        self.patience = int(patience)
+        self.reheat_factor = float(reheat_factor)
+        self.max_reheats = max_reheats
+        self.tolerance = float(tolerance)
+        self.best_energy = math.inf
+        self.since_improvement = 0
+        self.reheats = 0
+
+    def params(self) -> dict:
+        return {"schedule": self.schedule.state(), "patience": self.patience, "reheat_factor": self.reheat_factor,
+                "max_reheats": self.max_reheats, "tolerance": self.tolerance}
+
+    def state(self) -> dict:
+        return dict(super().state(),
+                    best_energy=None if math.isinf(self.best_energy) else self.best_energy,
+                    since_improvement=self.since_improvement,
+                    reheats=self.reheats)
+
+    def load_state(self, state: dict):
+        super().load_state(state)
+        self.best_energy = math.inf if state["best_energy"] is None else float(state["best_energy"])
+        self.since_improvement = int(state["since_improvement"])
+        self.reheats = int(state["reheats"])
+
+    def update(self, accepted: bool, energy: float = None):
+        self.step += 1
+        self.schedule.update(accepted, energy)
+        if (energy is not None) and (energy < self.best_energy - self.tolerance):
+            self.best_energy = float(energy)
+            self.since_improvement = 0
+        else:
+            self.since_improvement += 1
+        if (self.since_improvement >= self.patience) and \
+                ((self.max_reheats is None) or (self.reheats < self.max_reheats)):
+            self.reheats += 1
+            self.since_improvement = 0
+            self.schedule.reset(self.schedule.T_start * self.reheat_factor)
+            print(f'重新升温(第{self.reheats}次): T = {self.schedule.T:.2f}')
+        self.T = self.schedule.T
+
+    def reset(self, T_start: float = None):
+        self.schedule.reset(T_start)
+        self.step = 0
+        self.since_improvement = 0
+        self.T = self.schedule.T
@@ -15,8 +15,11 @@ class Exchange(object):
     k = 8.617333262145E-5
 
     @classmethod
-    def mark(cls, E_1:float, E_2:float, T:float) -> float:
-        random_number = np.random.rand()
+    def mark(cls, E_1:float, E_2:float, T:float, rng=None) -> float:
+        '''
+        rng: np.random.Generator, None 时使用 np.random 的全局状态
+        '''
+        random_number = cls._rng(rng).random()
         
         delta_E = E_2 - E_1
 
@@ -29,4 +32,134 @@ class Exchange(object):
         if ( possibility > random_number ):
             return True,possibility
         
-        return False,possibility
\ No newline at end of file
+        return False,possibility
+
+    @classmethod
+    def select(cls, energies:list, T:float, rng=None) -> int:
+        '''
+        按 Boltzmann 权重 exp(-E/kT) 从 K 个试探结构中选择一个, 返回其序号
+        '''
+        log_weights = - np.asarray(energies, dtype=float) / (cls.k * T)
+        weights = np.exp(log_weights - log_weights.max())
+        return int(cls._rng(rng).choice(len(weights), p=weights / weights.sum()))
+
+    @classmethod
+    def multiple_try_mark(cls, E_trials:list, E_references:list, T:float, rng=None):
+        '''
+        Multiple-try Metropolis 判据:
+            possibility = min(1, Σ exp(-E_trial/kT) / Σ exp(-E_reference/kT))
+        E_references 为由被选结构出发的 K-1 个参考结构以及当前结构的能量
+        '''
+        random_number = cls._rng(rng).random()
+
+        log_numerator = cls._logsumexp(- np.asarray(E_trials, dtype=float) / (cls.k * T))
+        log_denominator = cls._logsumexp(- np.asarray(E_references, dtype=float) / (cls.k * T))
+        possibility = math.exp(min(0.0, log_numerator - log_denominator))
+
+        if ( possibility > random_number ):
+            return True,possibility
+
+        return False,possibility
+
+    @classmethod
+    def screen_mark(cls, delta_E_surrogate:float, T:float, rng=None):
+        '''
+        Delayed acceptance 第一阶段 (代理模型, 不计算真实能量):
+            possibility = min(1, exp(-ΔE_s/kT))
+        '''
+        random_number = cls._rng(rng).random()
+
+        possibility = math.exp(min(0.0, - delta_E_surrogate / (cls.k * T)))
+
+        if ( possibility > random_number ):
+            return True,possibility
+
+        return False,possibility
+
+    @classmethod
+    def delayed_mark(cls, E_1:float, E_2:float, T:float, delta_E_surrogate:float, rng=None):
+        '''
+        Delayed acceptance 第二阶段 (通过第一阶段后计算真实能量):
+            possibility = min(1, exp(-(ΔE - ΔE_s)/kT))
+        两阶段的乘积满足细致平衡, 平稳分布与 `Exchange.mark` 相同
+        '''
+        random_number = cls._rng(rng).random()
+
+        exponent = - ((E_2 - E_1) - delta_E_surrogate) / (cls.k * T)
+        possibility = math.exp(min(0.0, exponent))
+
+        if ( possibility > random_number ):
+            return True,possibility
+
+        return False,possibility
+
+    @classmethod
+    def semi_grand_mark(cls, E_1:float, E_2:float, delta_mu:float, T:float, rng=None):
+        '''
+        半巨正则系综的元素替换判据 (Ω = E - Σ μ_i N_i):
+            possibility = min(1, exp(-(ΔE - Δμ)/kT)),  Δμ = μ_新元素 - μ_原元素
+        '''
+        random_number = cls._rng(rng).random()
+
+        exponent = - ((E_2 - E_1) - delta_mu) / (cls.k * T)
+        possibility = math.exp(min(0.0, exponent))
+
+        if ( possibility > random_number ):
+            return True,possibility
+
+        return False,possibility
+
+    @classmethod
+    def wang_landau_mark(cls, ln_g_1:float, ln_g_2:float, rng=None):
+        '''
+        Wang–Landau 判据 (与温度无关):
+            possibility = min(1, g(E_1)/g(E_2))
+        '''
+        random_number = cls._rng(rng).random()
+
+        possibility = math.exp(min(0.0, ln_g_1 - ln_g_2))
+
+        if ( possibility > random_number ):
+            return True,possibility
+
+        return False,possibility
+
+    @classmethod
+    def window_swap_mark(cls, ln_g_i_x:float, ln_g_i_y:float, ln_g_j_y:float, ln_g_j_x:float, rng=None):
+        '''
+        REWL 相邻能量窗口交换构型的判据 (窗口 i 的构型 x 与窗口 j 的构型 y):
+            possibility = min(1, g_i(E_x) g_j(E_y) / (g_i(E_y) g_j(E_x)))
+        '''
+        random_number = cls._rng(rng).random()
+
+        possibility = math.exp(min(0.0, ln_g_i_x - ln_g_i_y + ln_g_j_y - ln_g_j_x))
+
+        if ( possibility > random_number ):
+            return True,possibility
+
+        return False,possibility
+
+    @staticmethod
+    def _rng(rng=None):
+        return np.random if rng is None else rng
+
+    @staticmethod
+    def _logsumexp(values:np.ndarray) -> float:
+        max_value = values.max()
+        return float(max_value + np.log(np.exp(values - max_value).sum()))
+
+    @classmethod
+    def swap_mark(cls, E_i:float, E_j:float, T_i:float, T_j:float, rng=None):
+        '''
+        Replica exchange 判据 (交换温度 T_i 与 T_j 下的构型):
+            possibility = min(1, exp((β_i - β_j)(E_i - E_j))),  β = 1/kT
+        '''
+        random_number = cls._rng(rng).random()
+
+        exponent = (1.0 / (cls.k * T_i) - 1.0 / (cls.k * T_j)) * (E_i - E_j)
+        possibility = math.exp(min(0.0, exponent))
+
+        if ( possibility > random_number ):
+            return True,possibility
+
+        return False,possibility
@@ -0,0 +1,177 @@
+from MCobjects.Metropolis.main import Metropolis
+from utilitys.poolUtilitys import PoolFunctions
+
+from prettytable import PrettyTable
+import numpy as np
+import shutil
+import json
+import os
+
+
+def _run_chain(task:dict) -> dict:
+    '''
+    在工作进程中运行一条独立的内存模式 Metropolis 链, 随机数全部来自 task["seed"]
+    '''
+    metropolis_mc = Metropolis(pbs_nodefile=None, np=None, dxec=None)
+    step_object = metropolis_mc.run(poscar_path=task["poscar_path"],
+                                    in_memory=True,
+                                    seed=task["seed"],
+                                    **task["run_kwargs"])
+    return {"vasp_folders_path": step_object.vasp_folders_path,
+            "energy": float(step_object.energy),
+            "total_steps": step_object.total_steps,
+            "exchange_steps": step_object.exchange_steps}
+
+
+class MultiChain(object):
+    '''
+    Description
+    -----------
+        1. 由同一个初始 POSCAR 出发, 在进程池中运行 num_chains 条独立的内存模式(chgnet/mattersim) Metropolis 链
+        2. 第 k 条链写入独立的目录 chain_k (0,1,2... 文件夹, steps.log, mc_record.txt)
+        3. 各链的种子由 numpy.random.SeedSequence(seed).spawn 产生, 互相独立且可复现
+        4. aggregate 合并各链的能量轨迹, 给出链间平均值与误差
+
+    Attributes
+    ----------
+        1. self.num_workers: int
+            进程池大小, None 时等于链数
+        2. self.num_threads: int
+            每个工作进程的 torch 线程数, None 时不做限制
+        3. self.mp_context: str
+            multiprocessing 启动方式 ('fork'/'spawn'/'forkserver'), None 时使用平台默认
+    '''
+    def __init__(self, num_workers:int=None, num_threads:int=None, mp_context:str=None):
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.mp_context = mp_context
+
+    def run(self, poscar_path:str, num_loops:int, T:float, num_chains:int,
+            sublattice_symbols_lst:list, load_path=None, load_model:str=None,
+            from_contcar=True,
+            elements_str_for_vaspkit:str=None,
+            load=False,
+            *,
+            seed:int=None,
+            burn_in:int=0,
+            **kwargs):
+        '''
+        Description
+        -----------
+            1. poscar_path 所在的步数文件夹(如 MC_file/0)被复制为每条链的初始文件夹 MC_file/chain_k/0
+            2. kwargs 直接传给 Metropolis.run (vac_dope, open_diffusion, exchange_times, num_trials ...)
+            3. 各链的种子记录在 MC_file/chains.json
+
+        Return
+        ------
+            1. summary: dict
+                见 `MultiChain.aggregate`
+        '''
+        assert (elements_str_for_vaspkit is not None)
+        assert (load_model in ('chgnet', 'mattersim'))
+
+        vasp_folder_path = os.path.dirname(poscar_path)
+        vasp_folders_path = os.path.dirname(vasp_folder_path)
+        poscar_name = os.path.basename(poscar_path)
+        folder_name = os.path.basename(vasp_folder_path)
+
+        seed_sequence = np.random.SeedSequence(seed)
+        chain_seeds = seed_sequence.spawn(num_chains)
+        with open(os.path.join(vasp_folders_path, 'chains.json'), 'w') as f:
+            json.dump({"entropy": str(seed_sequence.entropy),
+                       "chains": [{"path": f'chain_{k}', "spawn_key": list(chain_seed.spawn_key)}
+                                  for k, chain_seed in enumerate(chain_seeds)]}, f)
+
+        run_kwargs = dict(num_loops=num_loops, T=T,
+                          sublattice_symbols_lst=sublattice_symbols_lst,
+                          load_path=load_path, load_model=load_model,
+                          from_contcar=from_contcar,
+                          elements_str_for_vaspkit=elements_str_for_vaspkit,
+                          load=load,
+                          **kwargs)
+
+        tasks = []
+        for k, chain_seed in enumerate(chain_seeds):
+            chain_folder_path = os.path.join(vasp_folders_path, f'chain_{k}', folder_name)
+            if not os.path.exists(chain_folder_path):
+                shutil.copytree(vasp_folder_path, chain_folder_path)
+            tasks.append({"poscar_path": os.path.join(chain_folder_path, poscar_name),
+                          "seed": chain_seed,
+                          "run_kwargs": run_kwargs})
+
+        print(f'执行{num_chains}条独立搜索','\n')
+        num_workers = self.num_workers or num_chains
+        with PoolFunctions.get_executor(num_workers, self.num_threads, self.mp_context) as executor:
+            results = list(executor.map(_run_chain, tasks))
+
+        return self.aggregate([result["vasp_folders_path"] for result in results],
+                              burn_in=burn_in,
+                              output_path=os.path.join(vasp_folders_path, 'energy_traces.txt'))
+
+    @staticmethod
+    def read_trace(vasp_folders_path:str) -> np.ndarray:
+        '''
+        由 mc_record.txt 得到每一步之后的当前能量 (接受取 E_2, 拒绝保持 E_1)
+        '''
+        trace = []
+        with open(os.path.join(vasp_folders_path, 'mc_record.txt'), 'r') as f:
+            for line in f:
+                columns = line.rstrip('\n').split('\t')
+                if len(columns) < 5:
+                    continue
+                E_1, E_2, accepted = float(columns[1]), float(columns[2]), int(columns[4])
+                trace.append(E_2 if accepted else E_1)
+        return np.array(trace, dtype=float)
+
+    @classmethod
+    def aggregate(cls, vasp_folders_path_lst:list, burn_in:int=0, output_path:str=None) -> dict:
+        '''
+        Description
+        -----------
+            1. 合并各链的能量轨迹 (截断到最短的一条)
+            2. 逐步给出链间平均值与标准误差, 写入 output_path (step, mean, stderr, 各链能量)
+            3. 丢弃前 burn_in 步后, 以各链平均能量的离散程度估计总平均能量的误差
+
+        Return
+        ------
+            1. summary: dict
+                steps, traces (num_chains x steps), mean, stderr,
+                chain_means, energy_mean, energy_stderr
+        '''
+        traces = [cls.read_trace(vasp_folders_path) for vasp_folders_path in vasp_folders_path_lst]
+        num_steps = min(len(trace) for trace in traces)
+        traces = np.array([trace[:num_steps] for trace in traces])
+        num_chains = len(traces)
+
+        steps = np.arange(1, num_steps + 1)
+        mean = traces.mean(axis=0)
+        if num_chains > 1:
+            stderr = traces.std(axis=0, ddof=1) / np.sqrt(num_chains)
+        else:
+            stderr = np.zeros(num_steps)
+
+        sampled = traces[:, burn_in:]
+        chain_means = sampled.mean(axis=1) if sampled.shape[1] else np.full(num_chains, np.nan)
+        energy_mean = float(chain_means.mean())
+        energy_stderr = float(chain_means.std(ddof=1) / np.sqrt(num_chains)) if num_chains > 1 else float('nan')
+
+        if output_path is not None:
+            header = 'step\tmean\tstderr\t' + '\t'.join(f'chain_{k}' for k in range(num_chains))
+            np.savetxt(output_path, np.column_stack([steps, mean, stderr, traces.T]),
+                       fmt=['%d', '%.6f', '%.6f'] + ['%.6f'] * num_chains,
+                       delimiter='\t', header=header, comments='')
+
+        table = PrettyTable(["Chain", "Path", "Steps", "Final_energy", "Mean_energy"])
+        for k, vasp_folders_path in enumerate(vasp_folders_path_lst):
+            final_energy = traces[k, -1] if num_steps else float('nan')
+            table.add_row([k, vasp_folders_path, num_steps, final_energy, chain_means[k]])
+        print(table)
+        print(f'<E> = {energy_mean:.6f} ± {energy_stderr:.6f} eV (burn_in={burn_in}, chains={num_chains})')
+
+        return {"steps": steps,
+                "traces": traces,
+                "mean": mean,
+                "stderr": stderr,
+                "chain_means": chain_means,
+                "energy_mean": energy_mean,
+                "energy_stderr": energy_stderr}
@@ -0,0 +1,312 @@
+from MCobjects.Metropolis.strategy import Exchange
+from MCobjects.Metropolis.main import Metropolis
+from cores.memoryStepObject import MemoryStepObject
+from cores.energyCache import EnergyCache
+from model.energyBackend import EnergyBackend
+from model.modelRegistry import ModelRegistry
+from utilitys.poolUtilitys import PoolFunctions
+
+from prettytable import PrettyTable
+from contextlib import ExitStack
+import numpy as np
+import shutil
+import math
+import os
+
+
+# 工作进程中的副本: 搜索目录 -> {"step_object", "energy_cache"}, 在各轮之间保留
+_REPLICAS = {}
+
+
+def _run_replica(task:dict) -> dict:
+    '''
+    Description
+    -----------
+        1. 在工作进程中运行一个副本的 swap_interval 步 Metropolis
+        2. 副本固定在同一个工作进程中 (见 `PoolFunctions.get_pinned_executors`): 能量后端与 MemoryStepObject
+            在第一轮建立后保留在 _REPLICAS 中, 之后各轮直接继续; 上一轮交换了构型时以 `replace_structure` 写入
+        3. 返回副本的当前结构、能量以及接受步数, 供主进程尝试交换构型;
+            同时返回工作进程的模型加载统计 (见 `ModelRegistry.counts`), 由主进程汇总报告
+    '''
+    replica = _REPLICAS.get(task["vasp_folders_path"])
+    if replica is None:
+        rng = np.random.default_rng(task["seed"])
+        energy_backend = EnergyBackend.from_name(task["load_model"], load_path=task["load_path"],
+                                                 **task["backend_kwargs"])
+        energy_backend.preload()
+        energy_cache = EnergyCache(**task["energy_cache"]) if task["energy_cache"] else None
+        step_object = MemoryStepObject.from_folder(poscar_path=task["poscar_path"],
+                                                   energy_backend=energy_backend,
+                                                   rng=rng,
+                                                   energy_cache=energy_cache,
+                                                   **task["step_kwargs"])
+        if task["num_trials"] > 1:
+            #multiple-try 模式在固定几何下比较单点能
+            step_object.energy = float(step_object.predict_batch([step_object.structure])[0])
+        replica = _REPLICAS[task["vasp_folders_path"]] = {"step_object": step_object, "energy_cache": energy_cache}
+    step_object, energy_cache = replica["step_object"], replica["energy_cache"]
+    if task["swapped"]:
+        step_object.replace_structure(task["structure"], task["energy"], task["current_index"])
+
+    accepted = 0
+    for _ in range(task["num_steps"]):
+        accepted += int(Metropolis.memory_step(step_object, task["T"], num_trials=task["num_trials"],
+                                               time_save=task["time_save"]))
+    step_object.save_info()
+    step_object.record_file.flush()
+
+    cache_hits = cache_lookups = 0
+    if energy_cache is not None:
+        cache_hits = energy_cache.hits + energy_cache.matcher_hits
+        cache_lookups = cache_hits + energy_cache.misses
+
+    return {"structure": step_object.structure,
+            "energy": float(step_object.energy),
+            "current_index": step_object.current_index,
+            "accepted": accepted,
+            "cache_hits": cache_hits,
+            "cache_lookups": cache_lookups,
+            "pid": os.getpid(),
+            "model_counts": ModelRegistry.counts()}
+
+
+def _close_replica(vasp_folders_path:str):
+    '''
+    搜索结束时在副本所在的工作进程中关闭 MemoryStepObject 与能量缓存
+    '''
+    replica = _REPLICAS.pop(vasp_folders_path, None)
+    if replica is None:
+        return
+    replica["step_object"].close()
+    if replica["energy_cache"] is not None:
+        replica["energy_cache"].close()
+
+
+class ParallelTempering(object):
+    '''
+    Description
+    -----------
+        1. Replica exchange: 在温度梯度 T_lst 上同时运行 N 个内存模式(chgnet/mattersim)的 Metropolis 副本
+        2. 每 swap_interval 步, 相邻温度的副本按 Exchange.swap_mark 判据交换构型
+        3. 第 k 个副本固定在 T_lst[k], 拥有独立的目录 replica_k (0,1,2... 文件夹, steps.log, mc_record.txt)
+        4. 各副本固定在进程池的同一个工作进程中并行运行, 模型、能量后端与 MemoryStepObject 只建立一次,
+            各轮之间保留在内存中
+
+    Attributes
+    ----------
+        1. self.num_workers: int
+            进程池大小, None 时等于副本数
+        2. self.num_threads: int
+            每个工作进程的 torch 线程数, None 时不做限制
+        3. self.mp_context: str
+            multiprocessing 启动方式 ('fork'/'spawn'/'forkserver'), None 时使用平台默认
+    '''
+    def __init__(self, num_workers:int=None, num_threads:int=None, mp_context:str=None):
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.mp_context = mp_context
+
+    @staticmethod
+    def geometric_ladder(T_min:float, T_max:float, num_replicas:int) -> list:
+        '''
+        几何温度梯度: 相邻温度之比恒定, 使相邻副本的交换接受率大致相同
+        '''
+        if num_replicas == 1:
+            return [float(T_min)]
+        return [float(T) for T in np.geomspace(T_min, T_max, num_replicas)]
+
+    def run(self, poscar_path:str, num_loops:int, T_lst:list,
+            sublattice_symbols_lst:list, load_path=None, load_model:str=None,
+            from_contcar=True,
+            elements_str_for_vaspkit:str=None,
+            *,
+            swap_interval:int=10,
+            vac_dope = False,
+            vac_as = 'V',
+            open_diffusion = False,
+            diffusion_specie:str=None,
+            time_save:bool=True,
+            exchange_times:int=1,
+            save_every:int=None,
+            num_trials:int=1,
+            seed:int=None,
+            energy_cache:bool=False,
+            cache_matcher:bool=False,
+            relax_mode:str='full',
+            local_radius:float=6.0,
+            relax_policy:str='converge',
+            relax_steps:int=50,
+            max_relax_steps:int=500):
+        '''
+        Description
+        -----------
+            1. poscar_path 所在的步数文件夹(如 MC_file/0)被复制为每个副本的初始文件夹 MC_file/replica_k/0
+            2. 每个副本共执行 num_loops 步, 每 swap_interval 步尝试一轮交换
+                (偶数轮交换 (0,1),(2,3)..., 奇数轮交换 (1,2),(3,4)...)
+            3. 交换记录写入 MC_file/replica_exchange.txt
+            4. energy_cache=True 时各副本共享 MC_file/energy_cache.sqlite
+            5. relax_mode / local_radius / relax_policy / relax_steps / max_relax_steps 同 Metropolis.run
+
+        Return
+        ------
+            1. replicas: list[dict]
+                各温度下副本的最终结构、能量与统计
+        '''
+        assert (elements_str_for_vaspkit is not None)
+        assert (load_model in ('chgnet', 'mattersim'))
+        T_lst = sorted(float(T) for T in T_lst)
+        num_replicas = len(T_lst)
+
+        vasp_folder_path = os.path.dirname(poscar_path)
+        vasp_folders_path = os.path.dirname(vasp_folder_path)
+        poscar_name = os.path.basename(poscar_path)
+        folder_name = os.path.basename(vasp_folder_path)
+
+        print('一、初始化(建立副本目录)','\n')
+        replicas = []
+        for k, T in enumerate(T_lst):
+            replica_path = os.path.join(vasp_folders_path, f'replica_{k}')
+            replica_folder_path = os.path.join(replica_path, folder_name)
+            if not os.path.exists(replica_folder_path):
+                shutil.copytree(vasp_folder_path, replica_folder_path)
+            replicas.append({"T": T,
+                             "vasp_folders_path": replica_path,
+                             "poscar_path": os.path.join(replica_folder_path, poscar_name),
+                             "structure": None,
+                             "energy": None,
+                             "current_index": None,
+                             "accepted": 0,
+                             "steps": 0,
+                             "swapped": False,
+                             "cache_hits": 0,
+                             "cache_lookups": 0})
+
+        step_kwargs = dict(sublattice_symbols_lst=sublattice_symbols_lst,
+                           elements_str_for_vaspkit=elements_str_for_vaspkit,
+                           from_contcar=from_contcar,
+                           vac_dope=vac_dope, vac_as=vac_as,
+                           open_diffusion=open_diffusion,
+                           diffusion_specie=diffusion_specie,
+                           exchange_times=exchange_times,
+                           save_every=save_every)
+        backend_kwargs = dict(relax_mode=relax_mode, local_radius=local_radius,
+                              relax_policy=relax_policy, relax_steps=relax_steps,
+                              max_relax_steps=max_relax_steps)
+
+        cache_kwargs = None
+        if energy_cache:
+            #先由主进程写入参考位点, 各工作进程共享同一个缓存文件
+            cache = Metropolis.open_energy_cache(poscar_path, load_model, load_path,
+                                                 vac_dope=vac_dope, vac_as=vac_as, use_matcher=cache_matcher,
+                                                 relax_mode=relax_mode, relax_policy=relax_policy,
+                                                 relax_steps=relax_steps)
+            cache_kwargs = dict(db_path=cache.db_path, namespace=cache.namespace,
+                                use_matcher=cache_matcher, vac_as=vac_as)
+            cache.close()
+
+        swap_attempts = np.zeros(max(num_replicas - 1, 0), dtype=int)
+        swap_accepts = np.zeros(max(num_replicas - 1, 0), dtype=int)
+        seed_generator = np.random.default_rng(seed)
+        swap_record_path = os.path.join(vasp_folders_path, 'replica_exchange.txt')
+
+        num_workers = self.num_workers or num_replicas
+        #各副本的随机数生成器在其工作进程中只建立一次
+        seeds = seed_generator.integers(2**31 - 1, size=num_replicas)
+
+        print('二、执行副本交换搜索','\n')
+        num_rounds = math.ceil(num_loops / swap_interval)
+        #工作进程 pid -> 该进程的模型加载统计 (累计值)
+        model_counts = {}
+        with ExitStack() as stack:
+            executors = [stack.enter_context(executor) for executor in
+                         PoolFunctions.get_pinned_executors(num_workers, self.num_threads, self.mp_context)]
+            swap_record = stack.enter_context(open(swap_record_path, 'a'))
+            for round_index in range(num_rounds):
+                num_steps = min(swap_interval, num_loops - round_index * swap_interval)
+
+                futures = []
+                for k, (replica, replica_seed) in enumerate(zip(replicas, seeds)):
+                    #只有交换了构型的副本需要传入结构
+                    task = {"T": replica["T"],
+                            "vasp_folders_path": replica["vasp_folders_path"],
+                            "poscar_path": replica["poscar_path"],
+                            "swapped": replica["swapped"],
+                            "structure": replica["structure"] if replica["swapped"] else None,
+                            "energy": replica["energy"],
+                            "current_index": replica["current_index"],
+                            "load_model": load_model,
+                            "load_path": load_path,
+                            "backend_kwargs": backend_kwargs,
+                            "num_steps": num_steps,
+                            "num_trials": num_trials,
+                            "time_save": time_save,
+                            "seed": int(replica_seed),
+                            "energy_cache": cache_kwargs,
+                            "step_kwargs": step_kwargs}
+                    futures.append(executors[k % num_workers].submit(_run_replica, task))
+
+                for replica, future in zip(replicas, futures):
+                    result = future.result()
+                    replica["structure"] = result["structure"]
+                    replica["energy"] = result["energy"]
+                    replica["current_index"] = result["current_index"]
+                    replica["swapped"] = False
+                    replica["accepted"] += result["accepted"]
+                    replica["steps"] += num_steps
+                    #能量缓存在工作进程中保留, 统计为累计值
+                    replica["cache_hits"] = result["cache_hits"]
+                    replica["cache_lookups"] = result["cache_lookups"]
+                    model_counts[result["pid"]] = result["model_counts"]
+
+                self._attempt_swaps(replicas, round_index, swap_attempts, swap_accepts, swap_record,
+                                    rng=seed_generator)
+                swap_record.flush()
+                print(f'完成第{round_index+1}轮, 共{num_rounds}轮: ' +
+                      ' '.join(f'{replica["T"]:.1f}K:{replica["energy"]:.4f}' for replica in replicas))
+
+            for future in [executors[k % num_workers].submit(_close_replica, replica["vasp_folders_path"])
+                           for k, replica in enumerate(replicas)]:
+                future.result()
+
+        self.report(replicas, swap_attempts, swap_accepts)
+        ModelRegistry.report(ModelRegistry.merge_counts(model_counts.values()))
+        return replicas
+
+    @staticmethod
+    def _attempt_swaps(replicas:list, round_index:int, swap_attempts:np.ndarray,
+                       swap_accepts:np.ndarray, swap_record, rng:np.random.Generator=None):
+        '''
+        交换相邻温度的构型; 交换后的构型不在本副本的目录中, current_index 置为 None,
+        swapped 置为 True (下一轮由工作进程写入副本的 MemoryStepObject)
+        '''
+        for i in range(round_index % 2, len(replicas) - 1, 2):
+            replica_i, replica_j = replicas[i], replicas[i + 1]
+            swap_mark,possibility = Exchange.swap_mark(E_i=replica_i["energy"], E_j=replica_j["energy"],
+                                                       T_i=replica_i["T"], T_j=replica_j["T"], rng=rng)
+            swap_attempts[i] += 1
+            swap_record.write("{0}\t{1}\t{2}\t{3:.2f}\t{4:.2f}\t{5:.6f}\t{6:.6f}\t{7:.6f}\t{8}\n".format(
+                round_index, i, i + 1, replica_i["T"], replica_j["T"],
+                replica_i["energy"], replica_j["energy"], possibility, int(swap_mark)))
+            if swap_mark:
+                swap_accepts[i] += 1
+                for key in ("structure", "energy"):
+                    replica_i[key], replica_j[key] = replica_j[key], replica_i[key]
+                replica_i["current_index"] = replica_j["current_index"] = None
+                replica_i["swapped"] = replica_j["swapped"] = True
+
+    @staticmethod
+    def report(replicas:list, swap_attempts:np.ndarray, swap_accepts:np.ndarray):
+        table = PrettyTable(["Replica", "T", "Energy", "Accept_rate", "Swap_rate(k,k+1)", "Cache_hit_rate"])
+        for k, replica in enumerate(replicas):
+            accept_rate = replica["accepted"] / replica["steps"] if replica["steps"] else 0.0
+            if k < len(swap_attempts) and swap_attempts[k]:
+                swap_rate = f'{swap_accepts[k] / swap_attempts[k]:.3f}'
+            else:
+                swap_rate = '-'
+            if replica["cache_lookups"]:
+                cache_hit_rate = f'{replica["cache_hits"] / replica["cache_lookups"]:.3f}'
+            else:
+                cache_hit_rate = '-'
+            table.add_row([k, replica["T"], replica["energy"], f'{accept_rate:.3f}', swap_rate, cache_hit_rate])
+        print(table)
+        return table
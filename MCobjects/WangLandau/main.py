@@ -0,0 +1,382 @@
+from MCobjects.Metropolis.strategy import Exchange
+from MCobjects.Metropolis.main import Metropolis
+from cores.memoryStepObject import MemoryStepObject
+from cores.densityOfStates import DensityOfStates
+from cores.energyCache import EnergyCache
+from model.energyBackend import EnergyBackend
+from model.modelRegistry import ModelRegistry
+from utilitys.poolUtilitys import PoolFunctions
+
+from prettytable import PrettyTable
+import numpy as np
+import shutil
+import time
+import os
+
+
+def _run_window(task:dict) -> dict:
+    '''
+    Description
+    -----------
+        1. 在工作进程中运行一个能量窗口的 num_steps 步 Wang–Landau
+        2. 模型由 ModelRegistry 在每个工作进程中只加载一次
+        3. 返回窗口的当前结构、能量、直方图状态以及接受步数, 供主进程尝试交换构型并检查平坦度;
+            同时返回工作进程的模型加载统计 (见 `ModelRegistry.counts`), 由主进程汇总报告
+    '''
+    rng = np.random.default_rng(task["seed"])
+
+    energy_backend = EnergyBackend.from_name(task["load_model"], load_path=task["load_path"],
+                                             relax_policy=task["relax_policy"], relax_steps=task["relax_steps"],
+                                             max_relax_steps=task["max_relax_steps"])
+    energy_backend.preload()
+
+    energy_cache = EnergyCache(**task["energy_cache"]) if task["energy_cache"] else None
+    step_kwargs = dict(task["step_kwargs"], energy_cache=energy_cache)
+    if task["structure"] is None:
+        step_object = MemoryStepObject.from_folder(poscar_path=task["poscar_path"],
+                                                   energy_backend=energy_backend,
+                                                   rng=rng,
+                                                   **step_kwargs)
+    else:
+        step_object = MemoryStepObject(vasp_folders_path=task["vasp_folders_path"],
+                                       structure=task["structure"],
+                                       energy_backend=energy_backend,
+                                       energy=task["energy"],
+                                       current_index=task["current_index"],
+                                       load=True,
+                                       rng=rng,
+                                       **step_kwargs)
+
+    dos = DensityOfStates.from_state(task["dos"])
+    accepted = 0
+    for _ in range(task["num_steps"]):
+        accepted += int(WangLandau.wang_landau_step(step_object, dos, time_save=task["time_save"]))
+    step_object.close()
+
+    cache_hits = cache_lookups = 0
+    if energy_cache is not None:
+        cache_hits = energy_cache.hits + energy_cache.matcher_hits
+        cache_lookups = cache_hits + energy_cache.misses
+        energy_cache.close()
+
+    return {"structure": step_object.structure,
+            "energy": float(step_object.energy),
+            "current_index": step_object.current_index,
+            "dos": dos.state(),
+            "accepted": accepted,
+            "cache_hits": cache_hits,
+            "cache_lookups": cache_lookups,
+            "pid": os.getpid(),
+            "model_counts": ModelRegistry.counts()}
+
+
+class WangLandau(object):
+    '''
+    Description
+    -----------
+        1. Wang–Landau 采样 (仅 chgnet/mattersim): 交换原子与能量计算沿用内存模式的 MemoryStepObject,
+            以 min(1, g(E_1)/g(E_2)) 接受交换 (Exchange.wang_landau_mark), 每步更新当前能量所在箱的
+            ln g 与直方图 (cores.densityOfStates.DensityOfStates), 直方图平坦时按 schedule 减小修正因子
+        2. num_windows > 1 时为 replica-exchange Wang–Landau (REWL): [E_min, E_max) 分为相互重叠的能量窗口,
+            每个窗口一个 walker, 各窗口在进程池中并行运行, 每 exchange_interval 步相邻窗口按
+            Exchange.window_swap_mark 交换构型, 结束后拼接为整个能量区间的 g(E)
+        3. 第 k 个窗口拥有独立的目录 window_k (0 文件夹, steps.log, mc_record.txt, dos.npz);
+            初始结构不在窗口内时, 只接受更接近窗口的交换, 进入窗口后才开始更新直方图
+        4. 由 g(E) 可计算任意温度下的热力学量 (见 `DensityOfStates.thermodynamics`), 代替多个固定温度的搜索
+
+    Attributes
+    ----------
+        1. self.num_workers: int
+            进程池大小, None 时等于窗口数
+        2. self.num_threads: int
+            每个工作进程的 torch 线程数, None 时不做限制
+        3. self.mp_context: str
+            multiprocessing 启动方式 ('fork'/'spawn'/'forkserver'), None 时使用平台默认
+    '''
+    def __init__(self, num_workers:int=None, num_threads:int=None, mp_context:str=None):
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.mp_context = mp_context
+
+    def run(self, poscar_path:str, E_min:float, E_max:float, bin_width:float,
+            sublattice_symbols_lst:list, load_path=None, load_model:str=None,
+            from_contcar=True,
+            elements_str_for_vaspkit:str=None,
+            *,
+            num_windows:int=1,
+            overlap:float=0.75,
+            exchange_interval:int=100,
+            max_steps:int=None,
+            flatness:float=0.8,
+            min_visits:int=10,
+            ln_f:float=1.0,
+            ln_f_final:float=1e-6,
+            schedule:str='halve',
+            T_lst:list=None,
+            vac_dope = False,
+            vac_as = 'V',
+            open_diffusion = False,
+            diffusion_specie:str=None,
+            time_save:bool=True,
+            exchange_times:int=1,
+            seed:int=None,
+            energy_cache:bool=False,
+            cache_matcher:bool=False,
+            relax_policy:str='none',
+            relax_steps:int=50,
+            max_relax_steps:int=500):
+        '''
+        Description
+        -----------
+            1. poscar_path 所在的步数文件夹(如 MC_file/0)被复制为每个窗口的初始文件夹 MC_file/window_k/0
+            2. 每轮各窗口执行 exchange_interval 步, 之后尝试相邻窗口交换构型 (偶数轮交换 (0,1),(2,3)...,
+                奇数轮交换 (1,2),(3,4)...), 并检查各窗口的直方图平坦度 (min(H)/mean(H) >= flatness,
+                且每个已访问的箱至少访问 min_visits 次)
+            3. 所有窗口的 ln_f 均不大于 ln_f_final, 或每个窗口都已执行 max_steps 步时结束
+            4. 每轮写出 MC_file/wang_landau.txt (各窗口的 ln_f、平坦度) 与 window_k/dos.npz;
+                窗口交换记录写入 MC_file/window_exchange.txt; 结束时拼接的 g(E) 写入 MC_file/dos.npz 与 dos.txt,
+                T_lst 不为 None 时热力学量写入 MC_file/thermodynamics.txt;
+                相邻窗口访问过的箱不相连时 (如 max_steps 先到达), 各组相连的窗口分别拼接为 dos_g.npz 与 dos_g.txt,
+                不计算热力学量
+            5. relax_policy 默认为 'none' (交换后晶格的单点能): 能量须是构型的确定函数, 弛豫时建议同时打开 energy_cache
+
+        Return
+        ------
+            1. result: dict
+                dos: 拼接后的 DensityOfStates (窗口不相连时为 None); groups: 各组相连窗口拼接后的 DensityOfStates;
+                windows: 各窗口的 DensityOfStates; walkers: 各窗口的最终结构、能量与统计;
+                thermodynamics: T_lst 下的热力学量 (T_lst 为 None 时为 None)
+        '''
+        assert (elements_str_for_vaspkit is not None)
+        assert (load_model in ('chgnet', 'mattersim'))
+
+        vasp_folder_path = os.path.dirname(poscar_path)
+        vasp_folders_path = os.path.dirname(vasp_folder_path)
+        poscar_name = os.path.basename(poscar_path)
+        folder_name = os.path.basename(vasp_folder_path)
+
+        print('一、初始化(建立能量窗口)','\n')
+        windows = DensityOfStates.windows(E_min, E_max, bin_width, num_windows=num_windows, overlap=overlap,
+                                          ln_f=ln_f, schedule=schedule)
+        walkers = []
+        for k, window in enumerate(windows):
+            window_path = os.path.join(vasp_folders_path, f'window_{k}')
+            window_folder_path = os.path.join(window_path, folder_name)
+            if not os.path.exists(window_folder_path):
+                shutil.copytree(vasp_folder_path, window_folder_path)
+            walkers.append({"vasp_folders_path": window_path,
+                            "poscar_path": os.path.join(window_folder_path, poscar_name),
+                            "structure": None,
+                            "energy": None,
+                            "current_index": None,
+                            "accepted": 0,
+                            "steps": 0,
+                            "cache_hits": 0,
+                            "cache_lookups": 0})
+
+        step_kwargs = dict(sublattice_symbols_lst=sublattice_symbols_lst,
+                           elements_str_for_vaspkit=elements_str_for_vaspkit,
+                           from_contcar=from_contcar,
+                           vac_dope=vac_dope, vac_as=vac_as,
+                           open_diffusion=open_diffusion,
+                           diffusion_specie=diffusion_specie,
+                           exchange_times=exchange_times,
+                           save_accepted=False)
+
+        cache_kwargs = None
+        if energy_cache:
+            #先由主进程写入参考位点, 各工作进程共享同一个缓存文件
+            cache = Metropolis.open_energy_cache(poscar_path, load_model, load_path,
+                                                 vac_dope=vac_dope, vac_as=vac_as, use_matcher=cache_matcher,
+                                                 relax_policy=relax_policy, relax_steps=relax_steps)
+            cache_kwargs = dict(db_path=cache.db_path, namespace=cache.namespace,
+                                use_matcher=cache_matcher, vac_as=vac_as)
+            cache.close()
+
+        swap_attempts = np.zeros(max(num_windows - 1, 0), dtype=int)
+        swap_accepts = np.zeros(max(num_windows - 1, 0), dtype=int)
+        seed_generator = np.random.default_rng(seed)
+        record_path = os.path.join(vasp_folders_path, 'wang_landau.txt')
+        swap_record_path = os.path.join(vasp_folders_path, 'window_exchange.txt')
+
+        num_workers = self.num_workers or num_windows
+
+        print('二、执行 Wang–Landau 采样','\n')
+        round_index = 0
+        #工作进程 pid -> 该进程的模型加载统计 (累计值)
+        model_counts = {}
+        with PoolFunctions.get_executor(num_workers, self.num_threads, self.mp_context) as executor, \
+                open(record_path, 'a') as record, open(swap_record_path, 'a') as swap_record:
+            while not self.finished(windows, walkers, ln_f_final, max_steps):
+                num_steps = exchange_interval if max_steps is None else \
+                    min(exchange_interval, max_steps - walkers[0]["steps"])
+                seeds = seed_generator.integers(2**31 - 1, size=num_windows)
+
+                tasks = []
+                for walker, window, walker_seed in zip(walkers, windows, seeds):
+                    tasks.append({"vasp_folders_path": walker["vasp_folders_path"],
+                                  "poscar_path": walker["poscar_path"],
+                                  "structure": walker["structure"],
+                                  "energy": walker["energy"],
+                                  "current_index": walker["current_index"],
+                                  "dos": window.state(),
+                                  "load_model": load_model,
+                                  "load_path": load_path,
+                                  "relax_policy": relax_policy,
+                                  "relax_steps": relax_steps,
+                                  "max_relax_steps": max_relax_steps,
+                                  "num_steps": num_steps,
+                                  "time_save": time_save,
+                                  "seed": int(walker_seed),
+                                  "energy_cache": cache_kwargs,
+                                  "step_kwargs": step_kwargs})
+
+                for k, (walker, result) in enumerate(zip(walkers, executor.map(_run_window, tasks))):
+                    windows[k] = DensityOfStates.from_state(result["dos"])
+                    walker["structure"] = result["structure"]
+                    walker["energy"] = result["energy"]
+                    walker["current_index"] = result["current_index"]
+                    walker["accepted"] += result["accepted"]
+                    walker["steps"] += num_steps
+                    walker["cache_hits"] += result["cache_hits"]
+                    walker["cache_lookups"] += result["cache_lookups"]
+                    model_counts[result["pid"]] = result["model_counts"]
+
+                self._attempt_swaps(windows, walkers, round_index, swap_attempts, swap_accepts, swap_record,
+                                    rng=seed_generator)
+                for k, (walker, window) in enumerate(zip(walkers, windows)):
+                    flat = window.flatness()
+                    window.advance(flatness, min_visits)
+                    record.write("{0}\t{1}\t{2:.6f}\t{3:.6e}\t{4}\t{5:.4f}\t{6}\t{7}\n".format(
+                        round_index, k, walker["energy"], window.ln_f, window.iteration, flat,
+                        int(window.visited.sum()), window.steps))
+                    window.save(os.path.join(walker["vasp_folders_path"], 'dos.npz'))
+                record.flush()
+                swap_record.flush()
+                print(f'完成第{round_index+1}轮: ' +
+                      ' '.join(f'{window.E_min:.2f}~{window.E_max:.2f}eV:ln_f={window.ln_f:.2e}'
+                               for window in windows))
+                round_index += 1
+
+        self.report(windows, walkers, swap_attempts, swap_accepts)
+        ModelRegistry.report(ModelRegistry.merge_counts(model_counts.values()))
+
+        #各窗口的 ln g 已写入 window_k/dos.npz; 窗口不相连时分别保存各组的拼接结果
+        groups = DensityOfStates.merge_groups(windows)
+        dos, thermodynamics = None, None
+        if len(groups) == 1:
+            dos = groups[0]
+            dos.save(os.path.join(vasp_folders_path, 'dos.npz'))
+            self.write_dos(os.path.join(vasp_folders_path, 'dos.txt'), dos)
+            if T_lst is not None:
+                thermodynamics = dos.thermodynamics(T_lst)
+                self.write_thermodynamics(os.path.join(vasp_folders_path, 'thermodynamics.txt'), thermodynamics)
+        else:
+            print(f'warning: 相邻窗口没有共同访问过的箱, 无法拼接为整个能量区间的 g(E), '
+                  f'分为{len(groups)}组分别保存 (dos_g.npz / dos_g.txt), 不计算热力学量')
+            for g, group in enumerate(groups):
+                print(f'  第{g}组: {group.E_min:.3f}~{group.E_max:.3f}eV')
+                group.save(os.path.join(vasp_folders_path, f'dos_{g}.npz'))
+                self.write_dos(os.path.join(vasp_folders_path, f'dos_{g}.txt'), group)
+        return {"dos": dos, "groups": groups, "windows": windows, "walkers": walkers,
+                "thermodynamics": thermodynamics}
+
+    @staticmethod
+    def finished(windows:list, walkers:list, ln_f_final:float, max_steps:int=None) -> bool:
+        if all(window.converged(ln_f_final) for window in windows):
+            return True
+        return (max_steps is not None) and (walkers[0]["steps"] >= max_steps)
+
+    @staticmethod
+    def wang_landau_step(step_object:MemoryStepObject, dos:DensityOfStates, time_save:bool=True) -> bool:
+        '''
+        Description
+        -----------
+            1. 原位交换原子并计算能量; 两个能量都在窗口内时以 Exchange.wang_landau_mark 判据接受,
+                试探能量在窗口外时拒绝; 当前能量在窗口外时只接受更接近窗口的交换
+            2. 当前能量在窗口内时, 更新其所在箱的 ln g 与直方图 (拒绝时为原结构的箱)
+        '''
+        start_time = time.time()
+        E_1 = step_object.energy
+        trial_structure = step_object.propose()
+        E_2, relaxed_structure = step_object.evaluate(trial_structure, local_centers=step_object.local_centers())
+        execution_time = time.time() - start_time if time_save else None
+
+        if not dos.contains(E_1):
+            exchange_mark = dos.distance(E_2) <= dos.distance(E_1)
+            possibility = float(exchange_mark)
+        elif not dos.contains(E_2):
+            exchange_mark,possibility = False,0.0
+        else:
+            exchange_mark,possibility = Exchange.wang_landau_mark(dos.ln_g_at(E_1), dos.ln_g_at(E_2),
+                                                                  rng=step_object.rng)
+
+        if exchange_mark:
+            step_object.walk(E_2, relaxed_structure, possibility, execution_time)
+        else:
+            step_object.walk_anew(E_2, relaxed_structure, possibility, execution_time)
+        if dos.contains(step_object.energy):
+            dos.update(step_object.energy)
+        return exchange_mark
+
+    @staticmethod
+    def _attempt_swaps(windows:list, walkers:list, round_index:int, swap_attempts:np.ndarray,
+                       swap_accepts:np.ndarray, swap_record, rng:np.random.Generator=None):
+        '''
+        交换相邻窗口的构型 (两个能量须同时在两个窗口内); 交换后的构型不在本窗口的目录中, current_index 置为 None
+        '''
+        for i in range(round_index % 2, len(walkers) - 1, 2):
+            walker_i, walker_j = walkers[i], walkers[i + 1]
+            window_i, window_j = windows[i], windows[i + 1]
+            E_x, E_y = walker_i["energy"], walker_j["energy"]
+            swap_attempts[i] += 1
+            if all(window.contains(E) for window in (window_i, window_j) for E in (E_x, E_y)):
+                swap_mark,possibility = Exchange.window_swap_mark(window_i.ln_g_at(E_x), window_i.ln_g_at(E_y),
+                                                                  window_j.ln_g_at(E_y), window_j.ln_g_at(E_x),
+                                                                  rng=rng)
+            else:
+                swap_mark,possibility = False,0.0
+            swap_record.write("{0}\t{1}\t{2}\t{3:.6f}\t{4:.6f}\t{5:.6f}\t{6}\n".format(
+                round_index, i, i + 1, E_x, E_y, possibility, int(swap_mark)))
+            if swap_mark:
+                swap_accepts[i] += 1
+                for key in ("structure", "energy"):
+                    walker_i[key], walker_j[key] = walker_j[key], walker_i[key]
+                walker_i["current_index"] = walker_j["current_index"] = None
+
+    @staticmethod
+    def write_dos(path:str, dos:DensityOfStates):
+        '''
+        已访问各箱的中心能量 (eV) 与 ln g(E)
+        '''
+        with open(path, 'w') as f:
+            f.write("# E(eV)\tln_g\n")
+            for energy, ln_g in zip(dos.centers[dos.visited], dos.ln_g[dos.visited]):
+                f.write("{0:.6f}\t{1:.6f}\n".format(energy, ln_g))
+
+    @staticmethod
+    def write_thermodynamics(path:str, thermodynamics:dict):
+        with open(path, 'w') as f:
+            f.write("# T(K)\tU(eV)\tC(eV/K)\tF(eV)\tS(eV/K)\n")
+            for row in zip(*(thermodynamics[key] for key in ("T", "U", "C", "F", "S"))):
+                f.write("{0:.2f}\t{1:.6f}\t{2:.6e}\t{3:.6f}\t{4:.6e}\n".format(*row))
+
+    @staticmethod
+    def report(windows:list, walkers:list, swap_attempts:np.ndarray, swap_accepts:np.ndarray):
+        table = PrettyTable(["Window", "E_range", "ln_f", "Iteration", "Visited", "Accept_rate",
+                             "Swap_rate(k,k+1)", "Cache_hit_rate"])
+        for k, (window, walker) in enumerate(zip(windows, walkers)):
+            accept_rate = walker["accepted"] / walker["steps"] if walker["steps"] else 0.0
+            if k < len(swap_attempts) and swap_attempts[k]:
+                swap_rate = f'{swap_accepts[k] / swap_attempts[k]:.3f}'
+            else:
+                swap_rate = '-'
+            if walker["cache_lookups"]:
+                cache_hit_rate = f'{walker["cache_hits"] / walker["cache_lookups"]:.3f}'
+            else:
+                cache_hit_rate = '-'
+            table.add_row([k, f'{window.E_min:.3f}~{window.E_max:.3f}', f'{window.ln_f:.3e}', window.iteration,
+                           f'{int(window.visited.sum())}/{window.num_bins}', f'{accept_rate:.3f}', swap_rate,
+                           cache_hit_rate])
+        print(table)
+        return table
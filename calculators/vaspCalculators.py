@@ -1,10 +1,14 @@
 import os
 import time
+import shlex
+import asyncio
 import logging
-from pymatgen.io.vasp.outputs import Oszicar
+import subprocess
 
 from utilitys.mpirunContext import PwdContext
 from logger.loggerForVaspTask import LoggerForVaspTask
+from calculators.vaspOutputReader import VaspOutputReader
+from utilitys.phaseTimer import PhaseTimer
 
 
 class VaspTask:
@@ -32,18 +36,22 @@ class VaspTask:
     '''
     TIME_INTERVAL = 30
     
-    def __init__(self, vasp_folder_path: str):
+    def __init__(self, vasp_folder_path: str, vasp_folders_path: str = None):
         '''
         Parameters
         ----------
              `vasp_folder_path`: str,
                 VASP计算文件夹路径
+             `vasp_folders_path`: str,
+                搜索总路径(INCAR 等取自其中的 0 文件夹), None 时为 vasp_folder_path 的上级目录
+                (预生成的试探结构位于 speculative/ 下, 需要显式给出)
         '''
 
         self.vasp_folder_path = vasp_folder_path
-        self.vasp_folders_path = os.path.dirname(self.vasp_folder_path)
+        self.vasp_folders_path = os.path.dirname(self.vasp_folder_path) if vasp_folders_path is None else vasp_folders_path
         self.pwd_path = os.getcwd()
         self.log_file_path = os.path.join(self.vasp_folder_path, "process.log")
+        self.output_reader = VaspOutputReader(self.vasp_folder_path)
 
         if not os.path.exists(self.vasp_folder_path):
             LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
@@ -54,6 +62,7 @@ class VaspTask:
             raise Exception("This structuew has been calculated!")
 
 
+    @PhaseTimer.timed("vasp_mpirun")
     def mpirun(self, pbs_nodefile: str, np: int, dxec: str):
         '''
         Description
@@ -82,23 +91,84 @@ class VaspTask:
                 
         with PwdContext(pwd_path=self.pwd_path, vasp_folder_path=self.vasp_folder_path) as _:
             os.system("mpirun -machinefile {0} -np {1} {2} > output".format(pbs_nodefile, np, dxec))
-        
+
+    async def mpirun_async(self, pbs_nodefile: str, np: int, dxec: str) -> int:
+        '''
+        Description
+        -----------
+            `self.mpirun` 的 asyncio 版本: 以 asyncio.create_subprocess_exec 启动
+            `mpirun -machinefile $PBS_NODEFILE -np $NP $DXEC > output`, 以进程退出判断计算结束
+
+        Note
+        ----
+            1. 以 cwd 指定计算文件夹, 不改变当前工作路径, 多个计算可以同时进行
+            2. 协程被取消时终止 mpirun (丢弃的预测性计算)
+            3. 计算期间每隔 TIME_INTERVAL 由 `self.output_reader` 增量读取 OSZICAR, 在 process.log 中记录进度
+
+        Return
+        ------
+            1. returncode: int
+        '''
+        LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
+                            msg="Calculating the energy of structure {0} on {1} ...".format(
+                            os.path.split(self.vasp_folder_path)[-1], pbs_nodefile),
+                            level=logging.INFO)
+
+        with open(os.path.join(self.vasp_folder_path, "output"), "w") as output, PhaseTimer.phase("vasp_mpirun"):
+            process = await asyncio.create_subprocess_exec("mpirun", "-machinefile", str(pbs_nodefile),
+                                                           "-np", str(np), *shlex.split(str(dxec)),
+                                                           cwd=self.vasp_folder_path,
+                                                           stdout=output)
+            wait_task = asyncio.ensure_future(process.wait())
+            try:
+                while True:
+                    done, _ = await asyncio.wait({wait_task}, timeout=self.TIME_INTERVAL)
+                    if done:
+                        returncode = wait_task.result()
+                        break
+                    self.log_progress()
+            except asyncio.CancelledError:
+                process.terminate()
+                await wait_task
+                raise
+
+        LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
+                            msg="mpirun of structure {0} exited with code {1} after {2} ionic steps".format(
+                            os.path.split(self.vasp_folder_path)[-1], returncode,
+                            self.output_reader.update().ionic_step),
+                            level=logging.INFO if returncode == 0 else logging.ERROR)
+        return returncode
+
+    def relocate(self, vasp_folder_path: str):
+        '''
+        计算文件夹被移动(预生成的试探结构被采用)后更新路径, 运行中的 mpirun 不受影响
+        '''
+        self.vasp_folder_path = vasp_folder_path
+        self.log_file_path = os.path.join(self.vasp_folder_path, "process.log")
+        self.output_reader.relocate(vasp_folder_path)
+
+    def log_progress(self):
+        '''
+        增量读取 OSZICAR, 在 process.log 中记录当前离子步与 dE
+        '''
+        LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
+                                     msg=self.output_reader.update().progress_message(),
+                                     level=logging.INFO)
 
     def generate_input_files(self, gen_poscar:bool=False,vac_dope=False):
         '''
         Note
         ----
             用于将初始VASP设置文件复制到后续目录
+            不改变当前工作路径, 可以在线程中与其他计算同时进行
         '''
-        with PwdContext(pwd_path=self.pwd_path, vasp_folder_path=self.vasp_folder_path) as manager:
-
-            if gen_poscar:
-                self._generate_poscar()
+        if gen_poscar:
+            self._generate_poscar()
 
-            self._generate_potcar()
+        self._generate_potcar()
 
-            for filename in ["KPOINTS", "INCAR", "OPTCELL"]:
-                self._copy_input_file(filename=filename)
+        for filename in ["KPOINTS", "INCAR", "OPTCELL"]:
+            self._copy_input_file(filename=filename)
     
     def _generate_poscar(self):
         '''
@@ -111,13 +181,14 @@ class VaspTask:
         os.system("cp -r {0} {1}".format(filename_0_path, filename_path))
         
         
+    @PhaseTimer.timed("vaspkit")
     def _generate_potcar(self):
         '''
         Note
         ----
             调用vaspkit生成POTCAR
         '''        
-        os.system("vaspkit -task 103")
+        subprocess.run("vaspkit -task 103", shell=True, cwd=self.vasp_folder_path)
 
     def _copy_input_file(self, filename):
         vasp_folder_0_path = os.path.join(self.vasp_folders_path, str(0))
@@ -126,63 +197,28 @@ class VaspTask:
         filename_path = os.path.join(self.vasp_folder_path, filename)
         os.system("cp -r {0} {1}".format(filename_0_path, filename_path))
     
-    def wait_until_task_ends(self):
-        time.sleep(self.TIME_INTERVAL)
-
-        final_energy = self._get_energy()
-
-        LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
-            msg="Energy of structure {0} = {1}, finding the next structure...".format( 
-                                                    os.path.split(self.vasp_folder_path)[-1], final_energy),
-            level=logging.INFO)
-
-        return final_energy
-    
     def _get_energy(self):
         oszicar_path = os.path.join(self.vasp_folder_path, "OSZICAR")
-        final_energy = float(Oszicar(oszicar_path).final_energy)
+        final_energy = VaspOutputReader.read_final_energy(oszicar_path)
         return final_energy
 
-    
     def wait_until_task_ends(self):
-        
-        outcar_path = os.path.join(self.vasp_folder_path, "OUTCAR")
-        completed_mark = False
-
-        # 间隔 log_time_multi 后。记录一次
-        with PwdContext(pwd_path=self.pwd_path, vasp_folder_path=self.vasp_folder_path):
-            # 判断是否已经生成 OUTCAR
-            while (True):
-                if (os.path.exists(outcar_path)):
-                    break
-                else:
-                    time.sleep(self.TIME_INTERVAL)
-
-            # 判断 VASP 计算是否完成 (OUTCAR中是否包含 `Total CPU time used (sec):` 字段)
-            while (True):
-                with open(outcar_path, "r") as f:
-                    if "Total CPU time used (sec):" in f.read():
-                        completed_mark = True
-                        break
-                    else:
-                        time.sleep(self.TIME_INTERVAL)
-
-                LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
-                                        #msg="Can't find `Total CPU time used (sec):` in OUTCAR",
-                                        msg="calculating...",
-                                        level=logging.INFO)
-            
+        '''
+        Description
+        -----------
+            1. 每隔 TIME_INTERVAL 增量读取 OUTCAR/OSZICAR (只读取新增的字节), 记录计算进度
+            2. OUTCAR 中出现 `Total CPU time used (sec):` 时计算完成, 返回最终能量
+        '''
+        while not self.output_reader.update().completed:
             time.sleep(self.TIME_INTERVAL)
+            self.log_progress()
 
-            if completed_mark:
-                """
-                可在 msg 处自定义日志输出
-                """
-                final_energy = self._get_energy()
+        final_energy = self._get_energy()
 
-                LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
-                    msg="Energy of structure {0} = {1}, finding the next structure...".format( 
-                                                            os.path.split(self.vasp_folder_path)[-1], final_energy),
-                    level=logging.INFO)
+        LoggerForVaspTask.log_output(log_file_path=self.log_file_path,
+            msg="Energy of structure {0} = {1} after {2} ionic steps, finding the next structure...".format(
+                                                    os.path.split(self.vasp_folder_path)[-1], final_energy,
+                                                    self.output_reader.ionic_step),
+            level=logging.INFO)
 
-        return final_energy
\ No newline at end of file
+        return final_energy
@@ -0,0 +1,73 @@
+import asyncio
+import contextlib
+
+from calculators.vaspCalculators import VaspTask
+
+
+class VaspJobManager(object):
+    '''
+    Description
+    -----------
+        1. asyncio 驱动的 VASP 作业管理: 以 `VaspTask.mpirun_async` 启动计算, 以进程退出判断计算结束
+        2. 每个 nodefile 为一个计算槽, 同一个槽同一时刻只运行一个 mpirun;
+            pbs_nodefile 为主计算槽, spare_nodefiles 为用于预测性计算的空闲节点
+        3. 输入文件(vaspkit POTCAR 等)在线程中生成, 与正在进行的计算重叠
+
+    Attributes
+    ----------
+        1. self.pbs_nodefile / self.np / self.dxec:
+            同 `VaspTask.mpirun`
+        2. self.spare_nodefiles: list
+            额外的节点文件, 为空时不做预测性计算
+        3. self.vac_dope: bool
+            是否属于空位掺杂结构
+    '''
+    def __init__(self, pbs_nodefile:str, np:int, dxec:str, spare_nodefiles:list=None, vac_dope:bool=False):
+        self.pbs_nodefile = pbs_nodefile
+        self.np = np
+        self.dxec = dxec
+        self.spare_nodefiles = list(spare_nodefiles or [])
+        self.vac_dope = vac_dope
+        self._slots = None
+
+    @property
+    def slots(self) -> asyncio.Queue:
+        # Queue 需要在事件循环中建立
+        if self._slots is None:
+            self._slots = asyncio.Queue()
+            for nodefile in [self.pbs_nodefile] + self.spare_nodefiles:
+                self._slots.put_nowait(nodefile)
+        return self._slots
+
+    def has_free_slot(self) -> bool:
+        return not self.slots.empty()
+
+    async def prepare(self, vasp_folder_path:str, vasp_folders_path:str=None) -> VaspTask:
+        '''
+        在线程中生成 POTCAR/INCAR/KPOINTS/OPTCELL, 返回 VaspTask
+        '''
+        vasp_task = VaspTask(vasp_folder_path, vasp_folders_path=vasp_folders_path)
+        await asyncio.to_thread(vasp_task.generate_input_files, gen_poscar=False, vac_dope=self.vac_dope)
+        return vasp_task
+
+    def submit(self, vasp_task:VaspTask) -> asyncio.Task:
+        '''
+        提交计算, 返回的 asyncio.Task 在计算结束后给出 mpirun 的 returncode
+        '''
+        return asyncio.create_task(self._run(vasp_task))
+
+    async def _run(self, vasp_task:VaspTask) -> int:
+        nodefile = await self.slots.get()
+        try:
+            return await vasp_task.mpirun_async(pbs_nodefile=nodefile, np=self.np, dxec=self.dxec)
+        finally:
+            self.slots.put_nowait(nodefile)
+
+    @staticmethod
+    async def cancel(job:asyncio.Task):
+        '''
+        丢弃预测性计算: 取消协程并终止 mpirun
+        '''
+        job.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await job
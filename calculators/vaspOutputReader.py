@@ -0,0 +1,157 @@
+import os
+import re
+
+
+class FileTail(object):
+    '''
+    Description
+    -----------
+        1. 记录文件偏移量, 每次只读取新增的字节
+        2. 文件变短(被新的计算覆盖)时从头读取
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.offset = 0
+        self._partial = b''
+
+    def read(self) -> bytes:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return b''
+        if size < self.offset:
+            self.offset = 0
+            self._partial = b''
+        if size == self.offset:
+            return b''
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+        return data
+
+    def read_lines(self) -> list:
+        '''
+        新增的完整行 (最后不完整的一行留到下一次)
+        '''
+        data = self._partial + self.read()
+        lines = data.split(b'\n')
+        self._partial = lines.pop()
+        return [line.decode('utf-8', errors='replace') for line in lines]
+
+
+class VaspOutputReader(object):
+    '''
+    Description
+    -----------
+        1. 增量读取 OSZICAR/OUTCAR, 代替每次完整读取 OUTCAR 与 pymatgen.Oszicar 的完整解析
+        2. OSZICAR: 离子步数、最终能量 (最后一个离子步的 E0)、离子步与电子步的 dE
+        3. OUTCAR: 只在新增的字节中查找结束标志 `Total CPU time used (sec):`
+
+    Attributes
+    ----------
+        1. self.ionic_step: int
+            已完成的离子步数
+        2. self.final_energy / self.free_energy: float
+            最后一个离子步的 E0 / F
+        3. self.dE: float
+            最后一个离子步的 d E
+        4. self.electronic_step / self.electronic_dE:
+            当前离子步中的电子步数与最后一个电子步的 dE
+        5. self.completed: bool
+            OUTCAR 中是否出现结束标志
+    '''
+    COMPLETION_MARK = b"Total CPU time used (sec):"
+    IONIC_PATTERN = re.compile(r"(\w+)=\s*(\S+)")
+    ELECTRONIC_PATTERN = re.compile(r"^\s*\w+\s*:\s*(\d+)\s+(\S+)\s+(\S+)")
+
+    def __init__(self, vasp_folder_path:str):
+        self.vasp_folder_path = vasp_folder_path
+        self.oszicar = FileTail(os.path.join(vasp_folder_path, "OSZICAR"))
+        self.outcar = FileTail(os.path.join(vasp_folder_path, "OUTCAR"))
+        self._outcar_tail = b''
+
+        self.ionic_step = 0
+        self.final_energy = None
+        self.free_energy = None
+        self.dE = None
+        self.electronic_step = 0
+        self.electronic_dE = None
+        self.completed = False
+
+    def relocate(self, vasp_folder_path:str):
+        '''
+        计算文件夹被移动后更新路径, 保留已读取的偏移量
+        '''
+        self.vasp_folder_path = vasp_folder_path
+        self.oszicar.path = os.path.join(vasp_folder_path, "OSZICAR")
+        self.outcar.path = os.path.join(vasp_folder_path, "OUTCAR")
+
+    def update(self) -> 'VaspOutputReader':
+        for line in self.oszicar.read_lines():
+            self._parse_oszicar_line(line)
+
+        if not self.completed:
+            data = self._outcar_tail + self.outcar.read()
+            if self.COMPLETION_MARK in data:
+                self.completed = True
+            # 保留末尾若干字节, 防止结束标志跨越两次读取
+            self._outcar_tail = data[-len(self.COMPLETION_MARK):]
+        return self
+
+    def _parse_oszicar_line(self, line:str):
+        if "E0=" in line:
+            values = self._parse_ionic_line(line)
+            self.ionic_step += 1
+            self.final_energy = values.get("E0")
+            self.free_energy = values.get("F")
+            self.dE = values.get("dE")
+            self.electronic_step = 0
+            return
+        match = self.ELECTRONIC_PATTERN.match(line)
+        if match:
+            self.electronic_step = int(match.group(1))
+            self.electronic_dE = self._to_float(match.group(3))
+
+    @classmethod
+    def _parse_ionic_line(cls, line:str) -> dict:
+        return {key: cls._to_float(value)
+                for key, value in cls.IONIC_PATTERN.findall(line.replace("d E ", "dE"))}
+
+    @staticmethod
+    def _to_float(value:str) -> float:
+        # VASP 可能省略指数中的 E, 如 -.1234-100
+        value = re.sub(r"(?<=\d)([+-]\d+)$", r"E\1", value)
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    def progress_message(self) -> str:
+        structure_name = os.path.split(self.vasp_folder_path)[-1]
+        if self.ionic_step == 0 and self.electronic_step == 0:
+            return "structure {0}: waiting for OSZICAR ...".format(structure_name)
+        return "structure {0}: ionic step {1}, E0 = {2}, dE = {3}, electronic step {4}, electronic dE = {5}".format(
+            structure_name, self.ionic_step, self.final_energy, self.dE, self.electronic_step, self.electronic_dE)
+
+    @classmethod
+    def read_final_energy(cls, oszicar_path:str, chunk_size:int=4096) -> float:
+        '''
+        从文件末尾向前读取, 返回最后一个离子步的 E0 (与 pymatgen.Oszicar.final_energy 相同)
+        '''
+        with open(oszicar_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b''
+            while position > 0:
+                step = min(chunk_size, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+                lines = data.split(b'\n')
+                # 第一行可能不完整, 只有读到文件开头时才使用
+                for line in reversed(lines if position == 0 else lines[1:]):
+                    line = line.decode('utf-8', errors='replace')
+                    if "E0=" in line:
+                        return float(cls._parse_ionic_line(line)["E0"])
+        raise ValueError("No ionic step found in {0}".format(oszicar_path))
@@ -0,0 +1,183 @@
+from __future__ import annotations
+import os
+import json
+import shutil
+import time
+import numpy as np
+
+from utilitys.phaseTimer import PhaseTimer
+
+
+class Checkpoint(object):
+    '''
+    Description
+    -----------
+        1. 搜索总目录下的 checkpoint.json: 一条链续算所需的全部状态, 每 checkpoint_every 个循环整体写出一次
+        2. 先写入 checkpoint.json.tmp 并 fsync, 再以 os.replace 原子地替换, 任何时刻中断都留下一个完整的检查点
+        3. 内容:
+            - Metropolis.run 的关键字参数、已完成/总的循环数
+            - 随机数状态: 各链的 np.random.Generator 与 np.random 的全局状态
+            - 计数器与当前结构: 内存模式为结构与能量本身, 文件模式为当前/试探结构的步数文件夹
+            - 续写位置: 轨迹文件的记录数、mc_record.txt 与 steps.jsonl 的字节数、能量缓存最后一条记录的时间与命中统计、
+                代理模型的样本
+            - 温度表 (模拟退火) 的当前状态, 见 MCobjects.Metropolis.schedule
+        4. 续算见 `Metropolis.resume`: 检查点之后写出的记录与文件被截去, 随机数状态还原后逐位复现未中断的搜索
+
+    Attributes
+    ----------
+        1. self.vasp_folders_path: str
+            搜索总目录
+        2. self.path: str
+            检查点文件路径
+        3. self.data: dict
+            检查点内容
+    '''
+    FILENAME = "checkpoint.json"
+    VERSION = 1
+
+    def __init__(self, vasp_folders_path: str, data: dict = None):
+        self.vasp_folders_path = vasp_folders_path
+        self.path = os.path.join(vasp_folders_path, self.FILENAME)
+        self.data = {} if data is None else data
+
+    @classmethod
+    def from_run_root(cls, vasp_folders_path: str) -> Checkpoint:
+        path = os.path.join(vasp_folders_path, cls.FILENAME)
+        if not os.path.exists(path):
+            raise FileNotFoundError("No checkpoint in {0}".format(vasp_folders_path))
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != cls.VERSION:
+            raise ValueError("Unsupported checkpoint version {0} in {1}".format(data.get("version"), path))
+        return cls(vasp_folders_path, data)
+
+    @classmethod
+    def exists(cls, vasp_folders_path: str) -> bool:
+        return os.path.isfile(os.path.join(vasp_folders_path, cls.FILENAME))
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    @property
+    def mode(self) -> str:
+        return self.data["step_object"]["mode"]
+
+    @property
+    def loops_done(self) -> int:
+        return self.data["loops_done"]
+
+    @property
+    def num_loops(self) -> int:
+        return self.data["num_loops"]
+
+    def capture(self, step_object, run_kwargs: dict, loops_done: int, num_loops: int,
+                energy_cache=None, surrogate=None, trajectory=None, run_logger=None, schedule=None,
+                **step_kwargs) -> Checkpoint:
+        '''
+        Parameters
+        ----------
+            1. step_object: StepObject or MemoryStepObject
+                由其 `checkpoint_state(**step_kwargs)` 给出计数器、当前结构与链的随机数状态
+            2. energy_cache / surrogate / trajectory / run_logger:
+                EnergyCache / ClusterExpansion / TrajectoryStore / RunLogger (若有)
+            3. schedule: MCobjects.Metropolis.schedule.TemperatureSchedule (若有)
+        '''
+        self.data = {"version": self.VERSION,
+                     "time": time.time(),
+                     "run_kwargs": run_kwargs,
+                     "loops_done": int(loops_done),
+                     "num_loops": int(num_loops),
+                     "step_object": step_object.checkpoint_state(**step_kwargs),
+                     "global_rng": self.global_rng_state(),
+                     "energy_cache": None if energy_cache is None else energy_cache.checkpoint_state(),
+                     "surrogate": None if surrogate is None else surrogate.checkpoint_state(),
+                     "trajectory_records": None if trajectory is None else trajectory.num_records,
+                     "steps_log_offset": None if run_logger is None else run_logger.checkpoint_state(),
+                     "schedule": None if schedule is None else schedule.state()}
+        return self
+
+    @PhaseTimer.timed("write_checkpoint")
+    def save(self):
+        self.write_json(self.path, self.data)
+
+    @staticmethod
+    def write_json(path: str, data: dict, fsync: bool = True):
+        '''
+        原子写入: 写临时文件 (fsync=True 时 fsync) 后以 os.replace 替换;
+        每步写出的 steps.log 不 fsync, 进程中断时同样不会留下不完整的文件
+        '''
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def rng_state(rng) -> dict:
+        '''
+        np.random.Generator 的状态; rng 为 None 或 np.random 模块 (全局状态, 见 `self.global_rng_state`) 时为 None
+        '''
+        if isinstance(rng, np.random.Generator):
+            return rng.bit_generator.state
+        return None
+
+    @staticmethod
+    def set_rng_state(rng, state: dict):
+        if (state is not None) and isinstance(rng, np.random.Generator):
+            rng.bit_generator.state = state
+
+    @staticmethod
+    def global_rng_state() -> dict:
+        state = np.random.get_state(legacy=False)
+        state["state"]["key"] = state["state"]["key"].tolist()
+        return state
+
+    @staticmethod
+    def set_global_rng_state(state: dict):
+        state = dict(state)
+        state["state"] = {"key": np.asarray(state["state"]["key"], dtype=np.uint32),
+                          "pos": state["state"]["pos"]}
+        np.random.set_state(state)
+
+    def restore_run_root(self, load_model: str = None):
+        '''
+        Description
+        -----------
+            1. 以检查点中的计数器重写 steps.log
+            2. 删除检查点之后生成的步数文件夹 (文件模式: 编号大于试探结构; 内存模式: 编号大于 total_steps)
+            3. 文件模式下删除试探结构在检查点之后的输出 (Accept.txt, time_record.txt; 检查点时尚未计算能量的
+                chgnet/mattersim 试探结构还有 CONTCAR, relaxation_output.txt, energy_provenance.txt)
+                以及当前结构的 exchanged.txt, 使该步完整重做
+        '''
+        state = self.data["step_object"]
+        self.write_json(os.path.join(self.vasp_folders_path, "steps.log"),
+                        {"Total_steps": state["total_steps"], "Exchanged_steps": state["exchange_steps"]})
+
+        last_index = state["next_index"] if state["mode"] == "file" else state["total_steps"]
+        for name in os.listdir(self.vasp_folders_path):
+            if name.isdigit() and int(name) > last_index:
+                shutil.rmtree(os.path.join(self.vasp_folders_path, name), ignore_errors=True)
+
+        if state["mode"] != "file":
+            return
+        stale_files = [(state["next_index"], "Accept.txt"), (state["next_index"], "time_record.txt"),
+                       (state["current_index"], "exchanged.txt")]
+        if load_model and not state["next_computed"]:
+            stale_files += [(state["next_index"], name) for name in
+                            ("CONTCAR", "relaxation_output.txt", "energy_provenance.txt")]
+        for index, name in stale_files:
+            path = os.path.join(self.vasp_folders_path, str(index), name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def restore_rng(self, rng):
+        '''
+        还原链的随机数生成器与 np.random 的全局状态 (在续算的第一步之前调用)
+        '''
+        self.set_rng_state(rng, self.data["step_object"].get("rng"))
+        self.set_global_rng_state(self.data["global_rng"])
@@ -0,0 +1,314 @@
+from __future__ import annotations
+import numpy as np
+from prettytable import PrettyTable
+
+
+class DensityOfStates(object):
+    '''
+    Description
+    -----------
+        1. Wang–Landau 的能量直方图: 在 [E_min, E_max) 上以 bin_width 等宽分箱, ln_g 为各箱的 ln g(E),
+            histogram 为当前修正因子下各箱的访问次数
+        2. `self.update` 每步将当前能量所在箱的 ln g 加上 ln_f 并计数; `self.advance` 在直方图平坦
+            (见 `self.whether_flat`, 各已访问的箱至少有 min_visits 次访问) 时按 schedule 减小修正因子:
+            - 'halve': ln_f -> ln_f/2, 清零直方图
+            - '1/t': 同 'halve', ln_f 小于 1/t 之后取 ln_f = 1/t 且不再要求平坦 (Belardinelli–Pereyra),
+                t 为每个已访问箱的平均更新次数
+        3. 能量窗口 (REWL) 为同一能量网格上的连续区间 (见 `self.windows`, 相邻窗口至少重叠 MIN_OVERLAP_BINS 个箱),
+            `self.merge` 在相邻窗口重叠区间中 ln g 斜率最接近的箱处拼接; 访问过的箱不相连时
+            `self.merge_groups` 分别拼接各组相连的窗口
+        4. `self.thermodynamics(T_lst)` 由 ln g 计算任意温度下的内能、热容、自由能与熵
+
+    Attributes
+    ----------
+        1. self.E_min / self.bin_width: float
+            能量网格的起点与箱宽 (eV), 第 i 个箱为 [E_min + i*bin_width, E_min + (i+1)*bin_width)
+        2. self.num_bins: int
+        3. self.ln_g: np.ndarray
+            各箱的 ln g(E), 未访问的箱为 0 (见 self.visited)
+        4. self.histogram: np.ndarray (int64)
+            当前修正因子下各箱的访问次数
+        5. self.visited: np.ndarray (bool)
+            曾经访问过的箱, 平坦度与热力学量只在这些箱上计算
+        6. self.ln_f: float
+            修正因子 ln f
+        7. self.iteration: int
+            修正因子已减小的次数
+        8. self.steps: int
+            累计的更新次数
+        9. self.schedule: str
+            'halve' 或 '1/t'
+        10. self.one_over_t: bool
+            '1/t' 时是否已进入 ln_f = 1/t 阶段
+    '''
+    SCHEDULES = ('halve', '1/t')
+    # 相邻窗口至少重叠的箱数 (拼接时比较 ln g 的斜率)
+    MIN_OVERLAP_BINS = 2
+    # Boltzmann constant
+    k = 8.617333262145E-5
+
+    def __init__(self, E_min: float, E_max: float, bin_width: float, ln_f: float = 1.0, schedule: str = 'halve'):
+        if schedule not in self.SCHEDULES:
+            raise ValueError("schedule must be one of {0}, got {1!r}".format(self.SCHEDULES, schedule))
+        if not (E_max > E_min and bin_width > 0):
+            raise ValueError("Invalid energy range [{0}, {1}) with bin_width {2}".format(E_min, E_max, bin_width))
+        self.E_min = float(E_min)
+        self.bin_width = float(bin_width)
+        self.num_bins = int(np.ceil(round((E_max - E_min) / bin_width, 6)))
+        self.ln_g = np.zeros(self.num_bins)
+        self.histogram = np.zeros(self.num_bins, dtype=np.int64)
+        self.visited = np.zeros(self.num_bins, dtype=bool)
+        self.ln_f = float(ln_f)
+        self.iteration = 0
+        self.steps = 0
+        self.schedule = schedule
+        self.one_over_t = False
+
+    def __repr__(self):
+        table = PrettyTable(["E_min", "E_max", "Bins", "Visited", "ln_f", "Iteration", "Steps", "Flatness"])
+        table.add_row([self.E_min, self.E_max, self.num_bins, int(self.visited.sum()), "{0:.3e}".format(self.ln_f),
+                       self.iteration, self.steps, "{0:.3f}".format(self.flatness())])
+        print(table)
+        return ""
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def E_max(self) -> float:
+        return self.E_min + self.num_bins * self.bin_width
+
+    @property
+    def centers(self) -> np.ndarray:
+        return self.E_min + (np.arange(self.num_bins) + 0.5) * self.bin_width
+
+    def index(self, energy: float) -> int:
+        '''
+        energy 所在的箱, 不在 [E_min, E_max) 内时为 -1
+        '''
+        index = int(np.floor((energy - self.E_min) / self.bin_width))
+        return index if 0 <= index < self.num_bins else -1
+
+    def contains(self, energy: float) -> bool:
+        return self.index(energy) >= 0
+
+    def distance(self, energy: float) -> float:
+        '''
+        energy 到能量区间的距离, 区间内为 0 (初始结构在窗口外时向窗口行走)
+        '''
+        if self.contains(energy):
+            return 0.0
+        return max(self.E_min - energy, energy - self.E_max, 0.0)
+
+    def ln_g_at(self, energy: float) -> float:
+        return float(self.ln_g[self.index(energy)])
+
+    def update(self, energy: float):
+        index = self.index(energy)
+        self.ln_g[index] += self.ln_f
+        self.histogram[index] += 1
+        self.visited[index] = True
+        self.steps += 1
+
+    def flatness(self) -> float:
+        '''
+        已访问的箱上 min(H) / mean(H)
+        '''
+        histogram = self.histogram[self.visited]
+        if len(histogram) == 0 or histogram.mean() == 0:
+            return 0.0
+        return float(histogram.min() / histogram.mean())
+
+    def whether_flat(self, flatness: float = 0.8, min_visits: int = 10) -> bool:
+        '''
+        平坦度不小于 flatness, 且每个已访问的箱在当前修正因子下至少访问 min_visits 次
+        (只访问过少数几个箱、每箱一两次时平坦度也接近 1)
+        '''
+        histogram = self.histogram[self.visited]
+        if (len(histogram) == 0) or (histogram.min() < min_visits):
+            return False
+        return self.flatness() >= flatness
+
+    def advance(self, flatness: float = 0.8, min_visits: int = 10) -> bool:
+        '''
+        按 schedule 减小修正因子, 返回是否减小了 ln_f
+        '''
+        t = self.steps / max(int(self.visited.sum()), 1)
+        if self.one_over_t:
+            ln_f = min(self.ln_f, 1.0 / max(t, 1.0))
+            changed, self.ln_f = ln_f < self.ln_f, ln_f
+            return changed
+        if not self.whether_flat(flatness, min_visits):
+            return False
+        self.ln_f /= 2
+        self.iteration += 1
+        self.histogram[:] = 0
+        if (self.schedule == '1/t') and (self.ln_f <= 1.0 / max(t, 1.0)):
+            self.one_over_t = True
+            self.ln_f = 1.0 / max(t, 1.0)
+        return True
+
+    def converged(self, ln_f_final: float = 1e-6) -> bool:
+        return self.ln_f <= ln_f_final
+
+    def state(self) -> dict:
+        '''
+        可序列化的状态 (在进程之间传递, 写入 npz)
+        '''
+        return {"E_min": self.E_min, "bin_width": self.bin_width, "num_bins": self.num_bins,
+                "ln_g": self.ln_g, "histogram": self.histogram, "visited": self.visited,
+                "ln_f": self.ln_f, "iteration": self.iteration, "steps": self.steps,
+                "schedule": self.schedule, "one_over_t": self.one_over_t}
+
+    @classmethod
+    def from_state(cls, state: dict) -> DensityOfStates:
+        return_object = cls(E_min=float(state["E_min"]),
+                            E_max=float(state["E_min"]) + int(state["num_bins"]) * float(state["bin_width"]),
+                            bin_width=float(state["bin_width"]),
+                            ln_f=float(state["ln_f"]),
+                            schedule=str(state["schedule"]))
+        return_object.num_bins = int(state["num_bins"])
+        return_object.ln_g = np.array(state["ln_g"], dtype=float)
+        return_object.histogram = np.array(state["histogram"], dtype=np.int64)
+        return_object.visited = np.array(state["visited"], dtype=bool)
+        return_object.iteration = int(state["iteration"])
+        return_object.steps = int(state["steps"])
+        return_object.one_over_t = bool(state["one_over_t"])
+        return return_object
+
+    def save(self, path: str):
+        np.savez(path, **self.state())
+
+    @classmethod
+    def load(cls, path: str) -> DensityOfStates:
+        with np.load(path) as data:
+            return cls.from_state({key: data[key] for key in data.files})
+
+    @classmethod
+    def windows(cls, E_min: float, E_max: float, bin_width: float, num_windows: int = 1,
+                overlap: float = 0.75, **kwargs) -> list:
+        '''
+        Description
+        -----------
+            1. 将 [E_min, E_max) 分为 num_windows 个等宽且相邻窗口重叠 overlap (窗口宽度的比例) 的能量窗口,
+                各窗口的箱与整个区间的能量网格对齐
+            2. 相邻窗口重叠的箱数少于 MIN_OVERLAP_BINS 时报错 (采样之前检查)
+        '''
+        grid = cls(E_min, E_max, bin_width)
+        if num_windows == 1:
+            return [cls(E_min, grid.E_max, bin_width, **kwargs)]
+        if not (0 < overlap < 1):
+            raise ValueError("overlap must be in (0, 1), got {0}".format(overlap))
+        width = int(np.ceil(grid.num_bins / (1 + (num_windows - 1) * (1 - overlap))))
+        starts = np.round(np.linspace(0, grid.num_bins - width, num_windows)).astype(int)
+        overlap_bins = int(width - np.diff(starts).max())
+        if overlap_bins < cls.MIN_OVERLAP_BINS:
+            raise ValueError("Adjacent windows overlap by {0} bin(s), at least {1} are needed to merge them: "
+                             "increase overlap or decrease bin_width / num_windows".format(overlap_bins,
+                                                                                          cls.MIN_OVERLAP_BINS))
+        return [cls(grid.E_min + start * bin_width, grid.E_min + (start + width) * bin_width, bin_width, **kwargs)
+                for start in starts]
+
+    @classmethod
+    def merge_groups(cls, windows: list) -> list:
+        '''
+        Description
+        -----------
+            1. 按能量顺序将各窗口分组: 与同组之前的窗口有共同访问过的箱时归入该组, 否则开始新的一组;
+                没有访问过任何箱的窗口被略去
+            2. 每组分别由 `self.merge` 拼接, 返回拼接后的 DensityOfStates 列表 (全部相连时只有一个)
+        '''
+        groups, group_bins = [], set()
+        for window in sorted(windows, key=lambda window: window.E_min):
+            if not window.visited.any():
+                continue
+            offset = int(round(window.E_min / window.bin_width))
+            window_bins = set((offset + np.flatnonzero(window.visited)).tolist())
+            if groups and (window_bins & group_bins):
+                groups[-1].append(window)
+                group_bins |= window_bins
+            else:
+                groups.append([window])
+                group_bins = window_bins
+        return [cls.merge(group) for group in groups]
+
+    @classmethod
+    def merge(cls, windows: list) -> DensityOfStates:
+        '''
+        Description
+        -----------
+            1. 按能量顺序拼接各窗口的 ln g: 在相邻窗口共同访问过的箱中, 选择 ln g 斜率最接近的箱,
+                平移后一个窗口使两者在该箱相等, 该箱以下取前一个窗口, 以上取后一个窗口
+            2. 拼接后平移使 ln g 的最小值为 0 (g(E) 只确定到一个常数, 见 `self.normalize`)
+        '''
+        windows = sorted(windows, key=lambda window: window.E_min)
+        bin_width = windows[0].bin_width
+        E_min = windows[0].E_min
+        offsets = [int(round((window.E_min - E_min) / bin_width)) for window in windows]
+        num_bins = max(offset + window.num_bins for offset, window in zip(offsets, windows))
+        merged = cls(E_min, E_min + num_bins * bin_width, bin_width, ln_f=max(window.ln_f for window in windows),
+                     schedule=windows[0].schedule)
+
+        ln_g = np.full(num_bins, np.nan)
+        first = windows[0]
+        ln_g[offsets[0]:offsets[0] + first.num_bins][first.visited] = first.ln_g[first.visited]
+        for index, (offset, window) in enumerate(zip(offsets[1:], windows[1:]), start=1):
+            window_ln_g = np.full(num_bins, np.nan)
+            window_ln_g[offset:offset + window.num_bins][window.visited] = window.ln_g[window.visited]
+            common = np.flatnonzero(~np.isnan(ln_g) & ~np.isnan(window_ln_g))
+            if len(common) == 0:
+                raise ValueError("Windows {0} and {1} share no visited bin, cannot be merged".format(index - 1, index))
+            if len(common) > 1:
+                slope_difference = np.abs(np.gradient(ln_g[common]) - np.gradient(window_ln_g[common]))
+                join = common[int(np.argmin(slope_difference))]
+            else:
+                join = common[0]
+            shifted = window_ln_g + (ln_g[join] - window_ln_g[join])
+            ln_g[join:] = np.where(np.isnan(shifted[join:]), ln_g[join:], shifted[join:])
+
+        for offset, window in zip(offsets, windows):
+            merged.histogram[offset:offset + window.num_bins] += window.histogram
+        merged.visited = ~np.isnan(ln_g)
+        merged.ln_g = np.where(merged.visited, ln_g - np.nanmin(ln_g), 0.0)
+        merged.steps = sum(window.steps for window in windows)
+        merged.iteration = min(window.iteration for window in windows)
+        return merged
+
+    def normalize(self, ln_total: float):
+        '''
+        平移 ln g 使 Σ g(E) 等于构型总数 exp(ln_total) (如各子晶格多项式系数之积的对数), 自由能与熵成为绝对值
+        '''
+        self.ln_g[self.visited] += ln_total - self._logsumexp(self.ln_g[self.visited])
+
+    @staticmethod
+    def _logsumexp(values: np.ndarray) -> float:
+        max_value = values.max()
+        return float(max_value + np.log(np.exp(values - max_value).sum()))
+
+    def thermodynamics(self, T_lst) -> dict:
+        '''
+        Description
+        -----------
+            1. Z(T) = Σ g(E) exp(-E/kT), 只在已访问的箱上求和 (取箱的中心能量)
+
+        Return
+        ------
+            1. result: dict
+                T (K), U (eV), C (eV/K), F (eV), S (eV/K), 均为与 T_lst 等长的数组;
+                未 `self.normalize` 时 F 与 S 只确定到一个常数
+        '''
+        T_lst = np.atleast_1d(np.asarray(T_lst, dtype=float))
+        energies = self.centers[self.visited]
+        ln_g = self.ln_g[self.visited]
+        result = {key: np.zeros(len(T_lst)) for key in ("U", "C", "F", "S")}
+        result["T"] = T_lst
+        for i, T in enumerate(T_lst):
+            log_weights = ln_g - energies / (self.k * T)
+            ln_Z = self._logsumexp(log_weights)
+            weights = np.exp(log_weights - ln_Z)
+            U = float(weights @ energies)
+            result["U"][i] = U
+            result["C"][i] = float(weights @ (energies - U) ** 2) / (self.k * T ** 2)
+            result["F"][i] = - self.k * T * ln_Z
+            result["S"][i] = (U - result["F"][i]) / T
+        return result
@@ -0,0 +1,288 @@
+from __future__ import annotations
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+from prettytable import PrettyTable
+from pymatgen.core import Structure, Lattice
+from pymatgen.io.vasp.inputs import Poscar
+from pymatgen.analysis.structure_matcher import StructureMatcher
+
+from .neighborTopology import NeighborTopology
+
+
+class EnergyCache(object):
+    '''
+    Description
+    -----------
+        1. 以结构指纹为键的持久化能量缓存, 保存在搜索总目录下的 SQLite 文件中, 命中时直接跳过弛豫, 重启后仍然有效
+        2. 指纹 = 参考晶格 + 各参考位点上的占据(未被占据的位点记为 vac_as):
+            各结构的位点按最小镜像距离映射到参考位点, 因此与原子顺序以及弛豫引起的小位移无关
+        3. 值为弛豫后的能量与 CONTCAR (按参考位点保存的弛豫坐标, 命中时按查询结构的原子顺序还原)
+        4. use_matcher=True 时, 未精确命中的结构再与近邻键数相同的已存结构用 StructureMatcher 比较,
+            对称等价的命中只返回能量, 弛豫结构以查询结构代替
+        5. 同一文件可被多个进程(副本交换/多链)共享, namespace 区分不同模型;
+            各记录以写入的搜索 (run_id) 标记, 续算时只回滚本搜索写入的记录 (见 `self.rollback`)
+
+    Attributes
+    ----------
+        1. self.db_path: str
+            SQLite 文件路径
+        2. self.namespace: str
+            能量来源, 如 "chgnet:None"
+        3. self.reference: pymatgen.core.Structure
+            参考结构(含空位位点), 第一次使用时写入数据库
+        4. self.tolerance: float
+            位点映射允许的最大位移 (Å), None 时为最近位点距离的 1/4
+        5. self.hits / self.matcher_hits / self.misses: int
+            本进程的命中统计
+        6. self.run_id: str
+            写入记录的搜索标记 (如搜索总目录), None 时不标记
+    '''
+    def __init__(self, db_path: str, namespace: str = "default", use_matcher: bool = False,
+                 vac_as: str = "V", tolerance: float = None, match_cutoff: float = None,
+                 max_candidates: int = 64, run_id: str = None):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.use_matcher = use_matcher
+        self.vac_as = vac_as
+        self.tolerance = tolerance
+        self.match_cutoff = match_cutoff
+        self.max_candidates = max_candidates
+        self.run_id = run_id
+
+        self.hits = 0
+        self.matcher_hits = 0
+        self.misses = 0
+        self.reference = None
+
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS energies ("
+                                "namespace TEXT, key TEXT, energy REAL, occupations TEXT, invariant TEXT, "
+                                "lattice TEXT, frac_coords BLOB, contcar TEXT, created REAL, run TEXT, "
+                                "PRIMARY KEY (namespace, key))")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(energies)")]
+        if "run" not in columns:
+            #旧版本建立的缓存文件没有 run 列, 其中的记录不属于任何搜索
+            self.connection.execute("ALTER TABLE energies ADD COLUMN run TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS energies_invariant ON energies (namespace, invariant)")
+        self.connection.commit()
+
+        row = self.connection.execute("SELECT value FROM meta WHERE name='reference'").fetchone()
+        if row is not None:
+            self._load_reference(Structure.from_dict(json.loads(row[0])))
+
+    @classmethod
+    def from_run_root(cls, vasp_folders_path: str, namespace: str = "default", **kwargs) -> EnergyCache:
+        return cls(os.path.join(vasp_folders_path, "energy_cache.sqlite"), namespace=namespace, **kwargs)
+
+    def __repr__(self):
+        table = PrettyTable(["Namespace", "Entries", "Lookups", "Hits", "Matcher_hits", "Hit_rate"])
+        stats = self.stats()
+        table.add_row([self.namespace, stats["Entries"], stats["Lookups"], stats["Hits"],
+                       stats["Matcher_hits"], "{0:.3f}".format(stats["Hit_rate"])])
+        print(table)
+        return ""
+
+    def __str__(self):
+        return self.__repr__()
+
+    def set_reference(self, structure: Structure):
+        '''
+        以 structure (应包含空位位点) 作为参考位点; 数据库中已有参考结构时保持不变
+        '''
+        if self.reference is not None:
+            return
+        self.connection.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('reference', ?)",
+                                (json.dumps(structure.as_dict()),))
+        self.connection.commit()
+        row = self.connection.execute("SELECT value FROM meta WHERE name='reference'").fetchone()
+        self._load_reference(Structure.from_dict(json.loads(row[0])))
+
+    def _load_reference(self, structure: Structure):
+        self.reference = structure
+        self.reference_frac_coords = structure.frac_coords
+        self.reference_matrix = structure.lattice.matrix
+        self.lattice_key = " ".join("{0:.2f}".format(x) for x in self.reference_matrix.ravel())
+
+        distance_matrix = structure.distance_matrix
+        min_distance = distance_matrix[distance_matrix > 1e-8].min(initial=np.inf)
+        if self.tolerance is None:
+            self.tolerance = 0.25 * min_distance
+        self.topology = None
+        if self.use_matcher:
+            cutoff = self.match_cutoff if self.match_cutoff is not None else 1.5 * min_distance
+            self.topology = NeighborTopology.from_structure(structure, cutoff=cutoff)
+
+    def assign(self, structure: Structure) -> np.ndarray:
+        '''
+        Return
+        ------
+            1. mapping: np.ndarray or None
+                第 i 个原子对应的参考位点; 位移超过 tolerance 或两个原子映射到同一位点时返回 None
+        '''
+        diff = structure.frac_coords[:, None, :] - self.reference_frac_coords[None, :, :]
+        diff -= np.round(diff)
+        distances = np.sqrt(((diff @ self.reference_matrix) ** 2).sum(axis=-1))
+        mapping = distances.argmin(axis=1)
+        if distances[np.arange(len(mapping)), mapping].max(initial=0.0) > self.tolerance:
+            return None
+        if len(np.unique(mapping)) != len(mapping):
+            return None
+        return mapping
+
+    def _occupations(self, structure: Structure, mapping: np.ndarray) -> list:
+        occupations = [self.vac_as] * len(self.reference)
+        for index, site in zip(mapping, structure):
+            occupations[index] = site.species_string
+        return occupations
+
+    def _key(self, occupations: list) -> str:
+        return hashlib.sha256((self.lattice_key + "|" + " ".join(occupations)).encode()).hexdigest()
+
+    def _invariant(self, occupations: list) -> str:
+        '''
+        对称不变量: match_cutoff 内各元素对的键数
+        '''
+        if self.topology is None:
+            return None
+        species = np.array(occupations)
+        centers = np.repeat(np.arange(len(species)), np.diff(self.topology.indptr))
+        pairs = np.sort(np.column_stack([species[centers], species[self.topology.indices]]), axis=1)
+        labels, counts = np.unique(pairs[:, 0] + "-" + pairs[:, 1], return_counts=True)
+        return " ".join("{0}:{1}".format(label, count) for label, count in zip(labels, counts))
+
+    def _occupied_structure(self, occupations: list) -> Structure:
+        kept = [i for i, specie in enumerate(occupations) if specie != self.vac_as]
+        return Structure(self.reference.lattice, [occupations[i] for i in kept],
+                         self.reference_frac_coords[kept])
+
+    def lookup(self, structure: Structure, mapping: np.ndarray = None):
+        '''
+        Description
+        -----------
+            1. structure 为弛豫前的结构(不含空位位点)
+            2. mapping 为各原子对应的参考位点; None 时按最小镜像距离确定
+                (内存模式下原子顺序不变, 由调用者给出, 不受弛豫累积位移的影响)
+
+        Return
+        ------
+            1. None (未命中) 或 (energy, relaxed_structure)
+                relaxed_structure 与 structure 的原子顺序一致
+        '''
+        if self.reference is None:
+            self.set_reference(structure)
+        if mapping is None:
+            mapping = self.assign(structure)
+        if mapping is None:
+            self.misses += 1
+            return None
+        occupations = self._occupations(structure, mapping)
+
+        row = self.connection.execute("SELECT energy, lattice, frac_coords FROM energies WHERE namespace=? AND key=?",
+                                      (self.namespace, self._key(occupations))).fetchone()
+        if row is not None:
+            self.hits += 1
+            energy, lattice, frac_coords = row
+            frac_coords = np.frombuffer(frac_coords, dtype=np.float64).reshape(-1, 3)
+            return energy, Structure(Lattice(json.loads(lattice)), structure.species, frac_coords[mapping])
+
+        if self.use_matcher:
+            energy = self._match(occupations)
+            if energy is not None:
+                self.matcher_hits += 1
+                return energy, structure.copy()
+
+        self.misses += 1
+        return None
+
+    def _match(self, occupations: list) -> float:
+        rows = self.connection.execute("SELECT energy, occupations FROM energies WHERE namespace=? AND invariant=? "
+                                       "ORDER BY created DESC LIMIT ?",
+                                       (self.namespace, self._invariant(occupations), self.max_candidates)).fetchall()
+        if not rows:
+            return None
+        matcher = StructureMatcher(primitive_cell=False, scale=False, attempt_supercell=False)
+        query = self._occupied_structure(occupations)
+        for energy, candidate in rows:
+            if matcher.fit(query, self._occupied_structure(candidate.split())):
+                return energy
+        return None
+
+    def store(self, structure: Structure, energy: float, relaxed_structure: Structure,
+              mapping: np.ndarray = None):
+        '''
+        structure 为弛豫前的结构, relaxed_structure 的原子顺序须与其一致; mapping 同 `self.lookup`
+        '''
+        if self.reference is None:
+            self.set_reference(structure)
+        if mapping is None:
+            mapping = self.assign(structure)
+        if mapping is None:
+            return
+
+        occupations = self._occupations(structure, mapping)
+        frac_coords = np.full((len(self.reference), 3), np.nan)
+        frac_coords[mapping] = relaxed_structure.frac_coords
+        self.connection.execute("INSERT OR REPLACE INTO energies (namespace, key, energy, occupations, invariant, "
+                                "lattice, frac_coords, contcar, created, run) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (self.namespace, self._key(occupations), float(energy), " ".join(occupations),
+                                 self._invariant(occupations),
+                                 json.dumps(relaxed_structure.lattice.matrix.tolist()),
+                                 frac_coords.tobytes(),
+                                 str(Poscar(relaxed_structure)),
+                                 time.time(),
+                                 self.run_id))
+        self.connection.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.matcher_hits + self.misses
+        entries = self.connection.execute("SELECT COUNT(*) FROM energies WHERE namespace=?",
+                                          (self.namespace,)).fetchone()[0]
+        return {"Entries": entries,
+                "Lookups": lookups,
+                "Hits": self.hits,
+                "Matcher_hits": self.matcher_hits,
+                "Hit_rate": (self.hits + self.matcher_hits) / lookups if lookups else 0.0}
+
+    def report(self):
+        print(self)
+
+    def checkpoint_state(self) -> dict:
+        '''
+        检查点中的缓存状态: 本搜索在本 namespace 中最后一条记录的写入时间与本进程的命中统计
+        '''
+        created = self.connection.execute("SELECT MAX(created) FROM energies WHERE namespace=? AND run IS ?",
+                                          (self.namespace, self.run_id)).fetchone()[0]
+        return {"db_path": self.db_path,
+                "namespace": self.namespace,
+                "run_id": self.run_id,
+                "created": created,
+                "hits": self.hits,
+                "matcher_hits": self.matcher_hits,
+                "misses": self.misses}
+
+    def rollback(self, state: dict):
+        '''
+        续算时删除本搜索 (run_id) 在检查点之后写入本 namespace 的记录, 并还原命中统计;
+        否则重复的步数会命中这些记录而跳过弛豫, 与未中断的搜索不同.
+        共享同一文件的其他搜索写入的记录保留; run_id 为 None 时无法区分记录的来源, 只还原命中统计
+        '''
+        if self.run_id is not None:
+            if state["created"] is None:
+                self.connection.execute("DELETE FROM energies WHERE namespace=? AND run=?",
+                                        (self.namespace, self.run_id))
+            else:
+                self.connection.execute("DELETE FROM energies WHERE namespace=? AND run=? AND created>?",
+                                        (self.namespace, self.run_id, state["created"]))
+            self.connection.commit()
+        self.hits = state["hits"]
+        self.matcher_hits = state["matcher_hits"]
+        self.misses = state["misses"]
+
+    def close(self):
+        self.connection.close()
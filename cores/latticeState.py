@@ -0,0 +1,186 @@
+from __future__ import annotations
+import numpy as np
+from pymatgen.core import Structure, Lattice
+from pymatgen.io.ase import AseAtomsAdaptor
+
+from generateNewStructure.poscarWriter import PoscarWriter
+
+
+class LatticeState(object):
+    '''
+    Description
+    -----------
+        1. 以占据表示的结构状态: 固定的位点 (晶格 + 分数坐标) 与 int8 占据数组 (各位点元素在 species 中的序号)
+        2. 交换原子只交换占据数组中的两个数, 不再 deepcopy 整个 Structure 或调用 Structure.replace
+        3. 只有能量计算或写文件时才由 `to_structure` / `to_atoms` 生成 pymatgen.Structure / ase.Atoms;
+            生成的 Structure 缓存到占据或坐标改变为止, 调用者不应原位修改它
+        4. `key()` 为占据数组的字节串, 可直接用于哈希、保存与比较
+        5. copy() 只复制占据数组, 晶格与坐标在各副本之间共享 (坐标只整体替换, 见 `set_positions`)
+
+    Attributes
+    ----------
+        1. self.species: tuple
+            元素表, 占据以其中的序号保存
+        2. self.species_index: dict
+            元素 -> 序号
+        3. self.occupation: np.ndarray (int8)
+            第 i 个位点上元素的序号
+        4. self.lattice: pymatgen.core.Lattice
+        5. self.frac_coords: np.ndarray
+            各位点的分数坐标
+    '''
+    __slots__ = ("species", "species_index", "occupation", "lattice", "frac_coords", "_structure")
+
+    def __init__(self, lattice: Lattice, species: tuple, occupation: np.ndarray, frac_coords: np.ndarray):
+        if len(species) > np.iinfo(np.int8).max:
+            raise ValueError("Too many species for an int8 occupation: {0}".format(len(species)))
+        self.lattice = lattice
+        self.species = tuple(species)
+        self.species_index = {specie: index for index, specie in enumerate(self.species)}
+        self.occupation = np.asarray(occupation, dtype=np.int8)
+        self.frac_coords = np.asarray(frac_coords, dtype=float)
+        self._structure = None
+
+    @classmethod
+    def from_structure(cls, structure: Structure, species: list = None) -> LatticeState:
+        '''
+        Parameters
+        ----------
+            1. species: list
+                元素表 (与结构中的元素取并集后排序); 同一搜索中的各状态使用相同的元素表时占据可直接比较
+        '''
+        symbols = [site.species_string for site in structure]
+        species = sorted(set(species or []) | set(symbols))
+        species_index = {specie: index for index, specie in enumerate(species)}
+        occupation = np.array([species_index[symbol] for symbol in symbols], dtype=np.int8)
+        return_object = cls(structure.lattice, species, occupation, structure.frac_coords)
+        return_object._structure = structure
+        return return_object
+
+    def __len__(self):
+        return len(self.occupation)
+
+    def __eq__(self, other):
+        if not isinstance(other, LatticeState):
+            return NotImplemented
+        return (self.species == other.species) and np.array_equal(self.occupation, other.occupation)
+
+    def __hash__(self):
+        # 占据会被原位交换, 哈希只对调用时的占据有效
+        return hash((self.species, self.key()))
+
+    def __repr__(self):
+        counts = np.bincount(self.occupation, minlength=len(self.species))
+        return "LatticeState({0} sites: {1})".format(
+            len(self), ", ".join("{0}{1}".format(specie, count) for specie, count in zip(self.species, counts)))
+
+    def key(self) -> bytes:
+        return self.occupation.tobytes()
+
+    def copy(self) -> LatticeState:
+        return_object = LatticeState.__new__(LatticeState)
+        return_object.lattice = self.lattice
+        return_object.species = self.species
+        return_object.species_index = self.species_index
+        return_object.occupation = self.occupation.copy()
+        return_object.frac_coords = self.frac_coords
+        return_object._structure = None
+        return return_object
+
+    @property
+    def symbols(self) -> np.ndarray:
+        return np.asarray(self.species)[self.occupation]
+
+    @property
+    def cart_coords(self) -> np.ndarray:
+        return self.lattice.get_cartesian_coords(self.frac_coords)
+
+    def symbol(self, index: int) -> str:
+        return self.species[self.occupation[index]]
+
+    def indexes_of(self, specie: str) -> np.ndarray:
+        if specie not in self.species_index:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(self.occupation == self.species_index[specie])
+
+    def codes_in(self, species_index: dict) -> np.ndarray:
+        '''
+        以另一个元素表 (元素 -> 序号) 表示的占据; 元素不在该表中时抛出 KeyError
+        '''
+        table = np.array([species_index[specie] for specie in self.species], dtype=np.int64)
+        return table[self.occupation]
+
+    def swap(self, first_index: int, second_index: int):
+        occupation = self.occupation
+        occupation[first_index], occupation[second_index] = occupation[second_index], occupation[first_index]
+        self._structure = None
+
+    def apply_exchange(self, pairs: list) -> LatticeState:
+        '''
+        原位交换 pairs 中的原子对 (格式同 `ExchangeAtoms.choose_exchange_pairs`);
+        原子对互不重叠, 因此再调用一次即可还原
+        '''
+        for pair in pairs:
+            self.swap(pair[1], pair[3])
+        return self
+
+    def apply_mutation(self, mutations: list, reverse: bool = False) -> LatticeState:
+        '''
+        原位替换 mutations 中各位点的元素 (格式同 `ExchangeAtoms.choose_mutation`, 每一项为 (原元素, 位点, 新元素));
+        reverse=True 时还原为原元素. 元素须在 self.species 中 (见 `from_structure` 的 species)
+        '''
+        occupation = self.occupation
+        for old_specie, index, new_specie in mutations:
+            occupation[index] = self.species_index[old_specie if reverse else new_specie]
+        self._structure = None
+        return self
+
+    def mask(self, exclude: str = None) -> np.ndarray:
+        '''
+        不是 exclude 元素 (如空位 vac_as) 的位点: 空位感知的视图, `to_structure(exclude)` 为其上的真实结构,
+        `set_positions(structure, exclude)` 将真实结构的弛豫结果写回完整晶格
+        '''
+        return self.occupation != self.species_index.get(exclude, -1)
+
+    def set_positions(self, structure: Structure, exclude: str = None):
+        '''
+        以 structure (原子顺序与本状态一致, 如弛豫后的结构) 的晶格与坐标替换位点, 占据不变;
+        exclude 不为 None 时 structure 为去除该元素后的真实结构 (同 `to_structure(exclude)`), 被去除的位点保持原分数坐标
+        '''
+        mask = None if exclude is None else self.mask(exclude)
+        num_sites = len(self) if mask is None else int(mask.sum())
+        if len(structure) != num_sites:
+            raise ValueError("Structure has {0} sites, state has {1}".format(len(structure), num_sites))
+        self.lattice = structure.lattice
+        if mask is None:
+            self.frac_coords = structure.frac_coords
+        else:
+            frac_coords = self.frac_coords.copy()
+            frac_coords[mask] = structure.frac_coords
+            self.frac_coords = frac_coords
+        self._structure = None
+
+    def sorted(self, elements_str_for_vaspkit: str, vac_as: str = None) -> LatticeState:
+        '''
+        按 elements_str_for_vaspkit 的元素顺序重排位点 (与 `PoscarWriter.sort_structure` 相同), 返回新的状态
+        '''
+        sorted_indices = PoscarWriter.sort_indices(self.symbols, elements_str_for_vaspkit, vac_as)
+        return LatticeState(self.lattice, self.species, self.occupation[sorted_indices],
+                            self.frac_coords[sorted_indices])
+
+    def to_structure(self, exclude: str = None) -> Structure:
+        '''
+        Parameters
+        ----------
+            1. exclude: str
+                不输出的元素 (如空位 vac_as); None 时返回缓存的完整结构
+        '''
+        if exclude is None:
+            if self._structure is None:
+                self._structure = Structure(self.lattice, self.symbols.tolist(), self.frac_coords)
+            return self._structure
+        kept = self.mask(exclude)
+        return Structure(self.lattice, self.symbols[kept].tolist(), self.frac_coords[kept])
+
+    def to_atoms(self, exclude: str = None):
+        return AseAtomsAdaptor.get_atoms(self.to_structure(exclude))
@@ -0,0 +1,623 @@
+import os
+import json
+import numpy as np
+from prettytable import PrettyTable
+from pymatgen.core import Structure
+from pymatgen.io.vasp.inputs import Poscar
+
+from generateNewStructure.exchangeAtoms import ExchangeAtoms
+from model.energyBackend import EnergyBackend
+from cores.energyCache import EnergyCache
+from cores.trajectoryStore import TrajectoryStore
+from cores.latticeState import LatticeState
+from cores.checkpoint import Checkpoint
+from logger.runLogger import RunLogger
+from utilitys.phaseTimer import PhaseTimer
+from model.clusterExpansion import ClusterExpansion
+
+
+class MemoryStepObject(object):
+    """内存模式下的交换搜索: 当前结构与能量常驻内存, 交换在工作结构上原位进行,
+    只有被接受的结构(或每 save_every 步)才写入步数文件夹。
+
+    Attributes
+    ----------
+    vasp_folders_path : str
+        搜索总目录(包含 0,1,2... 文件夹以及 steps.log)
+    state : cores.latticeState.LatticeState
+        工作结构的占据状态 (与 exchanger 共享), 试探交换只交换其占据数组;
+        vac_dope=True 时包含空位(vac_as)位点
+    structure : pymatgen.core.Structure
+        由 state 生成的工作结构 (缓存到占据改变为止)
+    energy : float
+        当前结构的能量
+    energy_backend : model.energyBackend.EnergyBackend
+        能量计算后端(CHGNet / MatterSim)
+    exchanger : generateNewStructure.exchangeAtoms.ExchangeAtoms
+        在 structure 上原位选择并交换原子
+    current_index : int or None
+        当前结构对应的步数文件夹编号(未写入磁盘时为 None)
+    save_accepted : bool
+        是否写入每一个被接受的结构
+    save_every : int or None
+        若设置, 每 save_every 步额外写入一次试探结构
+    record_path : str
+        每一步的能量/接受概率/耗时记录文件
+    rng : np.random.Generator
+        本条链的随机数生成器, 交换原子、弛豫扰动与接受判据均由它产生
+        (None 时为 np.random 的全局状态)
+    energy_cache : cores.energyCache.EnergyCache or None
+        持久化能量缓存, 命中时跳过弛豫
+    surrogate : model.clusterExpansion.ClusterExpansion or None
+        delayed acceptance 第一阶段的团簇展开代理模型, 每个真实能量都加入其训练集
+    full_relax_every : int or None
+        energy_backend.relax_mode='local' 时, 每接受 N 步对当前结构做一次完整弛豫
+    accepted_relax_policy : str or None
+        被接受的结构再以该策略重新计算 (如试探结构为单点能, 只弛豫被接受的结构)
+    provenance : str
+        最近一次 evaluate 的能量来源 (见 `EnergyBackend.provenance`, 缓存命中为 'cache')
+    trajectory : cores.trajectoryStore.TrajectoryStore or None
+        二进制轨迹文件, 每一步追加一条记录(占据、能量、接受概率、耗时、弛豫坐标)
+    trial_pairs / trial_mutations : list or None
+        本步原位进行的交换 / 半巨正则元素替换 (见 `ExchangeAtoms.choose_mutation`), 拒绝时据此还原
+    temperature : float or None
+        本步的温度 (由 Metropolis.memory_step 设置), 不为 None 时写入 mc_record.txt 的最后一列与 steps.jsonl
+
+    Note
+    ----
+    与 StepObject 相同, total_steps/exchange_steps 保存在 steps.log 中
+    """
+    def __init__(self, vasp_folders_path: str, structure: Structure, energy_backend: EnergyBackend,
+                 sublattice_symbols_lst: list, elements_str_for_vaspkit: str,
+                 from_contcar: bool = True, load: bool = False,
+                 *,
+                 energy: float = None,
+                 current_index: int = None,
+                 vac_dope=False, vac_as='V',
+                 open_diffusion: bool = False,
+                 diffusion_specie: str = None,
+                 exchange_times: int = 1,
+                 save_accepted: bool = True,
+                 save_every: int = None,
+                 rng: np.random.Generator = None,
+                 energy_cache: EnergyCache = None,
+                 surrogate: ClusterExpansion = None,
+                 full_relax_every: int = None,
+                 accepted_relax_policy: str = None,
+                 trajectory: TrajectoryStore = None):
+        self.vasp_folders_path = vasp_folders_path
+        self.energy_backend = energy_backend
+        self.sublattice_symbols_lst = sublattice_symbols_lst
+        self.elements_str_for_vaspkit = elements_str_for_vaspkit
+        self.from_contcar = from_contcar
+
+        self.vac_dope = vac_dope
+        self.vac_as = vac_as
+
+        self.open_diffusion = open_diffusion
+        self.diffusion_specie = diffusion_specie
+        self.exchange_times = exchange_times
+
+        self.save_accepted = save_accepted
+        self.save_every = save_every
+        self.current_index = current_index
+        self.rng = np.random if rng is None else rng
+        self.energy_cache = energy_cache
+        if self.energy_cache is not None:
+            #参考位点包含空位; 内存模式下原子顺序不变, 位点映射只需建立一次
+            self.energy_cache.set_reference(structure)
+            self.site_mapping = self.energy_cache.assign(structure)
+            if (self.site_mapping is None) and (len(structure) == len(self.energy_cache.reference)):
+                self.site_mapping = np.arange(len(structure))
+            if self.site_mapping is None:
+                print(f'energy cache disabled: structure does not match the reference sites in {self.energy_cache.db_path}')
+                self.energy_cache = None
+
+        self.full_relax_every = full_relax_every
+        self.accepted_relax_policy = accepted_relax_policy
+        self.provenance = None
+        self.surrogate = surrogate
+        if self.surrogate is not None:
+            #与能量缓存相同, 原子顺序不变, 代理模型的位点映射只建立一次
+            self.surrogate_mapping = self.surrogate.assign(structure)
+            if (self.surrogate_mapping is None) and (len(structure) == len(self.surrogate.reference)):
+                self.surrogate_mapping = np.arange(len(structure))
+            if self.surrogate_mapping is None:
+                print('surrogate disabled: structure does not match the reference sites')
+                self.surrogate = None
+
+        self.trajectory = trajectory
+        if self.trajectory is not None:
+            #原子顺序不变, 轨迹文件的位点映射只建立一次
+            self.trajectory_mapping = self.trajectory.assign(structure)
+            if (self.trajectory_mapping is None) and (len(structure) == len(self.trajectory.reference)):
+                self.trajectory_mapping = np.arange(len(structure))
+            if self.trajectory_mapping is None:
+                print(f'trajectory disabled: structure does not match the reference sites in {self.trajectory.path}')
+                self.trajectory = None
+
+        self.step_log_path = os.path.join(vasp_folders_path, "steps.log")
+        self.record_path = os.path.join(vasp_folders_path, "mc_record.txt")
+
+        if not load:
+            self.exchange_steps = 0
+            self.total_steps = 0
+        else:
+            self.total_steps, self.exchange_steps = self.load_info()
+
+        #元素表包含各子晶格的全部元素, 半巨正则替换可以引入结构中暂时没有的元素
+        self.state = LatticeState.from_structure(structure, species=[symbol for symbols in sublattice_symbols_lst
+                                                                     for symbol in symbols])
+        self.energy = energy
+        if self.energy is None:
+            #初始结构与被接受的结构使用相同的能量来源
+            self.energy, relaxed_structure = self.evaluate(self.structure, relax_policy=self.accepted_relax_policy)
+            self.learn(self.energy)
+            if self.from_contcar:
+                self.state.set_positions(relaxed_structure)
+
+        self.exchanger = ExchangeAtoms.from_state(state=self.state,
+                                                  vasp_folders_path=self.vasp_folders_path,
+                                                  sublattices_symbols_lst=self.sublattice_symbols_lst,
+                                                  vac_dope=self.vac_dope,
+                                                  vac_as=self.vac_as,
+                                                  rng=self.rng)
+        self.trial_pairs = None
+        self.trial_mutations = None
+        self.temperature = None
+        self.record_file = open(self.record_path, "a" if load else "w")
+        if (self.trajectory is not None) and (self.trajectory.num_records == 0):
+            self._append_trajectory(self.energy, 1.0, True, self.structure, self.provenance)
+        self.save_info()
+
+    @classmethod
+    def from_folder(cls, poscar_path: str, energy_backend: EnergyBackend, **kwargs) -> 'MemoryStepObject':
+        '''
+        Description
+        -----------
+            1. 由步数文件夹中的 POSCAR 建立内存搜索
+            2. vac_dope=True 时读取同目录下含空位的 n.POSCAR
+            3. 若该文件夹已有 relaxation_output.txt 与 CONTCAR, 直接读取能量, 不再弛豫
+        '''
+        vasp_folder_path = os.path.dirname(poscar_path)
+        vasp_folders_path = os.path.dirname(vasp_folder_path)
+        structure_index = int(os.path.split(vasp_folder_path)[-1])
+        vac_dope = kwargs.get("vac_dope", False)
+        vac_as = kwargs.get("vac_as", "V")
+
+        if vac_dope:
+            structure = Structure.from_file(os.path.join(vasp_folder_path, str(structure_index)+".POSCAR"))
+        else:
+            structure = Structure.from_file(poscar_path)
+
+        energy = None
+        contcar_path = os.path.join(vasp_folder_path, "CONTCAR")
+        output_path = os.path.join(vasp_folder_path, "relaxation_output.txt")
+        if os.path.exists(contcar_path) and os.path.exists(output_path):
+            with open(output_path, "r") as f:
+                energy = float(f.readlines()[-1].split(":")[-1])
+            if kwargs.get("from_contcar", True):
+                contcar = Structure.from_file(contcar_path)
+                if vac_dope:
+                    #CONTCAR 的坐标写回含空位的完整晶格, 空位保持 n.POSCAR 中的坐标
+                    state = LatticeState.from_structure(structure)
+                    state.set_positions(contcar, exclude=vac_as)
+                    contcar = state.to_structure()
+                structure = contcar
+
+        return cls(vasp_folders_path=vasp_folders_path,
+                   structure=structure,
+                   energy_backend=energy_backend,
+                   energy=energy,
+                   current_index=structure_index,
+                   **kwargs)
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint: Checkpoint, energy_backend: EnergyBackend, **kwargs) -> 'MemoryStepObject':
+        '''
+        Description
+        -----------
+            1. 由检查点还原内存搜索: 当前结构与能量直接取自检查点, 不重新计算
+            2. mc_record.txt 截去检查点之后的记录; steps.log 由 `Checkpoint.restore_run_root`,
+                链的随机数状态由 `Checkpoint.restore_rng` 还原
+        '''
+        state = checkpoint["step_object"]
+        record_path = os.path.join(checkpoint.vasp_folders_path, "mc_record.txt")
+        if os.path.exists(record_path):
+            os.truncate(record_path, min(state["record_offset"], os.path.getsize(record_path)))
+        kwargs["load"] = True
+        step_object = cls(vasp_folders_path=checkpoint.vasp_folders_path,
+                          structure=Structure.from_dict(state["structure"]),
+                          energy_backend=energy_backend,
+                          energy=state["energy"],
+                          current_index=state["current_index"],
+                          **kwargs)
+        step_object.provenance = state["provenance"]
+        return step_object
+
+    def __repr__(self):
+        table = PrettyTable(["Total_steps", "Exchanged_steps", "Current_Index", "Energy"])
+        table.add_row([self.total_steps, self.exchange_steps, self.current_index, self.energy])
+        print(table)
+        return ''
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def structure(self) -> Structure:
+        return self.state.to_structure()
+
+    def _physical_structure(self, structure: Structure) -> Structure:
+        '''
+        去除空位位点, 得到用于能量计算的真实结构; structure 为工作结构时直接由空位掩码生成 (见 `LatticeState.mask`)
+        '''
+        if not self.vac_dope:
+            return structure
+        if structure is self.structure:
+            return self.state.to_structure(exclude=self.vac_as)
+        physical_structure = structure.copy()
+        physical_structure.remove_species([self.vac_as])
+        return physical_structure
+
+    def _merge_relaxed(self, structure: Structure, relaxed_structure: Structure) -> Structure:
+        '''
+        将弛豫结果写回含空位的完整结构 (与工作状态的占据相同), 空位保持原分数坐标
+        '''
+        if not self.vac_dope:
+            return relaxed_structure
+        state = LatticeState.from_structure(structure, species=self.state.species)
+        state.set_positions(relaxed_structure, exclude=self.vac_as)
+        return state.to_structure()
+
+    def _physical_mapping(self, structure: Structure) -> np.ndarray:
+        '''
+        去除空位位点后, 各原子对应的缓存参考位点 (structure 与工作状态的占据相同)
+        '''
+        if not self.vac_dope:
+            return self.site_mapping
+        return self.site_mapping[self.state.mask(self.vac_as)]
+
+    def local_centers(self) -> np.ndarray:
+        '''
+        局部弛豫的中心: 试探交换涉及的位点 (含空位位点) 的笛卡尔坐标; 完整弛豫时为 None
+        '''
+        if (self.energy_backend.relax_mode != 'local') or (self.trial_pairs is None and self.trial_mutations is None):
+            return None
+        indices = [index for pair in self.trial_pairs or [] for index in (pair[1], pair[3])] + \
+                  [mutation[1] for mutation in self.trial_mutations or []]
+        return self.state.cart_coords[indices]
+
+    def evaluate(self, structure: Structure, local_centers: np.ndarray = None, relax_policy: str = None):
+        '''
+        Parameters
+        ----------
+            1. local_centers: np.ndarray
+                见 `EnergyBackend.evaluate`, 局部弛豫从当前(已弛豫的)结构出发, 只弛豫交换位点附近的原子
+            2. relax_policy: str
+                None 时为 energy_backend.relax_policy; 与之不同时不使用能量缓存
+
+        Return
+        ------
+            1. energy: float
+            2. relaxed_structure: pymatgen.core.Structure
+                弛豫后的完整结构(含空位)
+        '''
+        physical_structure = self._physical_structure(structure)
+        use_cache = (self.energy_cache is not None) and (relax_policy is None)
+        if use_cache:
+            mapping = self._physical_mapping(structure)
+            cached = self.energy_cache.lookup(physical_structure, mapping)
+            if cached is not None:
+                energy, relaxed_structure = cached
+                self.provenance = 'cache'
+                return energy, self._merge_relaxed(structure, relaxed_structure)
+
+        energy, relaxed_structure = self.energy_backend.evaluate(physical_structure, rng=self.rng,
+                                                                 local_centers=local_centers,
+                                                                 relax_policy=relax_policy)
+        self.provenance = self.energy_backend.provenance(relax_policy=relax_policy, local_centers=local_centers)
+        if use_cache:
+            self.energy_cache.store(physical_structure, energy, relaxed_structure, mapping)
+        return energy, self._merge_relaxed(structure, relaxed_structure)
+
+    def predict_surrogate(self) -> float:
+        '''
+        当前工作结构(原位交换后即为试探结构)的代理能量; 没有可用的代理模型时返回 None
+        '''
+        if self.surrogate is None:
+            return None
+        return self.surrogate.predict(self.state, self.surrogate_mapping)
+
+    def learn(self, energy: float):
+        '''
+        将工作结构的真实能量加入代理模型的训练集
+        '''
+        if self.surrogate is not None:
+            self.surrogate.add(self.state, energy, self.surrogate_mapping)
+
+    @PhaseTimer.timed("generate_structure")
+    def propose(self) -> Structure:
+        '''
+        在工作状态上原位交换原子, 返回试探结构(即 self.structure)
+        '''
+        pairs = self.exchanger.choose_exchange_pairs(self.diffusion_specie,
+                                                     exchange_times=self.exchange_times,
+                                                     with_cutoff=self.open_diffusion)
+        return self.apply_trial(pairs)
+
+    def apply_trial(self, pairs: list) -> Structure:
+        self.trial_pairs = pairs
+        self.state.apply_exchange(self.trial_pairs)
+        return self.structure
+
+    def whether_mutate(self, mutation_probability: float) -> bool:
+        '''
+        半巨正则模式下本步是否为元素替换: 以 mutation_probability 的概率替换, 没有可交换的原子对时总是替换
+        '''
+        if self.rng.random() < mutation_probability:
+            return True
+        return len(self.exchanger.structure_sublattice_object.exchangeable_entries(self.diffusion_specie)) == 0
+
+    @PhaseTimer.timed("generate_structure")
+    def propose_mutation(self, chemical_potentials: dict):
+        '''
+        在工作状态上原位替换一个位点的元素 (半巨正则)
+
+        Return
+        ------
+            1. trial_structure: pymatgen.core.Structure
+                试探结构(即 self.structure)
+            2. delta_mu: float
+                μ_新元素 - μ_原元素 (eV)
+        '''
+        old_specie, index, new_specie = self.exchanger.choose_mutation(chemical_potentials)
+        self.trial_mutations = [(old_specie, index, new_specie)]
+        self.state.apply_mutation(self.trial_mutations)
+        return self.structure, float(chemical_potentials[new_specie] - chemical_potentials[old_specie])
+
+    def _revert_trial(self):
+        '''
+        还原本步原位进行的交换与元素替换
+        '''
+        if self.trial_pairs is not None:
+            self.state.apply_exchange(self.trial_pairs)
+        if self.trial_mutations is not None:
+            self.state.apply_mutation(self.trial_mutations, reverse=True)
+        self.trial_pairs = None
+        self.trial_mutations = None
+
+    @PhaseTimer.timed("generate_structure")
+    def propose_batch(self, num_trials: int):
+        '''
+        Description
+        -----------
+            1. 以当前工作结构(若已原位交换, 则为试探结构)为起点, 生成 num_trials 个独立的交换结构副本
+
+        Return
+        ------
+            1. pairs_lst: list
+            2. structures: list[pymatgen.core.Structure]
+        '''
+        exchanger = self.exchanger
+        if self.trial_pairs is not None:
+            exchanger = ExchangeAtoms.from_state(state=self.state.copy(),
+                                                 vasp_folders_path=self.vasp_folders_path,
+                                                 sublattices_symbols_lst=self.sublattice_symbols_lst,
+                                                 vac_dope=self.vac_dope,
+                                                 vac_as=self.vac_as,
+                                                 neighbor_topology=self.exchanger.neighbor_topology,
+                                                 rng=self.rng)
+        pairs_lst = []
+        structures = []
+        for _ in range(num_trials):
+            pairs = exchanger.choose_exchange_pairs(self.diffusion_specie,
+                                                    exchange_times=self.exchange_times,
+                                                    with_cutoff=self.open_diffusion)
+            state = self.state.copy().apply_exchange(pairs)
+            pairs_lst.append(pairs)
+            structures.append(state.to_structure())
+        return pairs_lst, structures
+
+    def predict_batch(self, structures: list) -> np.ndarray:
+        '''
+        批量单点能(不弛豫), 空位位点在计算前去除
+        '''
+        structures = [self._physical_structure(structure) for structure in structures]
+        with PhaseTimer.phase(self.energy_backend.name + "_predict"):
+            return self.energy_backend.predict_batch(structures)
+
+    def walk(self, energy: float, relaxed_structure: Structure, possibility: float = 1.0,
+             execution_time: float = None):
+        '''
+        Description
+        -----------
+            1. 接受试探结构, 能量与结构直接在内存中迭代
+            2. from_contcar=True 时以弛豫后的结构继续搜索
+            3. accepted_relax_policy 不为 None 时, 被接受的结构以该策略重新计算后再保存并继续搜索
+        '''
+        self.total_steps += 1
+        self.exchange_steps += 1
+        provenance = self.provenance
+        if self.accepted_relax_policy is not None:
+            energy, relaxed_structure = self.evaluate(relaxed_structure, relax_policy=self.accepted_relax_policy)
+            provenance = '{0}>{1}'.format(provenance, self.provenance)
+        self._record(energy, possibility, True, execution_time, provenance)
+        self._append_trajectory(energy, possibility, True, relaxed_structure, provenance, execution_time)
+
+        if self.save_accepted or self._whether_save_every():
+            if self.current_index is not None:
+                exchanged_txt_path = os.path.join(self.vasp_folders_path, str(self.current_index), "exchanged.txt")
+                if os.path.isdir(os.path.dirname(exchanged_txt_path)):
+                    open(exchanged_txt_path, "a").close()
+            self.save_state(self.structure, relaxed_structure, energy, possibility, provenance)
+            self.current_index = self.total_steps
+        else:
+            self.current_index = None
+
+        if self.from_contcar:
+            self.state.set_positions(relaxed_structure)
+        self.energy = energy
+        self.trial_pairs = None
+        self.trial_mutations = None
+        if self._whether_full_relax():
+            self.full_relax()
+        self.exchanger.refresh()
+
+    def replace_structure(self, structure: Structure, energy: float, current_index: int = None):
+        '''
+        以外部给出的结构 (位点顺序与本链相同, 如副本交换得到的另一副本的构型) 与能量替换当前结构, 不重新计算能量;
+        占据原位写入 self.state (与 exchanger 共享), 交换原子的位点索引随之重建
+        '''
+        state = LatticeState.from_structure(structure, species=self.state.species)
+        if state.species != self.state.species:
+            raise ValueError("Structure species {0} do not match the chain species {1}".format(state.species,
+                                                                                              self.state.species))
+        self.state.occupation = state.occupation
+        self.state.set_positions(structure)
+        self.energy = energy
+        self.current_index = current_index
+        self.trial_pairs = None
+        self.trial_mutations = None
+        self.exchanger.refresh()
+
+    def _whether_full_relax(self) -> bool:
+        return (self.energy_backend.relax_mode == 'local') and bool(self.full_relax_every) \
+            and (self.exchange_steps % self.full_relax_every == 0)
+
+    def full_relax(self):
+        '''
+        局部弛豫模式下定期完整弛豫当前结构(含晶胞), 消除局部弛豫累积的误差; 不使用能量缓存
+        '''
+        energy, relaxed_structure = self.energy_backend.evaluate(self._physical_structure(self.structure),
+                                                                 rng=self.rng, relax_policy='converge')
+        print(f'完整弛豫: {self.energy} -> {energy}')
+        self.energy = energy
+        if self.from_contcar:
+            self.state.set_positions(self._merge_relaxed(self.structure, relaxed_structure))
+
+    def walk_anew(self, energy: float, relaxed_structure: Structure, possibility: float,
+                  execution_time: float = None):
+        '''
+        Description
+        -----------
+            1. 不接受试探结构, 将原位交换还原
+        '''
+        self.total_steps += 1
+        self._record(energy, possibility, False, execution_time, self.provenance)
+        self._append_trajectory(energy, possibility, False, relaxed_structure, self.provenance, execution_time)
+
+        if self._whether_save_every():
+            self.save_state(self.structure, relaxed_structure, energy, possibility, self.provenance)
+
+        self._revert_trial()
+
+    def walk_screened(self, possibility: float, execution_time: float = None):
+        '''
+        Description
+        -----------
+            1. 试探结构在代理模型阶段被拒绝, 没有计算真实能量 (mc_record.txt 中 E_2 记为 nan)
+        '''
+        self.total_steps += 1
+        self._record(float('nan'), possibility, False, execution_time, 'surrogate')
+        self._append_trajectory(float('nan'), possibility, False, None, 'surrogate', execution_time)
+
+        self._revert_trial()
+
+    def _whether_save_every(self) -> bool:
+        return bool(self.save_every) and (self.total_steps % self.save_every == 0)
+
+    def _record(self, energy: float, possibility: float, accepted: bool, execution_time: float = None,
+                provenance: str = None):
+        self.record_file.write("{0}\t{1:.6f}\t{2:.6f}\t{3:.6f}\t{4}\t{5}\t{6}{7}\n".format(
+            self.total_steps, float(self.energy), float(energy), possibility, int(accepted),
+            "" if execution_time is None else "{0:.6f}".format(execution_time),
+            "" if provenance is None else provenance,
+            "" if self.temperature is None else "\t{0:.2f}".format(self.temperature)))
+        fields = {}
+        if self.temperature is not None:
+            fields["T"] = float(self.temperature)
+        if self.trial_mutations is not None:
+            fields["mutation"] = ["{0}>{1}@{2}".format(old_specie, new_specie, index)
+                                  for old_specie, index, new_specie in self.trial_mutations]
+        RunLogger.log_step(step=self.total_steps, E1=float(self.energy), E2=float(energy),
+                           possibility=float(possibility), accepted=bool(accepted),
+                           execution_time=execution_time, provenance=provenance, **fields)
+
+    def _append_trajectory(self, energy: float, possibility: float, accepted: bool,
+                           relaxed_structure: Structure = None, provenance: str = None,
+                           execution_time: float = None):
+        '''
+        self.state 为本步的试探结构 (原位交换尚未还原)
+        '''
+        if self.trajectory is None:
+            return
+        self.trajectory.append(step=self.total_steps, E_1=self.energy, E_2=energy, possibility=possibility,
+                               accepted=accepted, structure=self.state, relaxed_structure=relaxed_structure,
+                               execution_time=execution_time, provenance=provenance,
+                               mapping=self.trajectory_mapping)
+
+    @PhaseTimer.timed("write_structure")
+    def save_state(self, structure: Structure, relaxed_structure: Structure, energy: float, possibility: float,
+                   provenance: str = None):
+        '''
+        Description
+        -----------
+            1. 将第 total_steps 步的结构写入步数文件夹, 文件格式与文件模式保持一致
+                POSCAR, CONTCAR, relaxation_output.txt, Accept.txt, energy_provenance.txt (vac_dope: n.POSCAR)
+        '''
+        vasp_folder_path = os.path.join(self.vasp_folders_path, str(self.total_steps))
+        if not os.path.exists(vasp_folder_path):
+            os.mkdir(vasp_folder_path)
+
+        Poscar(self._sorted(self._physical_structure(structure))).write_file(
+            os.path.join(vasp_folder_path, "POSCAR"))
+        Poscar(self._sorted(self._physical_structure(relaxed_structure))).write_file(
+            os.path.join(vasp_folder_path, "CONTCAR"))
+        if self.vac_dope:
+            Poscar(self._sorted(structure)).write_file(
+                os.path.join(vasp_folder_path, str(self.total_steps)+".POSCAR"))
+
+        with open(os.path.join(vasp_folder_path, "relaxation_output.txt"), "w") as f:
+            f.write(f'\nthe final structure energy:{energy}')
+        if provenance is not None:
+            EnergyBackend.record_provenance(vasp_folder_path, provenance)
+        with open(os.path.join(vasp_folder_path, "Accept.txt"), "w") as f:
+            f.write(f'本次搜索继承概率为：{possibility:.6f}\n')
+
+        self.save_info()
+
+    def _sorted(self, structure: Structure) -> Structure:
+        return self.exchanger.pos_sort(structure, self.elements_str_for_vaspkit)
+
+    @PhaseTimer.timed("write_steps_log")
+    def save_info(self):
+        dict_steps = {"Total_steps": self.total_steps, "Exchanged_steps": self.exchange_steps}
+        if self.energy_cache is not None:
+            dict_steps["Energy_cache"] = self.energy_cache.stats()
+        Checkpoint.write_json(self.step_log_path, dict_steps, fsync=False)
+
+    def checkpoint_state(self) -> dict:
+        '''
+        检查点中的链状态 (见 cores.checkpoint.Checkpoint): 计数器、当前结构(含空位)与能量、
+        本链的随机数状态以及 mc_record.txt 的续写位置
+        '''
+        self.record_file.flush()
+        return {"mode": "memory",
+                "total_steps": self.total_steps,
+                "exchange_steps": self.exchange_steps,
+                "energy": float(self.energy),
+                "structure": self.structure.as_dict(),
+                "current_index": self.current_index,
+                "provenance": self.provenance,
+                "record_offset": self.record_file.tell(),
+                "rng": Checkpoint.rng_state(self.rng)}
+
+    def load_info(self):
+        with open(self.step_log_path, "r") as f:
+            dict_steps = json.load(f)
+        return dict_steps["Total_steps"], dict_steps["Exchanged_steps"]
+
+    def close(self):
+        self.save_info()
+        self.record_file.close()
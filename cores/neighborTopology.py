@@ -0,0 +1,97 @@
+from __future__ import annotations
+import numpy as np
+from prettytable import PrettyTable
+from pymatgen.core import Structure
+from .latticeState import LatticeState
+
+
+class NeighborTopology(object):
+    '''
+    Description
+    -----------
+        1. 以 CSR 形式保存 cutoff 内的邻居: 第 i 个位点的邻居为 indices[indptr[i]:indptr[i+1]]
+        2. 交换原子只改变位点上的元素, 不改变位点坐标, 因此拓扑在各步之间复用
+        3. 弛豫后的 CONTCAR 使位点(或晶格)移动超过 tolerance 时才需要重建
+
+    Attributes
+    ----------
+        1. self.cutoff: float
+            邻居截断半径 (Å)
+        2. self.tolerance: float
+            允许的最大位点/晶格矢量位移 (Å)
+        3. self.indptr: np.ndarray
+            CSR 行指针, 长度为位点数 + 1
+        4. self.indices: np.ndarray
+            CSR 邻居序号 (不含自身, 同一邻居的多个镜像只记一次)
+        5. self.frac_coords: np.ndarray
+            建立拓扑时的分数坐标
+        6. self.lattice_matrix: np.ndarray
+            建立拓扑时的晶格矩阵
+    '''
+    def __init__(self, cutoff: float, indptr: np.ndarray, indices: np.ndarray,
+                 frac_coords: np.ndarray, lattice_matrix: np.ndarray, tolerance: float = 0.1):
+        self.cutoff = cutoff
+        self.tolerance = tolerance
+        self.indptr = indptr
+        self.indices = indices
+        self.frac_coords = frac_coords
+        self.lattice_matrix = lattice_matrix
+
+    def __repr__(self):
+        table = PrettyTable(["Sites", "Cutoff", "Pairs", "Tolerance"])
+        table.add_row([len(self.indptr) - 1, self.cutoff, len(self.indices), self.tolerance])
+        print(table)
+        return ""
+
+    def __str__(self):
+        return self.__repr__()
+
+    @classmethod
+    def from_structure(cls, structure: Structure, cutoff: float = 5.0, tolerance: float = 0.1) -> NeighborTopology:
+        if isinstance(structure, LatticeState):
+            structure = structure.to_structure()
+        num_sites = len(structure)
+        center_indices, point_indices, _, _ = structure.get_neighbor_list(r=float(cutoff), exclude_self=True)
+
+        # 去除同一邻居的重复镜像, 并按 (center, point) 排序
+        pair_keys = np.unique(center_indices.astype(np.int64) * num_sites + point_indices.astype(np.int64))
+        centers = pair_keys // num_sites
+        indices = pair_keys % num_sites
+
+        indptr = np.zeros(num_sites + 1, dtype=np.int64)
+        np.cumsum(np.bincount(centers, minlength=num_sites), out=indptr[1:])
+
+        return cls(cutoff=float(cutoff),
+                   indptr=indptr,
+                   indices=indices,
+                   frac_coords=structure.frac_coords,
+                   lattice_matrix=structure.lattice.matrix.copy(),
+                   tolerance=tolerance)
+
+    @classmethod
+    def ensure(cls, neighbor_topology: NeighborTopology, structure: Structure,
+               cutoff: float = 5.0, tolerance: float = 0.1) -> NeighborTopology:
+        '''
+        若已有拓扑对 structure 仍然有效则直接返回, 否则重新建立
+        '''
+        if (neighbor_topology is not None) and (neighbor_topology.cutoff == float(cutoff)) \
+                and neighbor_topology.whether_valid(structure):
+            return neighbor_topology
+        return cls.from_structure(structure, cutoff=cutoff, tolerance=tolerance)
+
+    def neighbors(self, index: int) -> np.ndarray:
+        return self.indices[self.indptr[index]:self.indptr[index + 1]]
+
+    def whether_valid(self, structure: Structure) -> bool:
+        '''
+        位点数一致, 且晶格矢量与各位点(最小镜像)位移均不超过 tolerance (structure 也可以是 LatticeState)
+        '''
+        if len(structure) != len(self.indptr) - 1:
+            return False
+        lattice_matrix = structure.lattice.matrix
+        if np.abs(lattice_matrix - self.lattice_matrix).max() > self.tolerance:
+            return False
+        diff = structure.frac_coords - self.frac_coords
+        diff -= np.round(diff)
+        displacement = np.sqrt(((diff @ lattice_matrix) ** 2).sum(axis=-1))
+        return bool(displacement.max(initial=0.0) <= self.tolerance)
@@ -0,0 +1,86 @@
+from __future__ import annotations
+import numpy as np
+from prettytable import PrettyTable
+
+
+class RateTree(object):
+    '''
+    Description
+    -----------
+        1. 以数组保存的二叉求和树: 叶子为各事件的速率, 每个内部节点为两个子节点之和, 根节点为总速率
+        2. 更新一个事件的速率 (`self.update`) 与按累积速率选择事件 (`self.find`) 均为 O(log N),
+            用于 BKL (residence-time) 动力学蒙特卡洛
+        3. 更新时沿路径重新求和而不是累加差值, 长时间运行不会积累舍入误差
+
+    Attributes
+    ----------
+        1. self.size: int
+            事件数
+        2. self.capacity: int
+            叶子数 (不小于 size 的 2 的幂), 第 i 个事件的叶子为 self.tree[capacity + i]
+        3. self.tree: np.ndarray
+            节点 1 为根, 节点 p 的子节点为 2p 与 2p+1 (节点 0 不使用)
+    '''
+    def __init__(self, rates: np.ndarray):
+        rates = np.asarray(rates, dtype=float)
+        if (rates < 0).any():
+            raise ValueError("Rates must be non-negative")
+        self.size = len(rates)
+        self.capacity = 1 << int(np.ceil(np.log2(max(self.size, 1))))
+        self.tree = np.zeros(2 * self.capacity)
+        self.tree[self.capacity:self.capacity + self.size] = rates
+        node = self.capacity
+        while node > 1:
+            self.tree[node // 2:node] = self.tree[node:2 * node:2] + self.tree[node + 1:2 * node:2]
+            node //= 2
+
+    def __repr__(self):
+        table = PrettyTable(["Events", "Active", "Total_rate"])
+        table.add_row([self.size, int(np.count_nonzero(self.rates)), self.total])
+        print(table)
+        return ""
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index: int) -> float:
+        return float(self.tree[self.capacity + index])
+
+    @property
+    def total(self) -> float:
+        return float(self.tree[1])
+
+    @property
+    def rates(self) -> np.ndarray:
+        return self.tree[self.capacity:self.capacity + self.size]
+
+    def update(self, index: int, rate: float):
+        if rate < 0:
+            raise ValueError("Rate must be non-negative, got {0}".format(rate))
+        tree = self.tree
+        node = self.capacity + index
+        if tree[node] == rate:
+            return
+        tree[node] = rate
+        node //= 2
+        while node >= 1:
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+            node //= 2
+
+    def find(self, value: float) -> int:
+        '''
+        累积速率首次超过 value (0 <= value < self.total) 的事件; 舍入误差不会选中速率为 0 的事件
+        '''
+        tree = self.tree
+        node = 1
+        while node < self.capacity:
+            left = tree[2 * node]
+            if (value < left) or (tree[2 * node + 1] <= 0):
+                node = 2 * node
+            else:
+                value -= left
+                node = 2 * node + 1
+        return node - self.capacity
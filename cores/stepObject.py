@@ -1,15 +1,23 @@
 import os
 import json
 import sys
+import shutil
+import time
+import numpy as np
 from pymatgen.core import Structure
 from prettytable import PrettyTable
-from pymatgen.io.vasp import Oszicar
 
 from generateNewStructure.exchangeAtoms import ExchangeAtoms
 from model.mattersim_ import mattersim_predict
+from model.modelRegistry import ModelRegistry
+from model.energyBackend import EnergyBackend
+from cores.energyCache import EnergyCache
+from cores.trajectoryStore import TrajectoryStore
+from cores.checkpoint import Checkpoint
+from logger.runLogger import RunLogger
+from utilitys.phaseTimer import PhaseTimer
+from calculators.vaspOutputReader import VaspOutputReader
 
-from chgnet.model import CHGNet
-from chgnet.model import StructOptimizer
 from io import StringIO
 
 class StructureState(object):
@@ -31,10 +39,34 @@ class StructureState(object):
         是否属于空位掺杂结构
     load_CHGnet : bool or str
         是否加载模型。为str时将加载str路径模型
+    load_path : str
+        训练模型路径(若有), 模型由 ModelRegistry 统一加载
     CHG_out_path : str
         设置模型输出文件路径
+    energy_cache : EnergyCache
+        持久化能量缓存(若有), 命中时跳过弛豫
+    relax_mode : str
+        'full' 或 'local' (见 model.energyBackend.EnergyBackend)
+    local_radius : float
+        局部弛豫半径 (Å)
+    local_centers : np.ndarray
+        生成本结构时被交换位点的笛卡尔坐标(初始结构为 None, 即完整弛豫)
+    relax_policy / relax_steps / max_relax_steps : str / int / int
+        'none' (单点能), 'fixed_steps' (最多 relax_steps 步) 或 'converge' (最多 max_relax_steps 步, 见 EnergyBackend)
+    rng : np.random.Generator
+        弛豫前随机扰动所用的随机数生成器 (与搜索共用); None 时使用 np.random 的全局状态
+    lattice_state : cores.latticeState.LatticeState
+        由本结构交换原子时读取的占据状态 (首次交换时建立); 试探结构被拒绝后再次交换时直接复用, 不再读取文件
+    energy : float
+        本结构的能量 (计算或读取后保存在内存中, 见 `StepObject.current_energy`); None 表示尚未读取
+    energy_time : float
+        生成本结构时 (`self.load_model`) 预先计算能量所用的时间 (s), 计入该步的 execution_time; 未预先计算时为 0
     """
-    def __init__(self,poscar_path: str,vac_dope = False,load_CHGnet = False,load_path=None):
+    def __init__(self,poscar_path: str,vac_dope = False,load_CHGnet = False,load_path=None,
+                 energy_cache:EnergyCache=None,
+                 relax_mode:str='full',local_radius:float=6.0,local_centers=None,
+                 relax_policy:str='converge',relax_steps:int=50,max_relax_steps:int=500,
+                 rng=None):
 
         self.poscar_path = poscar_path
         self.vasp_folder_path = os.path.dirname(self.poscar_path)
@@ -46,19 +78,37 @@ class StructureState(object):
 
         self.structure_index = int(os.path.split(self.vasp_folder_path)[-1])
         self.load_CHGnet=load_CHGnet
+        self.load_path = load_path
         self.CHG_out_path = os.path.join(self.vasp_folder_path,'relaxation_output.txt')
+        self.energy_cache = energy_cache
+        self.relax_mode = relax_mode
+        self.local_radius = local_radius
+        self.local_centers = local_centers
+        self.relax_policy = relax_policy
+        self.relax_steps = relax_steps
+        self.max_relax_steps = max_relax_steps
+        self.rng = rng
+        self.lattice_state = None
+        self.energy = None
+        self.energy_time = 0.0
+
+    def free_mask(self, structure:Structure):
+        '''
+        局部弛豫时参与弛豫的原子; 完整弛豫时为 None
+        '''
+        if (self.relax_mode != 'local') or (self.local_centers is None):
+            return None
+        return EnergyBackend.local_free_mask(structure, self.local_centers, self.local_radius)
 
     def load_model(self,load_CHGnet,load_path):
-        #加载初始化模型
-        if load_path is not None:
-            self.model = CHGNet.from_file(load_path)
-            print('load trained model')
-        else:
-            self.model = CHGNet.load()
-            print('load initial model')
+        #加载初始化模型(同一模型在进程内只加载一次)
+        self.load_path = load_path
+        self.model = ModelRegistry.get_chgnet(load_path=load_path)
         #初始化文件计算
         if load_CHGnet and (not os.path.exists(self.CHG_out_path)):
+            start_time = time.time()
             self.get_CHG_energy()
+            self.energy_time = time.time() - start_time
         return
 
 
@@ -73,12 +123,33 @@ class StructureState(object):
     
     def get_energy(self):
         oszicar_path = os.path.join(self.vasp_folder_path, "OSZICAR")
-        energy = float(Oszicar(oszicar_path).final_energy)
+        energy = VaspOutputReader.read_final_energy(oszicar_path)
         
         self.energy = energy
 
         return energy
     
+    def get_provenance(self) -> str:
+        '''
+        能量来源: energy_provenance.txt 中各行以 '>' 连接 (如被接受后重新计算), DFT 为 'vasp'
+        '''
+        provenance_path = os.path.join(self.vasp_folder_path, "energy_provenance.txt")
+        if os.path.exists(provenance_path):
+            with open(provenance_path, "r") as f:
+                lines = f.read().split()
+            return ">".join(lines)
+        if os.path.exists(os.path.join(self.vasp_folder_path, "OSZICAR")):
+            return 'vasp'
+        return None
+
+    def get_lattice_structure(self):
+        '''
+        交换位点上的占据: vac_dope 时读取含空位的 n.POSCAR, 否则读取 POSCAR
+        '''
+        if self.vac_dope:
+            return Structure.from_file(os.path.join(self.vasp_folder_path, str(self.structure_index)+".POSCAR"))
+        return Structure.from_file(self.poscar_path)
+
     def get_already_predict_energy(self):
         with open(self.CHG_out_path, "r") as f:
             content = f.readlines()
@@ -86,16 +157,54 @@ class StructureState(object):
         energy_CHG = line[-1]
         return energy_CHG
 
-    def get_CHG_energy(self):
-
-        structure = Structure.from_file(self.poscar_path)
-        relaxer = StructOptimizer()
-        structure.perturb(0.1)
-
+    def get_CHG_energy(self, full_relax:bool=False, relax_policy:str=None):
+        '''
+        full_relax=True 时由 CONTCAR 出发做一次完整(非局部)弛豫, 不使用能量缓存 (见 `self.full_relax`);
+        relax_policy 为 None 时使用 self.relax_policy
+        '''
+        relax_policy = self.relax_policy if relax_policy is None else relax_policy
+        if full_relax:
+            structure = Structure.from_file(self.contcar_path)
+            free_mask = None
+        else:
+            structure = Structure.from_file(self.poscar_path)
+            free_mask = self.free_mask(structure)
+        if (self.energy_cache is not None) and (not full_relax):
+            cached = self.energy_cache.lookup(structure)
+            if cached is not None:
+                energy_CHG, relaxed_structure = cached
+                relaxed_structure.to(os.path.join(self.vasp_folder_path,"CONTCAR"),'poscar')
+                with open(self.CHG_out_path, "w") as f:
+                    f.write(f'energy cache hit\nthe final structure energy:{energy_CHG}')
+                EnergyBackend.record_provenance(self.vasp_folder_path, 'cache')
+                return self.get_already_predict_energy()
+            unrelaxed_structure = structure.copy()
+
+        relaxer = ModelRegistry.get_struct_optimizer(load_path=self.load_path)
+        steps = self.relax_steps if relax_policy == 'fixed_steps' else self.max_relax_steps
         original_stdout = sys.stdout
         output_buffer = StringIO()
         sys.stdout = output_buffer
-        result = relaxer.relax(structure, verbose=True) #分子弛豫优化，默认step = 500
+        if relax_policy == 'none':
+            #单点能: 不扰动、不弛豫
+            result = {"final_structure": structure}
+        elif free_mask is None:
+            #与 Structure.perturb(0.1) 相同, 但使用搜索的 rng (可由检查点还原)
+            vectors = EnergyBackend._rng(self.rng).standard_normal((len(structure), 3))
+            vectors *= 0.1 / np.linalg.norm(vectors, axis=1, keepdims=True)
+            for index in range(len(structure)):
+                structure.translate_sites([index], vectors[index], frac_coords=False)
+            with PhaseTimer.phase("chgnet_relax"):
+                result = relaxer.relax(structure, steps=steps, verbose=True) #分子弛豫优化，默认step = 500
+        else:
+            #局部弛豫: 只扰动并弛豫交换位点附近的原子, 其余原子固定, 不弛豫晶胞
+            vectors = EnergyBackend._rng(self.rng).standard_normal((len(structure), 3))
+            vectors *= 0.1 / np.linalg.norm(vectors, axis=1, keepdims=True)
+            for index in np.flatnonzero(free_mask):
+                structure.translate_sites([int(index)], vectors[index], frac_coords=False)
+            atoms = EnergyBackend.fix_outside(structure.to_ase_atoms(), free_mask)
+            with PhaseTimer.phase("chgnet_relax"):
+                result = relaxer.relax(atoms, steps=steps, relax_cell=False, verbose=True)
         sys.stdout = original_stdout
 
         with open(self.CHG_out_path, "w") as f: #保存优化过程
@@ -103,17 +212,41 @@ class StructureState(object):
             f.close()
 
         relaxed_structure=result["final_structure"]
+        if "selective_dynamics" in relaxed_structure.site_properties:
+            relaxed_structure.remove_site_property("selective_dynamics")
         relaxed_structure.to(os.path.join(self.vasp_folder_path,"CONTCAR"),'poscar')
         #保存优化结构
-        predic = self.model.predict_structure(relaxed_structure)
+        model = ModelRegistry.get_chgnet(load_path=self.load_path)
+        with PhaseTimer.phase("chgnet_predict"):
+            predic = model.predict_structure(relaxed_structure)
         energy_CHG = predic['e']
 
         with open(self.CHG_out_path, "a") as f:
             f.write(f'\nthe final structure energy:{energy_CHG*relaxed_structure.num_sites}')
+        if (self.energy_cache is not None) and (not full_relax):
+            self.energy_cache.store(unrelaxed_structure, energy_CHG*relaxed_structure.num_sites, relaxed_structure)
+        EnergyBackend.record_provenance(self.vasp_folder_path,
+                                        EnergyBackend.describe_policy(relax_policy, self.relax_steps,
+                                                                      local=free_mask is not None))
        
         energy_CHG = self.get_already_predict_energy()
         return energy_CHG
 
+    def full_relax(self, load_model:str, relax_policy:str='converge'):
+        '''
+        由 CONTCAR 出发以 relax_policy 完整(非局部)弛豫当前结构, 更新 CONTCAR 与 relaxation_output.txt 中的能量
+        (局部弛豫模式下的定期完整弛豫; 被接受的结构以 accepted_relax_policy 重新计算)
+        '''
+        self.lattice_state = None
+        if load_model == 'chgnet':
+            self.get_CHG_energy(full_relax=True, relax_policy=relax_policy)
+        elif load_model == 'mattersim':
+            mattersim_predict.full_relax(self.poscar_path, load_path=self.load_path,
+                                         relax_policy=relax_policy, relax_steps=self.relax_steps,
+                                         max_relax_steps=self.max_relax_steps, rng=self.rng)
+        self.energy = float(self.get_already_predict_energy())
+        return self.energy
+
     def get_mattersim_energy(self):
 
         energy_sim = self.get_already_predict_energy()
@@ -148,13 +281,39 @@ class StepObject(object):
         必须参与交换的元素
     exchange_times : int
         每次结构的交换原子对数
+    rng : np.random.Generator
+        选择交换原子的随机数生成器(None 时为 np.random 的全局状态)
+    energy_cache : EnergyCache
+        持久化能量缓存(若有), 传递给各步的 StructureState
+    relax_mode / local_radius : str / float
+        传递给各步的 StructureState; 'local' 时试探结构只弛豫交换位点附近的原子
+    full_relax_every : int
+        relax_mode='local' 时, 每接受 N 步对当前结构做一次完整弛豫
+    relax_policy / relax_steps / max_relax_steps : str / int / int
+        传递给各步的 StructureState, 决定试探结构的能量来源
+    accepted_relax_policy : str
+        不为 None 时, 被接受的结构以该策略重新计算
+    trajectory : TrajectoryStore
+        二进制轨迹文件(若有), 每一步追加一条记录 (见 `self.record_trajectory`)
+    keep_folders : bool
+        False 时只保留初始文件夹 0 与当前/试探结构的步数文件夹, 其余文件夹在 `self.prune` 时删除
+        (由调用者在写出检查点之后调用, 检查点引用的文件夹总是存在)
+    vac_process_files : bool
+        vac_dope 时是否写出空位的中间文件 (process 文件夹、n.vasp 与 n.CONTCAR); 空位结构总是在内存中得到
+    next_poscar_path / next_local_centers : str / np.ndarray
+        续算时已经生成的试探结构 (见 cores.checkpoint.Checkpoint), 给出时不再交换原子
 
     Note
     ----
     默认为非读取模式:load=False,搜索从文件夹0开始;读取模式下可自定义初始文件夹及序号
 
     进行一次完整的交换原子流程,生成下一步文件夹以及POSCAR/.poscar
+
+    异步 VASP 流水线中, 下一个试探结构可以预先生成在 speculative/<branch>/ 下
+    (见 `self.prepare_candidate`), 被采用时移入搜索目录
     """
+    SPECULATIVE_FOLDER = 'speculative'
+
     def __init__(self, current_structure_state:StructureState, sublattice_symbols_lst: list,
                 elements_str_for_vaspkit:str,
                 from_contcar: bool,load: bool = True,
@@ -162,7 +321,22 @@ class StepObject(object):
                 vac_dope = False,vac_as = 'V',
                 open_diffusion:bool=False,
                 diffusion_specie:str=None,
-                exchange_times:int=1
+                exchange_times:int=1,
+                rng=None,
+                energy_cache:EnergyCache=None,
+                relax_mode:str='full',
+                local_radius:float=6.0,
+                full_relax_every:int=None,
+                relax_policy:str='converge',
+                relax_steps:int=50,
+                max_relax_steps:int=500,
+                accepted_relax_policy:str=None,
+                trajectory:TrajectoryStore=None,
+                keep_folders:bool=True,
+                vac_process_files:bool=False,
+                next_poscar_path:str=None,
+                next_local_centers=None,
+                lazy_energy:bool=False
                 ):
         self.sublattice_symbols_lst = sublattice_symbols_lst
         self.from_contcar = from_contcar
@@ -171,15 +345,33 @@ class StepObject(object):
         
         self.load_CHGnet = load_CHGnet
         self.load_path = load_path
+        self.load_model = load_model
+        self.relax_mode = relax_mode
+        self.local_radius = local_radius
+        self.full_relax_every = full_relax_every
+        self.relax_policy = relax_policy
+        self.relax_steps = relax_steps
+        self.max_relax_steps = max_relax_steps
+        self.accepted_relax_policy = accepted_relax_policy
+        self.trajectory = trajectory
+        self.keep_folders = keep_folders
+        self.pending_prune = []
+        # 使用代理模型时试探结构的能量在通过第一阶段筛选后才计算 (见 MCobjects.Metropolis)
+        self.lazy_energy = lazy_energy
 
         self.vac_dope = vac_dope
         self.vac_as = vac_as
+        self.vac_process_files = vac_process_files
 
         self.open_diffusion = open_diffusion
         self.exchange_times = exchange_times
+        self.rng = rng
+        self.energy_cache = energy_cache
+        # 短程扩散的邻居拓扑, 在各步之间复用
+        self.neighbor_topology = None
         # 日志文件的路径
-        vasp_folders_path = self.current_structure_state.vasp_folders_path
-        self.step_log_path = os.path.join(vasp_folders_path, "steps.log")  #总目录下生成步数文件
+        self.vasp_folders_path = self.current_structure_state.vasp_folders_path
+        self.step_log_path = os.path.join(self.vasp_folders_path, "steps.log")  #总目录下生成步数文件
         if not os.path.exists(self.step_log_path):
             os.system("touch {0}".format(self.step_log_path))
 
@@ -189,37 +381,72 @@ class StepObject(object):
         else:
             self.total_steps, self.exchange_steps = self.load_info()
         self.diffusion_specie = diffusion_specie
-        self.next_structure_state = self._get_next_state()
+        if next_poscar_path is None:
+            self.next_structure_state = self._get_next_state()
+        else:
+            self.next_structure_state = self._new_structure_state(next_poscar_path, next_local_centers)
         self.save_info()
     
-    def _get_next_state(self):
+    def _get_next_state(self, structure_state:StructureState=None, new_structure_index:int=None,
+                        vasp_folders_path:str=None):
+        '''
+        由 structure_state (默认为当前结构) 交换原子, 在 vasp_folders_path (默认为搜索目录) 下
+        生成第 new_structure_index (默认为 total_steps+1) 个结构
+        '''
+        structure_state = self.current_structure_state if structure_state is None else structure_state
+        new_structure_index = self.total_steps+1 if new_structure_index is None else new_structure_index
         if self.from_contcar:
-            exchanger = ExchangeAtoms(poscar_path=self.current_structure_state.contcar_path,            #current_structure_state发生变化
+            exchanger = ExchangeAtoms(poscar_path=structure_state.contcar_path,            #current_structure_state发生变化
                                 sublattices_symbols_lst=self.sublattice_symbols_lst,
                                 vac_dope=self.vac_dope,
-                                vac_as=self.vac_as)
+                                vac_as=self.vac_as,
+                                neighbor_topology=self.neighbor_topology,
+                                rng=self.rng,
+                                lattice_state=structure_state.lattice_state,
+                                vac_process_files=self.vac_process_files)
         else:
-            exchanger = ExchangeAtoms(poscar_path=self.current_structure_state.poscar_path,
+            exchanger = ExchangeAtoms(poscar_path=structure_state.poscar_path,
                                 sublattices_symbols_lst=self.sublattice_symbols_lst,
                                 vac_dope=self.vac_dope,
-                                vac_as=self.vac_as)
-
-        next_poscar_path = exchanger.generate_new_structure(new_structure_index=self.total_steps+1,
+                                vac_as=self.vac_as,
+                                neighbor_topology=self.neighbor_topology,
+                                rng=self.rng,
+                                lattice_state=structure_state.lattice_state,
+                                vac_process_files=self.vac_process_files)
+        #交换在副本上进行, 当前结构的占据状态保持不变, 被拒绝后可以复用
+        structure_state.lattice_state = exchanger.state
+        if vasp_folders_path is not None:
+            exchanger.vasp_folders_path = vasp_folders_path
+
+        next_poscar_path = exchanger.generate_new_structure(new_structure_index=new_structure_index,
                                                         elements_str_for_vaspkit=self.elements_str_for_vaspkit,
                                                         pick_first_specie=self.diffusion_specie,
                                                         with_cutoff=self.open_diffusion,
                                                         exchange_times=self.exchange_times
                                                         )
+        self.neighbor_topology = exchanger.neighbor_topology
 
+        return self._new_structure_state(next_poscar_path, exchanger.exchanged_coords)
 
-
-        next_structure_state = StructureState(poscar_path=next_poscar_path,
+    def _new_structure_state(self, poscar_path:str, local_centers=None) -> StructureState:
+        '''
+        以本搜索的设置建立试探结构的 StructureState (chgnet 时加载模型并计算能量, lazy_energy 时只加载模型)
+        '''
+        next_structure_state = StructureState(poscar_path=poscar_path,
                                          vac_dope=self.vac_dope,
                                          load_CHGnet=self.load_CHGnet,
-                                         load_path=self.load_path)
+                                         load_path=self.load_path,
+                                         energy_cache=self.energy_cache,
+                                         relax_mode=self.relax_mode,
+                                         local_radius=self.local_radius,
+                                         local_centers=local_centers,
+                                         relax_policy=self.relax_policy,
+                                         relax_steps=self.relax_steps,
+                                         max_relax_steps=self.max_relax_steps,
+                                         rng=self.rng)
         
         if self.load_CHGnet:
-            next_structure_state.load_model(load_CHGnet = self.load_CHGnet,
+            next_structure_state.load_model(load_CHGnet = self.load_CHGnet and not self.lazy_energy,
                                             load_path=self.load_path)
 
         return next_structure_state
@@ -234,6 +461,7 @@ class StepObject(object):
     def __str__(self):
         return self.__repr__()
 
+    @PhaseTimer.timed("write_steps_log")
     def save_info(self):
         '''
         Description
@@ -241,8 +469,9 @@ class StepObject(object):
             1. 每一步结束，无论是否交换原子，都需要执行这个函数 -- 保存 step 信息
         '''
         dict_steps = {"Total_steps": self.total_steps, "Exchanged_steps": self.exchange_steps}
-        with open(self.step_log_path, "w") as f:
-            json.dump(dict_steps, f)
+        if self.energy_cache is not None:
+            dict_steps["Energy_cache"] = self.energy_cache.stats()
+        Checkpoint.write_json(self.step_log_path, dict_steps, fsync=False)
 
     def load_info(self):
         '''
@@ -253,24 +482,93 @@ class StepObject(object):
         
         Return
         ------
+            1. (total_steps, exchange_steps)
 
+        Raise
+        -----
+            1. ValueError: steps.log 不存在、为空或缺少计数器 (可由 `Metropolis.resume` 从检查点续算)
         '''
         try:
             with open(self.step_log_path, "r") as f:
                 dict_steps = json.load(f)
             return dict_steps["Total_steps"], dict_steps["Exchanged_steps"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise ValueError("Cannot read step counters from {0}: {1!r}".format(self.step_log_path, e)) from e
 
-        except:
-            return None
+    def checkpoint_state(self) -> dict:
+        '''
+        检查点中的链状态 (见 cores.checkpoint.Checkpoint): 计数器、当前/试探结构的步数文件夹、
+        试探结构的局部弛豫中心与本链的随机数状态
+        '''
+        local_centers = self.next_structure_state.local_centers
+        return {"mode": "file",
+                "total_steps": self.total_steps,
+                "exchange_steps": self.exchange_steps,
+                "current_index": self.current_structure_state.structure_index,
+                "current_poscar": os.path.basename(self.current_structure_state.poscar_path),
+                "next_index": self.next_structure_state.structure_index,
+                "next_poscar": os.path.basename(self.next_structure_state.poscar_path),
+                "next_local_centers": None if local_centers is None else np.asarray(local_centers).tolist(),
+                "next_computed": os.path.exists(self.next_structure_state.CHG_out_path),
+                "rng": Checkpoint.rng_state(self.rng)}
+
+    def speculative_branches(self) -> list:
+        '''
+        可以在当前试探结构计算期间预先生成下一个试探结构的分支:
+            - 'reject': 由当前结构交换 (试探结构被拒绝时采用)
+            - 'accept': 由试探结构的 POSCAR 交换, 仅 from_contcar=False 且无空位时可行
+                (否则需要试探结构弛豫后的 CONTCAR)
+        '''
+        if self.from_contcar or self.vac_dope:
+            return ['reject']
+        return ['reject', 'accept']
+
+    def prepare_candidate(self, branch:str) -> StructureState:
+        '''
+        Description
+        -----------
+            1. 在 speculative/<branch>/ 下预先生成第 total_steps+2 个结构 (即下一步的试探结构)
+            2. 该分支被采用时由 `self.promote_candidate` 移入搜索目录, 否则由 `self.discard_candidate` 删除
+        '''
+        structure_state = self.current_structure_state if branch == 'reject' else self.next_structure_state
+        staging_path = os.path.join(self.vasp_folders_path, self.SPECULATIVE_FOLDER, branch)
+        os.makedirs(staging_path, exist_ok=True)
+        return self._get_next_state(structure_state=structure_state,
+                                    new_structure_index=self.total_steps+2,
+                                    vasp_folders_path=staging_path)
+
+    def promote_candidate(self, structure_state:StructureState) -> StructureState:
+        '''
+        将预先生成的结构移入搜索目录 (文件夹名即为结构编号, 运行中的计算不受影响)
+        '''
+        vasp_folder_path = os.path.join(self.vasp_folders_path, str(structure_state.structure_index))
+        if os.path.exists(vasp_folder_path):
+            # 上一次中断的搜索留下的、未记录在 steps.log 中的文件夹
+            shutil.rmtree(vasp_folder_path)
+        os.rename(structure_state.vasp_folder_path, vasp_folder_path)
+        return StructureState(poscar_path=os.path.join(vasp_folder_path, os.path.basename(structure_state.poscar_path)),
+                              vac_dope=self.vac_dope,
+                              load_CHGnet=self.load_CHGnet,
+                              load_path=self.load_path,
+                              energy_cache=self.energy_cache)
+
+    def discard_candidate(self, structure_state:StructureState=None):
+        '''
+        删除未被采用的预生成结构; structure_state 为 None 时清空整个 speculative/ 目录
+        '''
+        if structure_state is None:
+            shutil.rmtree(os.path.join(self.vasp_folders_path, self.SPECULATIVE_FOLDER), ignore_errors=True)
+        else:
+            shutil.rmtree(structure_state.vasp_folder_path, ignore_errors=True)
 
-    def walk(self):
+    def walk(self, next_structure_state:StructureState=None):
         '''
         Description
         -----------
             1. 满足条件， 
                 - 在 current_structure 文件夹下，建立一个 `exchanged.txt` 文件
                 - self.current_structure_state = self.next_structure_state
-                - self.next_structure_satte = 新的 structure_state
+                - self.next_structure_satte = 新的 structure_state (或已经预先生成的 next_structure_state)
         '''
         # 交换的步数加 1
         self.total_steps += 1
@@ -278,14 +576,88 @@ class StepObject(object):
         
         exchanged_txt_path = os.path.join(self.current_structure_state.vasp_folder_path, "exchanged.txt")
         os.system("touch {0}".format(exchanged_txt_path))
+        self._prune(self.current_structure_state)
 
         self.current_structure_state = self.next_structure_state    #数据进行迭代
-        self.next_structure_state = self._get_next_state()
+        #在生成下一个结构(读取 CONTCAR)之前重新弛豫
+        if self._whether_full_relax():
+            self.current_structure_state.full_relax(self.load_model)
+        elif (self.accepted_relax_policy is not None) and (self.load_model in ('chgnet', 'mattersim')):
+            self.current_structure_state.full_relax(self.load_model, relax_policy=self.accepted_relax_policy)
+        if next_structure_state is None:
+            next_structure_state = self._get_next_state()
+        self.next_structure_state = next_structure_state
         
         self.save_info()
     
 
-    def walk_anew(self):
+    def _prune(self, structure_state:StructureState):
+        '''
+        keep_folders=False 时记下已经记录在轨迹文件中、不再需要的步数文件夹 (初始文件夹 0 保留), 由 `self.prune` 删除
+        '''
+        if self.keep_folders or structure_state.structure_index == 0:
+            return
+        self.pending_prune.append(structure_state.vasp_folder_path)
+
+    def prune(self):
+        for vasp_folder_path in self.pending_prune:
+            shutil.rmtree(vasp_folder_path, ignore_errors=True)
+        self.pending_prune = []
+
+    def record_trajectory(self, E_1, E_2, possibility:float, accepted:bool, execution_time:float=None,
+                          structure_state:StructureState=None, step:int=None, T:float=None):
+        '''
+        Description
+        -----------
+            1. 将本步(默认为试探结构 next_structure_state, 步数 total_steps+1)追加到轨迹文件与 steps.jsonl
+            2. E_2 为 None 或 nan (代理模型拒绝, 未计算能量) 时不保存弛豫坐标
+            3. T 不为 None 时 (本步的温度, 见 MCobjects.Metropolis.schedule) 一并写入 steps.jsonl
+        '''
+        structure_state = self.next_structure_state if structure_state is None else structure_state
+        step = self.total_steps+1 if step is None else step
+        provenance = structure_state.get_provenance()
+        extra_fields = {} if T is None else {"T": float(T)}
+        RunLogger.log_step(step=step, index=structure_state.structure_index,
+                           E1=None if E_1 is None else float(E_1), E2=None if E_2 is None else float(E_2),
+                           possibility=float(possibility), accepted=bool(accepted),
+                           execution_time=execution_time, provenance=provenance, **extra_fields)
+        if self.trajectory is None:
+            return
+        structure = Structure.from_file(structure_state.poscar_path)
+        relaxed_structure = None
+        if (E_2 is not None) and np.isfinite(float(E_2)) and os.path.exists(structure_state.contcar_path):
+            relaxed_structure = Structure.from_file(structure_state.contcar_path)
+        self.trajectory.append(step=step, E_1=E_1, E_2=E_2, possibility=possibility, accepted=accepted,
+                               structure=structure, relaxed_structure=relaxed_structure,
+                               execution_time=execution_time, provenance=provenance)
+
+    def current_energy(self) -> float:
+        '''
+        当前结构的能量: 被接受时即为该步的 E_2, 随 current_structure_state 传递, 拒绝时不变;
+        只有初始结构 (或续算后的第一步) 读取一次 OSZICAR / relaxation_output.txt
+        '''
+        structure_state = self.current_structure_state
+        if structure_state.energy is None:
+            if self.load_model in ('chgnet', 'mattersim'):
+                structure_state.energy = float(structure_state.get_already_predict_energy())
+            else:
+                structure_state.get_energy()
+        return structure_state.energy
+
+    def record_initial(self, E_1):
+        '''
+        轨迹文件为空时记录初始结构 (第 0 步)
+        '''
+        if (self.trajectory is not None) and (self.trajectory.num_records == 0):
+            self.record_trajectory(E_1, E_1, 1.0, True, structure_state=self.current_structure_state,
+                                   step=self.total_steps)
+
+    def _whether_full_relax(self) -> bool:
+        return (self.relax_mode == 'local') and bool(self.full_relax_every) \
+            and (self.load_model in ('chgnet', 'mattersim')) \
+            and (self.exchange_steps % self.full_relax_every == 0)
+
+    def walk_anew(self, next_structure_state:StructureState=None):
         '''
         Descroption
         -----------
@@ -293,6 +665,9 @@ class StepObject(object):
                 - self
         '''
         self.total_steps += 1
-        self.next_structure_state = self._get_next_state()
+        self._prune(self.next_structure_state)
+        if next_structure_state is None:
+            next_structure_state = self._get_next_state()
+        self.next_structure_state = next_structure_state
         
         self.save_info()
\ No newline at end of file
@@ -1,11 +1,11 @@
 from __future__ import annotations
 import numpy as np
-import random
 from prettytable.prettytable import PrettyTable
 from pymatgen.core import Structure
 from .blankObject import BlankObject
 from utilitys.formatUtilitys import Functions
-from ase.neighborlist import NeighborList
+from .neighborTopology import NeighborTopology
+from .latticeState import LatticeState
 
 class SpecieIndexesObject(object):
     
@@ -13,8 +13,11 @@ class SpecieIndexesObject(object):
        
         self.specie = specie
         self.indexes_lst = indexes_lst
-        self.max_index = max(self.indexes_lst)
-        self.min_index = min(self.indexes_lst)
+        self.indexes_array = np.asarray(indexes_lst, dtype=np.int64)
+        self.indexes_set = set(indexes_lst)
+        # 半巨正则模式下子晶格中的元素可能暂时没有原子, 此时 min/max 记为 -1
+        self.max_index = max(self.indexes_lst, default=-1)
+        self.min_index = min(self.indexes_lst, default=-1)
 
     def __repr__(self):
         
@@ -29,10 +32,7 @@ class SpecieIndexesObject(object):
         return self.__repr__()
 
     def whether_in(self, index: int) -> bool:
-        if index in self.indexes_lst:
-            return True
-        else:
-            return False
+        return index in self.indexes_set
 
     def dict_index2specie(self):
         index2specie = {}
@@ -49,9 +49,38 @@ class SublatticeObject(object):
         self.atoms_num_inside_sublattice = sum([len(specie_indexes_object.indexes_lst) \
                                     for specie_indexes_object in self.specie_indexes_objects_lst])
         self.min_index = min([specie_indexes_object.min_index \
-                        for specie_indexes_object in self.specie_indexes_objects_lst])
+                        for specie_indexes_object in self.specie_indexes_objects_lst \
+                        if specie_indexes_object.indexes_lst], default=-1)
         self.max_index = max([specie_indexes_object.max_index \
                         for specie_indexes_object in self.specie_indexes_objects_lst])
+        self._build_index()
+
+    def _build_index(self):
+        '''
+        预先建立子晶格的 NumPy 位点索引:
+            indexes_array: 子晶格全部位点; species_codes: 各位点元素在子晶格中的编号;
+            partner_indexes[code]: 与第 code 种元素可交换(元素不同)的位点
+        '''
+        self.indexes_array = np.concatenate([specie_indexes_object.indexes_array \
+                                for specie_indexes_object in self.specie_indexes_objects_lst])
+        self.species_codes = np.concatenate([np.full(len(specie_indexes_object.indexes_array), code) \
+                                for code, specie_indexes_object in enumerate(self.specie_indexes_objects_lst)])
+        self.partner_indexes = [self.indexes_array[self.species_codes != code] \
+                                for code in range(len(self.specie_indexes_objects_lst))]
+        # site_codes[index]: 位点 index 的元素编号, 不属于该子晶格为 -1
+        self.site_codes = np.full(self.max_index + 1, -1, dtype=np.int64)
+        self.site_codes[self.indexes_array] = self.species_codes
+        self.neighbor_topology = None
+
+    def codes_of(self, indexes) -> np.ndarray:
+        '''
+        返回各位点在子晶格中的元素编号, 不属于该子晶格的位点为 -1
+        '''
+        indexes = np.asarray(indexes, dtype=np.int64)
+        codes = np.full(len(indexes), -1, dtype=np.int64)
+        inside = indexes <= self.max_index
+        codes[inside] = self.site_codes[indexes[inside]]
+        return codes
 
     def __repr__(self):
         
@@ -69,15 +98,22 @@ class SublatticeObject(object):
     def from_file(cls, poscar_path: str, species_inside_sublattice_lst: list) -> SublatticeObject:
         
         structure = Structure.from_file(poscar_path)
-        all_species_lst = [specie.symbol for specie in structure.species]
-        all_indexes_lst = [i for i in range(len(all_species_lst))]
+        return cls.from_structure(structure=structure,
+                                  species_inside_sublattice_lst=species_inside_sublattice_lst)
+
+    @classmethod
+    def from_structure(cls, structure: Structure, species_inside_sublattice_lst: list) -> SublatticeObject:
+        '''
+        structure 也可以是 LatticeState, 直接由占据数组建立索引
+        '''
+        if isinstance(structure, LatticeState):
+            all_species_array = structure.symbols
+        else:
+            all_species_array = np.array([specie.symbol for specie in structure.species])
 
         indexes_lsts_lst = []
         for i in range(len(species_inside_sublattice_lst)):
-            indexes_lst = []
-            for index in range(len(all_indexes_lst)):
-                if (all_species_lst[index] == species_inside_sublattice_lst[i]):
-                    indexes_lst.append(index)
+            indexes_lst = np.flatnonzero(all_species_array == species_inside_sublattice_lst[i]).tolist()
             indexes_lsts_lst.append(indexes_lst)
         
         specie_indexes_objects_lst = []
@@ -93,63 +129,59 @@ class SublatticeObject(object):
         return_object.atoms_num_inside_sublattice = sum([len(specie_indexes_object.indexes_lst) \
                                     for specie_indexes_object in return_object.specie_indexes_objects_lst])
         return_object.min_index = min([specie_indexes_object.min_index \
-                        for specie_indexes_object in return_object.specie_indexes_objects_lst])
+                        for specie_indexes_object in return_object.specie_indexes_objects_lst \
+                        if specie_indexes_object.indexes_lst], default=-1)
         return_object.max_index = max([specie_indexes_object.max_index \
                         for specie_indexes_object in return_object.specie_indexes_objects_lst])
 
         return_object.__class__ = cls
+        return_object._build_index()
         
         return return_object
         
-    def choose_anthor_atom(self, first_atom_index,structure,cutoff=float(5)):
+    def choose_anthor_atom(self, first_atom_index,structure,cutoff=float(5),neighbor_topology:NeighborTopology=None,
+                           rng:np.random.Generator=None):
+        '''
+        Description
+        -----------
+            1. 在 first_atom_index 的 cutoff 范围内, 随机选择同一子晶格中元素不同的原子
+            2. 邻居由缓存的 NeighborTopology 给出, 不再每次重建 NeighborList
 
-        all_atom_indexes_lst = list(np.arange(self.min_index, self.max_index + 1))
+        Return
+        ------
+            1. second_atom_index: int
+            2. neighbors: list
+                cutoff 内全部可交换的原子序号
+        '''
+        if not self.whether_in(first_atom_index):
+            raise ValueError("Atom {0} is not inside sublattice {1}".format(
+                                first_atom_index, self.species_inside_sublattice_lst))
 
-        try:
-            assert ( first_atom_index in all_atom_indexes_lst )
-        except Exception as e:
-            pass   
-            raise (e)
-        
-        neighbors=[]
-        out=[]
-        while len(neighbors) == 0:
-            neighbors = self.find_neighbors(first_atom_index,structure,cutoff)
-
-            for id in neighbors:
-                i=0
-                for specie_indexes_object in self.specie_indexes_objects_lst:
-                    if (not specie_indexes_object.whether_in(id)):
-                        i+=1
-                    if i == int(len(self.species_inside_sublattice_lst)):
-                        out.append(id)
-
-        for i in out:
-            if i in neighbors:
-                neighbors.remove(i)
-
-        second_atom_index = random.choice(neighbors)
+        neighbors = np.asarray(self.find_neighbors(first_atom_index,structure,cutoff,neighbor_topology), dtype=np.int64)
+        codes = self.codes_of(neighbors)
+        first_code = self.site_codes[first_atom_index]
+        neighbors = neighbors[(codes >= 0) & (codes != first_code)].tolist()
+        if len(neighbors) == 0:
+            raise ValueError("No exchangeable neighbor of atom {0} within {1} Å".format(first_atom_index, cutoff))
+
+        second_atom_index = int((np.random if rng is None else rng).choice(neighbors))
         
         return second_atom_index,neighbors
 
-    def find_neighbors(self,first_atom_index,structure,cutoff=float(5)):
-        ase_stru = Structure.to_ase_atoms(structure)
-
-        cutoffs = [float(cutoff)/2] * len(ase_stru)
-        nl = NeighborList(cutoffs)
-        nl.update(ase_stru)
-        indices, offsets = nl.get_neighbors(int(first_atom_index))
+    def find_neighbors(self,first_atom_index,structure,cutoff=float(5),neighbor_topology:NeighborTopology=None):
+        '''
+        neighbor_topology 为 None 时使用(并缓存)本子晶格上一次建立的拓扑
+        '''
+        if neighbor_topology is None:
+            neighbor_topology = self.neighbor_topology
+        self.neighbor_topology = NeighborTopology.ensure(neighbor_topology, structure, cutoff)
 
-        neighbors = indices.tolist()
+        neighbors = self.neighbor_topology.neighbors(int(first_atom_index)).tolist()
         
         return neighbors
     
     def whether_in(self, index: int)  -> bool:
-        mark = False
-        for specie_indexes_object in self.specie_indexes_objects_lst:
-            if ( specie_indexes_object.whether_in(index) ):
-                mark = True
-        return mark
+        return (0 <= index <= self.max_index) and bool(self.site_codes[index] >= 0)
     
     def dict_index2specie(self):
         dict_index2specie = {}
@@ -185,9 +217,18 @@ class StructureSublatticeObject(object):
     
     @classmethod
     def from_file(cls, poscar_path: str, sublattices_symbols_lst: list) -> StructureSublatticeObject:
+        structure = Structure.from_file(poscar_path)
+        return cls.from_structure(structure=structure,
+                                  sublattices_symbols_lst=sublattices_symbols_lst)
+
+    @classmethod
+    def from_structure(cls, structure: Structure, sublattices_symbols_lst: list) -> StructureSublatticeObject:
+        '''
+        structure 可以是 pymatgen.Structure 或 LatticeState
+        '''
         sublattice_objects_lst = []
         for sublattice_symbols_lst in sublattices_symbols_lst:
-            sublattice_object = SublatticeObject.from_file(poscar_path = poscar_path,
+            sublattice_object = SublatticeObject.from_structure(structure = structure,
                                                         species_inside_sublattice_lst = sublattice_symbols_lst)
             sublattice_objects_lst.append(sublattice_object)
 
@@ -203,6 +244,24 @@ class StructureSublatticeObject(object):
 
         return return_object
 
+    def exchangeable_entries(self, diffusion_specie: str = None) -> list:
+        '''
+        Return
+        ------
+            1. entries: list
+                [(sublattice_object, code), ...], 第 code 种元素至少有一个位点, 且同一子晶格内存在可交换的其他元素;
+                diffusion_specie 不为 None 时只保留该元素
+        '''
+        entries = []
+        for sublattice_object in self.sublattice_objects_lst:
+            for code, specie_indexes_object in enumerate(sublattice_object.specie_indexes_objects_lst):
+                if (diffusion_specie is not None) and (specie_indexes_object.specie != diffusion_specie):
+                    continue
+                if len(specie_indexes_object.indexes_array) == 0 or len(sublattice_object.partner_indexes[code]) == 0:
+                    continue
+                entries.append((sublattice_object, code))
+        return entries
+
     def dict_index2specie(self):
         dict_index2specie = {}
         for sublattice_object in self.sublattice_objects_lst:
@@ -0,0 +1,314 @@
+from __future__ import annotations
+import os
+import json
+import struct
+import numpy as np
+from pymatgen.core import Structure, Lattice
+from .latticeState import LatticeState
+from utilitys.phaseTimer import PhaseTimer
+
+
+class TrajectoryStore(object):
+    '''
+    Description
+    -----------
+        1. 每次搜索一个只追加的二进制轨迹文件 (搜索总目录下的 trajectory.bin), 代替每一步一个文件夹
+        2. 文件 = 文件头 (MAGIC + 头长度 + JSON: 参考位点、元素表、记录格式) + 定长记录, 可直接以 numpy.memmap 读取
+        3. 每条记录: 步数、E_1、E_2、接受概率、是否接受、耗时、能量来源、各参考位点的占据(元素表中的序号),
+            以及可选的弛豫后晶格与分数坐标 (store_positions=True)
+        4. 各结构的原子按最小镜像距离映射到参考位点 (与 EnergyCache 相同), 未被占据的位点记为 vac_as;
+            无法映射时占据记为 -1
+        5. 读取见 `TrajectoryReader`
+
+    Attributes
+    ----------
+        1. self.path: str
+            轨迹文件路径
+        2. self.reference: pymatgen.core.Structure
+            参考结构(含空位位点)
+        3. self.species: list
+            元素表, 占据以其中的序号保存
+        4. self.store_positions: bool
+            是否保存弛豫后的晶格与分数坐标
+        5. self.tolerance: float
+            位点映射允许的最大位移 (Å), None 时为最近位点距离的一半
+    '''
+    FILENAME = "trajectory.bin"
+    MAGIC = b"HTMCTRJ1"
+    ALIGNMENT = 64
+
+    def __init__(self, path: str, reference: Structure, species: list = None, vac_as: str = "V",
+                 store_positions: bool = True, append: bool = False, tolerance: float = None):
+        self.path = path
+        self.vac_as = vac_as
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            header, self.offset = self.read_header(path)
+            self._load_header(header)
+            # 中断时可能留下不完整的最后一条记录
+            num_records = (os.path.getsize(path) - self.offset) // self.dtype.itemsize
+            os.truncate(path, self.offset + num_records * self.dtype.itemsize)
+            self.num_records = num_records
+        else:
+            species = sorted(set(species or []) | {site.species_string for site in reference} | {vac_as})
+            header = {"version": 1,
+                      "vac_as": vac_as,
+                      "species": species,
+                      "store_positions": bool(store_positions),
+                      "reference": reference.as_dict()}
+            self._load_header(header)
+            self.offset = self.write_header(path, header)
+            self.num_records = 0
+
+        if tolerance is None:
+            distance_matrix = self.reference.distance_matrix
+            tolerance = 0.5 * distance_matrix[distance_matrix > 1e-8].min(initial=np.inf)
+        self.tolerance = tolerance
+        self.file = open(path, "ab")
+
+    @classmethod
+    def from_run_root(cls, vasp_folders_path: str, reference: Structure, **kwargs) -> TrajectoryStore:
+        return cls(os.path.join(vasp_folders_path, cls.FILENAME), reference, **kwargs)
+
+    def _load_header(self, header: dict):
+        self.header = header
+        self.vac_as = header["vac_as"]
+        self.species = header["species"]
+        self.species_index = {specie: index for index, specie in enumerate(self.species)}
+        self.store_positions = header["store_positions"]
+        self.reference = Structure.from_dict(header["reference"])
+        self.reference_frac_coords = self.reference.frac_coords
+        self.reference_matrix = self.reference.lattice.matrix
+        self.dtype = self.record_dtype(len(self.reference), self.store_positions)
+
+    @staticmethod
+    def record_dtype(num_sites: int, store_positions: bool) -> np.dtype:
+        fields = [("step", "<i8"),
+                  ("E1", "<f8"),
+                  ("E2", "<f8"),
+                  ("possibility", "<f8"),
+                  ("accepted", "i1"),
+                  ("time", "<f8"),
+                  ("provenance", "S32"),
+                  ("occupation", "i1", (num_sites,))]
+        if store_positions:
+            fields += [("lattice", "<f8", (3, 3)),
+                       ("frac_coords", "<f4", (num_sites, 3))]
+        return np.dtype(fields)
+
+    @classmethod
+    def write_header(cls, path: str, header: dict) -> int:
+        data = json.dumps(header).encode()
+        offset = len(cls.MAGIC) + 8 + len(data)
+        data += b" " * (-offset % cls.ALIGNMENT)
+        with open(path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack("<Q", len(data)))
+            f.write(data)
+        return len(cls.MAGIC) + 8 + len(data)
+
+    @classmethod
+    def read_header(cls, path: str):
+        '''
+        Return
+        ------
+            1. header: dict
+            2. offset: int
+                第一条记录的字节偏移
+        '''
+        with open(path, "rb") as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError("Not a trajectory file: {0}".format(path))
+            length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(length).decode())
+        return header, len(cls.MAGIC) + 8 + length
+
+    def assign(self, structure: Structure) -> np.ndarray:
+        '''
+        Return
+        ------
+            1. mapping: np.ndarray or None
+                第 i 个原子对应的参考位点; 位移超过 tolerance 或两个原子映射到同一位点时返回 None
+        '''
+        diff = structure.frac_coords[:, None, :] - self.reference_frac_coords[None, :, :]
+        diff -= np.round(diff)
+        distances = np.sqrt(((diff @ self.reference_matrix) ** 2).sum(axis=-1))
+        mapping = distances.argmin(axis=1)
+        if distances[np.arange(len(mapping)), mapping].max(initial=0.0) > self.tolerance:
+            return None
+        if len(np.unique(mapping)) != len(mapping):
+            return None
+        return mapping
+
+    @PhaseTimer.timed("write_trajectory")
+    def append(self, step: int, E_1: float, E_2: float, possibility: float, accepted: bool,
+               structure: Structure = None, relaxed_structure: Structure = None,
+               execution_time: float = None, provenance: str = None, mapping: np.ndarray = None):
+        '''
+        Parameters
+        ----------
+            1. structure: pymatgen.core.Structure or LatticeState
+                本步的试探结构(弛豫前); 可以包含空位位点, 也可以不包含
+            2. relaxed_structure: pymatgen.core.Structure
+                弛豫后的结构, 原子顺序须与 structure 一致; None 时不保存坐标
+            3. mapping: np.ndarray
+                structure 各原子对应的参考位点; None 时按最小镜像距离确定
+                (内存模式下原子顺序不变, 由调用者给出)
+        '''
+        record = np.zeros((), dtype=self.dtype)
+        record["step"] = step
+        record["E1"] = np.nan if E_1 is None else float(E_1)
+        record["E2"] = np.nan if E_2 is None else float(E_2)
+        record["possibility"] = possibility
+        record["accepted"] = int(accepted)
+        record["time"] = np.nan if execution_time is None else execution_time
+        record["provenance"] = (provenance or "").encode()[:32]
+
+        record["occupation"] = -1
+        if structure is not None:
+            if mapping is None:
+                mapping = self.assign(structure)
+            if mapping is not None:
+                record["occupation"] = self.species_index[self.vac_as]
+                if isinstance(structure, LatticeState):
+                    record["occupation"][mapping] = structure.codes_in(self.species_index)
+                else:
+                    record["occupation"][mapping] = [self.species_index[site.species_string] for site in structure]
+        if self.store_positions:
+            record["lattice"] = np.nan
+            record["frac_coords"] = np.nan
+            if (relaxed_structure is not None) and (mapping is not None):
+                record["lattice"] = relaxed_structure.lattice.matrix
+                record["frac_coords"][mapping] = relaxed_structure.frac_coords
+
+        self.file.write(record.tobytes())
+        self.file.flush()
+        self.num_records += 1
+
+    def truncate(self, num_records: int):
+        '''
+        截去第 num_records 条之后的记录 (续算时回到检查点)
+        '''
+        if num_records > self.num_records:
+            raise ValueError("Trajectory {0} has only {1} records, cannot truncate to {2}".format(
+                                self.path, self.num_records, num_records))
+        self.file.flush()
+        os.truncate(self.path, self.offset + num_records * self.dtype.itemsize)
+        self.num_records = num_records
+
+    def close(self):
+        self.file.close()
+
+
+class TrajectoryReader(object):
+    '''
+    Description
+    -----------
+        1. 以 numpy.memmap 读取 `TrajectoryStore` 写出的轨迹文件, 各字段为按步数排列的数组
+        2. `self.structure(i)` 由占据(与可选的弛豫坐标)还原第 i 条记录的结构
+
+    Attributes
+    ----------
+        1. self.records: np.ndarray
+            结构化数组 (step, E1, E2, possibility, accepted, time, provenance, occupation[, lattice, frac_coords])
+        2. self.reference / self.species / self.vac_as:
+            同 `TrajectoryStore`
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.header, offset = TrajectoryStore.read_header(path)
+        self.vac_as = self.header["vac_as"]
+        self.species = self.header["species"]
+        self.store_positions = self.header["store_positions"]
+        self.reference = Structure.from_dict(self.header["reference"])
+        dtype = TrajectoryStore.record_dtype(len(self.reference), self.store_positions)
+        num_records = (os.path.getsize(path) - offset) // dtype.itemsize
+        if num_records > 0:
+            self.records = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(num_records,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+
+    @classmethod
+    def from_run_root(cls, vasp_folders_path: str) -> TrajectoryReader:
+        return cls(os.path.join(vasp_folders_path, TrajectoryStore.FILENAME))
+
+    @staticmethod
+    def exists(vasp_folders_path: str) -> bool:
+        return os.path.isfile(os.path.join(vasp_folders_path, TrajectoryStore.FILENAME))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    @property
+    def steps(self) -> np.ndarray:
+        return np.asarray(self.records["step"])
+
+    @property
+    def accepted(self) -> np.ndarray:
+        return np.asarray(self.records["accepted"]).astype(bool)
+
+    @property
+    def possibility(self) -> np.ndarray:
+        return np.asarray(self.records["possibility"])
+
+    @property
+    def time(self) -> np.ndarray:
+        return np.asarray(self.records["time"])
+
+    @property
+    def occupations(self) -> np.ndarray:
+        return np.asarray(self.records["occupation"])
+
+    @property
+    def provenance(self) -> list:
+        return [value.decode() for value in self.records["provenance"]]
+
+    def energies(self) -> np.ndarray:
+        '''
+        每一步之后的当前能量 (接受取 E_2, 拒绝保持 E_1)
+        '''
+        return np.where(self.accepted, self.records["E2"], self.records["E1"])
+
+    def compositions(self) -> np.ndarray:
+        '''
+        每一步之后当前结构中各元素 (self.species 的顺序, 含空位) 的原子数, 形状为 (记录数, 元素数);
+        记录中保存的是试探结构的占据, 拒绝的步取上一个被接受的记录 (半巨正则模式下组成随步数变化);
+        第一个被接受的记录之前取参考结构 (初始结构) 的组成
+        '''
+        occupations = self.occupations
+        counts = np.stack([(occupations == code).sum(axis=1) for code in range(len(self.species))], axis=1)
+        initial = np.array([[sum(site.species_string == specie for site in self.reference)
+                             for specie in self.species]])
+        #尚无被接受的记录时序号为 -1, 即最后一行的初始组成
+        last_accepted = np.maximum.accumulate(np.where(self.accepted, np.arange(len(self)), -1))
+        return np.concatenate([counts, initial])[last_accepted]
+
+    def structure(self, index: int, relaxed: bool = True, with_vacancies: bool = False) -> Structure:
+        '''
+        Parameters
+        ----------
+            1. relaxed: bool
+                True 且保存了坐标时返回弛豫后的结构, 否则为参考位点上的结构
+            2. with_vacancies: bool
+                是否保留空位(vac_as)位点
+        '''
+        record = self.records[index]
+        occupation = np.asarray(record["occupation"])
+        if (occupation < 0).any():
+            raise ValueError("Occupation of record {0} is unknown".format(index))
+        species = [self.species[i] for i in occupation]
+        lattice = self.reference.lattice
+        frac_coords = self.reference.frac_coords
+        if relaxed and self.store_positions and not np.isnan(record["lattice"]).any():
+            lattice = Lattice(np.asarray(record["lattice"]))
+            relaxed_frac_coords = np.asarray(record["frac_coords"], dtype=float)
+            known = ~np.isnan(relaxed_frac_coords).any(axis=1)
+            frac_coords = np.where(known[:, None], relaxed_frac_coords, frac_coords)
+        kept = [i for i, specie in enumerate(species) if with_vacancies or specie != self.vac_as]
+        return Structure(lattice, [species[i] for i in kept], frac_coords[kept])
+
+    def structures(self, relaxed: bool = True, with_vacancies: bool = False):
+        for index in range(len(self)):
+            yield self.structure(index, relaxed=relaxed, with_vacancies=with_vacancies)
@@ -29,7 +29,12 @@ vac_as = "V"
 from_contcar = True
 load = False
 
-#6.程序加载与启动
+#6.弛豫设置(chgnet/mattersim)
+relax_policy = 'converge' #'none'(单点能) / 'fixed_steps' / 'converge'
+relax_steps = 50 #'fixed_steps' 的弛豫步数上限
+max_relax_steps = 500 #'converge' 的弛豫步数上限
+
+#7.程序加载与启动
 def run():
     metropolis_mc = Metropolis(pbs_nodefile=PBS_NODEFILE,
                                 np=NP,
@@ -50,7 +55,10 @@ def run():
                     time_save=True,
                     open_diffusion=False,
                     diffusion_specie=None,
-                    exchange_times=1
+                    exchange_times=1,
+                    relax_policy=relax_policy,
+                    relax_steps=relax_steps,
+                    max_relax_steps=max_relax_steps
                     ) 
 
 if __name__ == "__main__":
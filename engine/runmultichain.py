@@ -0,0 +1,65 @@
+import sys
+from MCobjects.MultiChain.main import MultiChain
+
+
+#1.文件路径设置
+poscar_path = r"D:\Desk\新建文件夹 (3)\0\POSCAR"
+
+#2.筛选温度与链数设置
+num_loops = 4000
+T = 444
+num_chains = 16
+seed = 0
+
+#3.MC-搜索位点
+sublattice_symbols_lst = [
+                        ["Sc","Sb"],
+                             ]
+elements_str_for_vaspkit = "Sc Sb Te"
+
+#4.模型加载
+load_model = 'mattersim' #/'chgnet'
+load_path='MatterSim-v1.0.0-5M.pth'
+
+#5.空位缺陷开关和其余设置
+vac_dope =False
+vac_as = "V"
+from_contcar = True
+load = False
+
+#6.弛豫设置(chgnet/mattersim)
+relax_policy = 'converge' #'none'(单点能) / 'fixed_steps' / 'converge'
+relax_steps = 50 #'fixed_steps' 的弛豫步数上限
+max_relax_steps = 500 #'converge' 的弛豫步数上限
+
+#7.程序加载与启动
+def run():
+    multi_mc = MultiChain(num_workers=None,
+                          num_threads=4)
+
+    multi_mc.run(
+            poscar_path=poscar_path,
+            num_loops=num_loops,
+            T=T,
+            num_chains=num_chains,
+            sublattice_symbols_lst=sublattice_symbols_lst,
+            from_contcar=from_contcar,
+            elements_str_for_vaspkit=elements_str_for_vaspkit,
+            load=load,
+            load_model=load_model,
+            load_path = load_path,
+            seed=seed,
+            burn_in=500,
+            vac_dope = vac_dope,
+            vac_as=vac_as,
+            time_save=True,
+            open_diffusion=False,
+            diffusion_specie=None,
+            exchange_times=1,
+            relax_policy=relax_policy,
+            relax_steps=relax_steps,
+            max_relax_steps=max_relax_steps
+            )
+
+if __name__ == "__main__":
+    run()
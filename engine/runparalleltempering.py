@@ -0,0 +1,61 @@
+import sys
+from MCobjects.ParallelTempering.main import ParallelTempering
+
+
+#1.文件路径设置
+poscar_path = r"D:\Desk\新建文件夹 (3)\0\POSCAR"
+
+#2.温度梯度与交换设置
+num_loops = 4000
+T_lst = ParallelTempering.geometric_ladder(300, 1500, 8)
+swap_interval = 10
+
+#3.MC-搜索位点
+sublattice_symbols_lst = [
+                        ["Sc","Sb"],
+                             ]
+elements_str_for_vaspkit = "Sc Sb Te"
+
+#4.模型加载
+load_model = 'mattersim' #/'chgnet'
+load_path='MatterSim-v1.0.0-5M.pth'
+
+#5.空位缺陷开关和其余设置
+vac_dope =False
+vac_as = "V"
+from_contcar = True
+
+#6.弛豫设置(chgnet/mattersim)
+relax_policy = 'converge' #'none'(单点能) / 'fixed_steps' / 'converge'
+relax_steps = 50 #'fixed_steps' 的弛豫步数上限
+max_relax_steps = 500 #'converge' 的弛豫步数上限
+
+#7.程序加载与启动
+def run():
+    pt_mc = ParallelTempering(num_workers=None,
+                              num_threads=4)
+
+    pt_mc.run(
+            poscar_path=poscar_path,
+            num_loops=num_loops,
+            T_lst=T_lst,
+            sublattice_symbols_lst=sublattice_symbols_lst,
+            from_contcar=from_contcar,
+            elements_str_for_vaspkit=elements_str_for_vaspkit,
+            load_model=load_model,
+            load_path = load_path,
+            swap_interval=swap_interval,
+            vac_dope = vac_dope,
+            vac_as=vac_as,
+            time_save=True,
+            open_diffusion=False,
+            diffusion_specie=None,
+            exchange_times=1,
+            seed=0,
+            relax_policy=relax_policy,
+            relax_steps=relax_steps,
+            max_relax_steps=max_relax_steps
+            )
+
+if __name__ == "__main__":
+    run()
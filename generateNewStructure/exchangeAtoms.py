@@ -1,21 +1,25 @@
-from turtle import distance
 import numpy as np
-import random
+import itertools
 import os
 import logging
 
 import shutil
 
 from pymatgen.core import Structure
-from copy import deepcopy
 from pymatgen.io.vasp.inputs import Poscar
 
 
 from cores.sublatticeObject import StructureSublatticeObject
+from cores.blankObject import BlankObject
+from cores.neighborTopology import NeighborTopology
+from cores.latticeState import LatticeState
 from logger.loggerForGenerator import LoggerForExchangeAtoms
-from utilitys.mpirunContext import PwdContext
 
-from generateNewStructure.pos_convert import poscar_convert
+from generateNewStructure.poscarWriter import PoscarWriter
+from utilitys.phaseTimer import PhaseTimer
+
+#逐次抽样的调试信息, 只在 verbosity='debug' 时写入 run.log (见 logger.runLogger)
+logger = logging.getLogger("pyMC.exchange")
 
 
 class ExchangeAtoms(object):
@@ -30,16 +34,25 @@ class ExchangeAtoms(object):
             The folder which includes INCAR, POSCAR, POTCAR ...
         2. self.vasp_folders_path: str
             The folder which includes many vasp folders
-        3. self.structure: pymatgen.core.Structure
-            The current structure (before exchanging two atoms)
+        3. self.state: cores.latticeState.LatticeState
+            The current structure (before exchanging two atoms), 以占据数组表示;
+            self.structure 为由它生成的 pymatgen.core.Structure
         4. self.structure_index: str
             The index of current structure (before exchanging two atoms)
         5. self.structure_sublattcie_object: pyMC.cores.StructureSublatticeObject
             
         6. self.log_file_path: str
             The path of the log file
+        7. self.rng: np.random.Generator
+            交换原子时使用的随机数生成器 (None 时为 np.random 的全局状态)
+        8. self.exchanged_coords: np.ndarray
+            上一次 `self._exchange` 交换的位点的笛卡尔坐标 (局部弛豫的中心)
     '''
-    def __init__(self, poscar_path: str, sublattices_symbols_lst: list, vac_dope=False,load_CHGnet=False,vac_as="V"):
+    IMAGES = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+
+    def __init__(self, poscar_path: str, sublattices_symbols_lst: list, vac_dope=False,load_CHGnet=False,vac_as="V",
+                 neighbor_topology:NeighborTopology=None, rng:np.random.Generator=None,
+                 lattice_state:LatticeState=None, vac_process_files:bool=False):
         '''
         Parameters
         ----------
@@ -49,6 +62,15 @@ class ExchangeAtoms(object):
                 可以交换的 sublattice 所包含的元素
                 [ ["Re", "Nb"], 
                   ["S", "Se"] ]
+            3. neighbor_topology: NeighborTopology
+                上一步缓存的 cutoff 邻居拓扑, 位点移动不超过容差时直接复用
+            4. rng: np.random.Generator
+                各链独立的随机数生成器, 使搜索可由种子复现
+            5. lattice_state: LatticeState
+                poscar_path 对应的结构已读取过时 (如上一步被拒绝), 直接使用它, 不再读取文件
+            6. vac_process_files: bool
+                vac_dope=True 时是否写出空位的中间文件 (process 文件夹、n.vasp 与 n.CONTCAR);
+                空位结构总是在内存中由空位掩码得到 (见 `self.vacancy_state` 与 `self.Vac_del`)
         '''
         self.vasp_folder_path = os.path.dirname(poscar_path)
         self.vasp_folders_path = os.path.dirname(self.vasp_folder_path)
@@ -59,16 +81,83 @@ class ExchangeAtoms(object):
         self.load_CHGnet = load_CHGnet
         
         self.vac_as = vac_as
-        if self.vac_dope:
-            poscar_path = self.vac_path_deal()
-        
-
-        self.structure = Structure.from_file(poscar_path)  #from_CONTCAR
-        print('5,得到路径','\n',)
+        self.vac_process_files = vac_process_files
+        if lattice_state is None:
+            if self.vac_dope:
+                lattice_state = self.vacancy_state(poscar_path)
+            else:
+                lattice_state = LatticeState.from_structure(Structure.from_file(poscar_path))  #from_CONTCAR
+        self.state = lattice_state
+        logger.debug('5,得到路径')
         self.structure_sublattice_object = \
-            StructureSublatticeObject.from_file(poscar_path=poscar_path,
+            StructureSublatticeObject.from_structure(structure=self.state,
                                             sublattices_symbols_lst=sublattices_symbols_lst)     #得到最大最小的原子序列，用于随机交换
         self.sublattices = sublattices_symbols_lst
+        self.neighbor_topology = neighbor_topology
+        self.rng = np.random if rng is None else rng
+        self.exchanged_coords = None
+        self._build_distance_arrays()
+
+    @classmethod
+    def from_structure(cls, structure: Structure, vasp_folders_path: str, sublattices_symbols_lst: list,
+                       vac_dope=False, vac_as="V", structure_index: int = 0,
+                       neighbor_topology:NeighborTopology=None,
+                       rng:np.random.Generator=None) -> 'ExchangeAtoms':
+        '''
+        Description
+        -----------
+            1. 内存模式: 直接由 pymatgen.Structure 建立交换器, 不读取 POSCAR/CONTCAR
+        '''
+        return cls.from_state(state=LatticeState.from_structure(structure),
+                              vasp_folders_path=vasp_folders_path,
+                              sublattices_symbols_lst=sublattices_symbols_lst,
+                              vac_dope=vac_dope, vac_as=vac_as, structure_index=structure_index,
+                              neighbor_topology=neighbor_topology, rng=rng)
+
+    @classmethod
+    def from_state(cls, state: LatticeState, vasp_folders_path: str, sublattices_symbols_lst: list,
+                   vac_dope=False, vac_as="V", structure_index: int = 0,
+                   neighbor_topology:NeighborTopology=None,
+                   rng:np.random.Generator=None) -> 'ExchangeAtoms':
+        '''
+        Description
+        -----------
+            1. 内存模式: state 为工作状态 (与调用者共享), 交换在其占据数组上原位进行 (见 `self.apply_exchange`)
+        '''
+        return_object = BlankObject()
+        return_object.vasp_folders_path = vasp_folders_path
+        return_object.vasp_folder_path = os.path.join(vasp_folders_path, str(structure_index))
+        return_object.structure_index = structure_index
+        return_object.log_file_path = None
+        return_object.vac_dope = vac_dope
+        return_object.load_CHGnet = False
+        return_object.vac_as = vac_as
+        return_object.vac_process_files = False
+        return_object.state = state
+        return_object.structure_sublattice_object = \
+            StructureSublatticeObject.from_structure(structure=state,
+                                                     sublattices_symbols_lst=sublattices_symbols_lst)
+        return_object.sublattices = sublattices_symbols_lst
+        return_object.neighbor_topology = neighbor_topology
+        return_object.rng = np.random if rng is None else rng
+        return_object.exchanged_coords = None
+        return_object.__class__ = cls
+        return_object._build_distance_arrays()
+
+        return return_object
+
+    @property
+    def structure(self) -> Structure:
+        return self.state.to_structure()
+
+    def refresh(self):
+        '''
+        原位交换被接受后, 根据 self.state 重新建立各元素的位点索引
+        '''
+        self.structure_sublattice_object = \
+            StructureSublatticeObject.from_structure(structure=self.state,
+                                                     sublattices_symbols_lst=self.sublattices)
+        self._build_distance_arrays()
 
     def _choose_two_atoms(self,diffusion_specie:str=None,*,with_cutoff:bool=False,cutoff:float=5.0):
         '''
@@ -76,90 +165,83 @@ class ExchangeAtoms(object):
         ----
             1. 选择的两个原子应该属于一个 sublattice, 并且不是同一种元素
             2. 指定一个diffusion_specie必定参与交换
+            3. 位点索引由 SublatticeObject 预先建立, 选择过程不再重试
         
         Return
         ------
             1. 返回两个需要交换的原子, 格式为
                 （第一原子种类, 第一原子index, 第二原子种类, 第二原子index )
+
+        Raise
+        -----
+            1. ValueError: 结构中不存在可交换的原子对
         '''
-        #print('进行choose_two_atoms-----2-StepObject-ExchangeAtoms后'+'\n')
-
-        all_atom_indexes_lst = list( np.arange(self.structure_sublattice_object.min_index,
-                                            self.structure_sublattice_object.max_index + 1) )
-        dict_index2specie = self.structure_sublattice_object.dict_index2specie()  #得到待交换原子索引字典{0:'A',1:'A',...,6:'B',...}
-        all_choose = [item for sublist in self.sublattices for item in sublist]
-        k = 0
-        while True:
-            k+=1
-            print('查找次数：',k)
-            try:
-                first_atom_index_list,first_atom_index,first_atom_specie,dict_del_first = self.get_random_index(dict_index2specie,all_choose,diffusion_specie)
-                
-                if diffusion_specie is not None:
-                    diffusion_specie=diffusion_specie
-                elif diffusion_specie is None:
-                    diffusion_specie = first_atom_specie
-
-                if with_cutoff:           #制作cutoff新dict
-                    distance_dic = self.get_all_distance(first_atom_index,dict_del_first)
-                    dict2={}
-                    for index,dis in distance_dic.items():
-                        if dis < cutoff:      #cutoff
-                            dict2[index]=dis
-                else:
-                    dict2=dict_del_first
-
-
-                if first_atom_specie == diffusion_specie:  #检索第一第二是否有diffusion_specie
-                    new_dic2=dict2
-                else:
-                    new_dic2={}                            
-                    for index,distance in dict2.items():
-                        if self.structure[index].species_string == diffusion_specie:
-                            new_dic2[index]=distance
-                        else:
-                            pass
-
-                second_atom_index = random.choice(list(new_dic2.keys()))
-                second_atom_specie = dict_del_first[second_atom_index]
-                break
-            except Exception as e:
-                print(f"选择失败，重新尝试。Error: {e}")
-                continue  # 重新选择
-        
-        return first_atom_specie, first_atom_index, second_atom_specie, second_atom_index
+        entries = self.structure_sublattice_object.exchangeable_entries(diffusion_specie)
+        self.rng.shuffle(entries)
+
+        for sublattice_object, code in entries:
+            first_atom_specie = sublattice_object.specie_indexes_objects_lst[code].specie
+            first_indexes = sublattice_object.specie_indexes_objects_lst[code].indexes_array
+            second_indexes = sublattice_object.partner_indexes[code]
+
+            if not with_cutoff:
+                first_atom_index = int(self.rng.choice(first_indexes))
+            else:
+                first_atom_index, second_indexes = self._choose_within_cutoff(sublattice_object, code, cutoff)
+                if first_atom_index is None:
+                    continue
 
+            second_atom_index = int(self.rng.choice(second_indexes))
+            second_atom_specie = self.state.symbol(second_atom_index)
+            return first_atom_specie, first_atom_index, second_atom_specie, second_atom_index
 
-    def get_random_index(self,dict,all_choose,diffusion_specie:str=None):
+        raise ValueError("No exchangeable atom pair in structure {0}: sublattices={1}, diffusion_specie={2}, cutoff={3}".format(
+                            self.structure_index, self.sublattices, diffusion_specie, cutoff if with_cutoff else None))
+
+    def _choose_within_cutoff(self,sublattice_object,code:int,cutoff:float):
         '''
-        添加代码即可指定diffusion_specie为第一交换元素
+        随机选择第 code 种元素的一个原子, 返回其 cutoff 内可交换的原子;
+        若该原子 cutoff 内没有可交换原子, 依次检查同种元素的其余位点
         '''
-        if diffusion_specie is not None:
-            diffusion_specie=diffusion_specie
-        elif diffusion_specie is None:
-            diffusion_specie = random.choice(all_choose)
-        print(diffusion_specie)
-        first_atom_index_list = [k for k, v in dict.items() if v == diffusion_specie] #指定第一选择元素即可不停交换某项原子 
-        first_atom_index = random.choice(first_atom_index_list)
-        dict_del_first = {k:v for k,v in dict.items() if v!=diffusion_specie} #删除1号元素序列
-        return first_atom_index_list,first_atom_index,diffusion_specie,dict_del_first
-
-    def get_all_distance(self,center_index,index_dict:dict):
-        structure = deepcopy(self.structure)
-        distance_dic = {}
-        for index,species in index_dict.items():
-            distance = structure.get_distance(center_index, index)
-            distance_dic[index] = distance
-        return distance_dic
+        neighbor_topology = self.get_neighbor_topology(cutoff)
+        first_indexes = sublattice_object.specie_indexes_objects_lst[code].indexes_array
+        for first_atom_index in self.rng.permutation(first_indexes):
+            neighbors = neighbor_topology.neighbors(first_atom_index)
+            codes = sublattice_object.codes_of(neighbors)
+            within_indexes = neighbors[(codes >= 0) & (codes != code)]
+            if len(within_indexes) > 0:
+                return int(first_atom_index), within_indexes
+        return None, None
 
-    def _exchange(self,diffusion_specie:str=None,*,exchange_times:int=1,with_cutoff:bool=False):
+    def get_neighbor_topology(self,cutoff:float=5.0) -> NeighborTopology:
+        self.neighbor_topology = NeighborTopology.ensure(self.neighbor_topology, self.state, cutoff)
+        return self.neighbor_topology
+
+    def _build_distance_arrays(self):
+        self.frac_coords_array = self.state.frac_coords
+        self.lattice_matrix = self.state.lattice.matrix
+        # 弛豫使位点移动超过容差时, 邻居拓扑需要重建
+        if (self.neighbor_topology is not None) and (not self.neighbor_topology.whether_valid(self.state)):
+            self.neighbor_topology = None
+
+    def get_distance_row(self,center_index:int,indexes):
+        '''
+        由晶格矩阵计算 center_index 到 indexes 的最小镜像距离 (向量化, 检查相邻 27 个镜像)
+        '''
+        diff = self.frac_coords_array[indexes] - self.frac_coords_array[center_index]
+        diff -= np.round(diff)
+        cart = (diff[:, None, :] + self.IMAGES[None, :, :]) @ self.lattice_matrix
+        return np.sqrt((cart ** 2).sum(axis=-1)).min(axis=-1)
+
+    def choose_exchange_pairs(self,diffusion_specie:str=None,*,exchange_times:int=1,with_cutoff:bool=False):
         '''
         Return
         ------
-            1. new_structure: pymatgen.core.Structure
-                The new structure (after exchanging)
+            1. pairs: list
+                互不重叠的交换原子对, 每一项为
+                （第一原子种类, 第一原子index, 第二原子种类, 第二原子index )
         '''
-        new_structure = deepcopy(self.structure)
+        pairs = []
         used_indices = set()  #用于记录已经使用过的索引
 
         max_retries = 10
@@ -169,7 +251,7 @@ class ExchangeAtoms(object):
                 # 选择两个原子
                 first_atom_specie, first_atom_index, second_atom_specie, second_atom_index = \
                     self._choose_two_atoms(diffusion_specie,with_cutoff=with_cutoff)
-                print(first_atom_index,second_atom_index,used_indices)
+                logger.debug('抽样: %s %s %s', first_atom_index, second_atom_index, used_indices)
                 # 检查索引是否重复
                 if first_atom_index in used_indices or second_atom_index in used_indices:
                     #print(f"重复的索引: {first_atom_index} 或 {second_atom_index}。重新采样...")
@@ -179,23 +261,101 @@ class ExchangeAtoms(object):
                 # 记录使用的索引
                 used_indices.add(first_atom_index)
                 used_indices.add(second_atom_index)
-                
-                # 执行原子交换
-                new_structure.replace(idx=first_atom_index, species=second_atom_specie)
-                new_structure.replace(idx=second_atom_index, species=first_atom_specie) #老版本为i,新版本为idx
-                print(f'交换:\n{first_atom_specie}:{first_atom_index};\n{second_atom_specie}:{second_atom_index}\n')
-                
-                LoggerForExchangeAtoms.log_output(level=logging.INFO,
-                                                log_file_path=self.log_file_path,
-                                                msg="structure{4} will exchange {0}({1}) and {2}({3}) ".format(
-                                                    first_atom_specie, first_atom_index,
-                                                    second_atom_specie, second_atom_index,
-                                                    self.structure_index
-                                                ))
+                pairs.append((first_atom_specie, first_atom_index, second_atom_specie, second_atom_index))
                 break
 
-        return new_structure
+        return pairs
+
+    def choose_mutation(self,chemical_potentials:dict):
+        '''
+        Description
+        -----------
+            1. 半巨正则的元素替换: 在各子晶格中给出了化学势的元素 (至少两种) 所占的位点中均匀地选择一个,
+                再从同一子晶格的其余这些元素中均匀地选择新元素 (可以是结构中暂时没有的元素或空位 vac_as)
+            2. 可替换的位点集合在替换前后不变, 提议概率对称, 接受判据只需 Δμ (见 Exchange.semi_grand_mark)
+
+        Return
+        ------
+            1. mutation: tuple
+                （原元素, 位点index, 新元素 )
+
+        Raise
+        -----
+            1. ValueError: 没有子晶格包含两种以上给出化学势的元素
+        '''
+        candidates = []
+        for sublattice_object in self.structure_sublattice_object.sublattice_objects_lst:
+            species = [specie for specie in sublattice_object.species_inside_sublattice_lst
+                       if specie in chemical_potentials]
+            if len(species) < 2:
+                continue
+            indexes = np.concatenate([specie_indexes_object.indexes_array
+                                      for specie_indexes_object in sublattice_object.specie_indexes_objects_lst
+                                      if specie_indexes_object.specie in species])
+            candidates.append((species, indexes))
+        num_sites = sum(len(indexes) for _, indexes in candidates)
+        if num_sites == 0:
+            raise ValueError("No mutable site in structure {0}: sublattices={1}, chemical_potentials={2}".format(
+                                self.structure_index, self.sublattices, sorted(chemical_potentials)))
+
+        position = int(self.rng.choice(num_sites))
+        for species, indexes in candidates:
+            if position < len(indexes):
+                break
+            position -= len(indexes)
+        index = int(indexes[position])
+        old_specie = self.state.symbol(index)
+        new_specie = str(self.rng.choice([specie for specie in species if specie != old_specie]))
+        logger.debug('替换: %s:%s -> %s', old_specie, index, new_specie)
+        return old_specie, index, new_specie
+
+    @staticmethod
+    def apply_exchange(structure:Structure,pairs:list):
+        '''
+        Description
+        -----------
+            1. 在 structure 上原位交换 pairs 中的原子对
+            2. 原子对互不重叠, 因此对同一 structure 再调用一次即可还原
+            3. structure 为 LatticeState 时只交换占据数组
+        '''
+        if isinstance(structure, LatticeState):
+            return structure.apply_exchange(pairs)
+        for pair in pairs:
+            first_atom_index, second_atom_index = pair[1], pair[3]
+            first_atom_specie = structure[first_atom_index].species_string
+            second_atom_specie = structure[second_atom_index].species_string
+            structure.replace(idx=first_atom_index, species=second_atom_specie)
+            structure.replace(idx=second_atom_index, species=first_atom_specie) #老版本为i,新版本为idx
+        return structure
+
+    def _exchange(self,diffusion_specie:str=None,*,exchange_times:int=1,with_cutoff:bool=False):
+        '''
+        Return
+        ------
+            1. new_state: cores.latticeState.LatticeState
+                The new structure (after exchanging), 只复制占据数组
+        '''
+        new_state = self.state.copy()
+        pairs = self.choose_exchange_pairs(diffusion_specie,exchange_times=exchange_times,with_cutoff=with_cutoff)
+
+        # 执行原子交换
+        new_state.apply_exchange(pairs)
+        #排序与删除空位不改变笛卡尔坐标, 局部弛豫以此确定交换位点
+        self.exchanged_coords = new_state.cart_coords[[index for pair in pairs for index in (pair[1], pair[3])]]
+        for first_atom_specie, first_atom_index, second_atom_specie, second_atom_index in pairs:
+            logger.debug('交换: %s:%s; %s:%s', first_atom_specie, first_atom_index, second_atom_specie, second_atom_index)
+            
+            LoggerForExchangeAtoms.log_output(level=logging.INFO,
+                                            log_file_path=self.log_file_path,
+                                            msg="structure{4} will exchange {0}({1}) and {2}({3}) ".format(
+                                                first_atom_specie, first_atom_index,
+                                                second_atom_specie, second_atom_index,
+                                                self.structure_index
+                                            ))
+
+        return new_state
     
+    @PhaseTimer.timed("generate_structure")
     def generate_new_structure(self, new_structure_index: int, elements_str_for_vaspkit:str,pick_first_specie:str=None,with_cutoff:bool=False,exchange_times:int=1):
         '''
         Description
@@ -224,94 +384,78 @@ class ExchangeAtoms(object):
             new_structure,V_stru = self.Vac_del(new_structure,new_structure_index,elements_str_for_vaspkit)  #对更换位置后的poscar进行位置删除
             n_poscar = Poscar(V_stru) #有空位坐标
             n_poscar_path = os.path.join(new_vasp_folder_path, str(new_structure_index)+".POSCAR")
-            n_vasp_path = os.path.join(new_vasp_folder_path, str(new_structure_index)+".vasp")
             n_poscar.write_file(n_poscar_path)
-            n_poscar.write_file(n_vasp_path)
+            if self.vac_process_files:
+                n_poscar.write_file(os.path.join(new_vasp_folder_path, str(new_structure_index)+".vasp"))
         elif not self.vac_dope:
             new_structure = self._exchange(pick_first_specie,with_cutoff=with_cutoff,exchange_times=exchange_times)
             new_structure = self.pos_sort(new_structure,elements_str_for_vaspkit)  
         #无空位文件写入
         new_poscar = Poscar(new_structure)
         new_poscar_path = os.path.join(new_vasp_folder_path, "POSCAR")
-        new_poscar.write_file(new_poscar_path)
 
-        #整理 
+        #整理 (按元素顺序写出, 代替 vaspkit 107: POSCAR -> POSCAR_PRI, POSCAR_REV -> POSCAR)
         if not self.vac_dope:
-            pwd_path = os.getcwd()
-            with PwdContext(pwd_path=pwd_path, vasp_folder_path=new_vasp_folder_path) as _:
-                os.system("echo \"107\n{0}\n\" | vaspkit".format(elements_str_for_vaspkit))
-                os.system("mv POSCAR POSCAR_PRI")
-                os.system("mv POSCAR_REV POSCAR") 
+            new_poscar.write_file(os.path.join(new_vasp_folder_path, "POSCAR_PRI"))
+            PoscarWriter.write_file(new_structure, new_poscar_path, elements_str_for_vaspkit)
+        else:
+            new_poscar.write_file(new_poscar_path)
 
-        print('new_poscar_path:'+new_poscar_path +'\n')
+        logger.debug('new_poscar_path: %s', new_poscar_path)
         return new_poscar_path
         
     
-    def Vac_del(self,new_structure,new_structure_index,elements_str_for_vaspkit): 
+    def Vac_del(self,new_structure,new_structure_index,elements_str_for_vaspkit):
         '''
-        根据序列号写入process文件夹中一个n.vasp用于生成POSCAR过渡文件
+        由交换后的占据状态 (LatticeState) 得到 (真实结构, 含空位的完整结构): 按元素顺序排序后以空位掩码去除空位位点,
+        不经过临时文件; vac_process_files=True 时另外在 process 文件夹中写出 n.vasp (无空位) 与 n-with_vac.vasp (有空位)
         '''
-        process = os.path.join(self.vasp_folders_path,'process')
-        if not os.path.exists(process):
-            os.mkdir(process)
-        nvasp = os.path.join(process,str(int(new_structure_index))+".vasp")
-        vesta = os.path.join(process,str(int(new_structure_index))+"-with_vac.vasp")
-        new_structure = self.pos_sort(structure=new_structure,elements_str_for_vaspkit=elements_str_for_vaspkit)
-        V_stru = new_structure       #用于存于下一步n.poscar
-        p = Poscar(new_structure)
-        p2 = Poscar(V_stru)
-        p2.write_file(vesta)    #存于process里一个交换后的n#.vasp文件 有空位
-        p.write_file(nvasp)   #存于process里一个交换后的n.vasp文件  无空位
-        Vac_del = poscar_convert(nvasp,'poscar')
-        Vac_del.poscar_trans()       
-        Vac_del_p = shutil.copy(nvasp, os.path.join(process,'POSCAR')) 
-        new_structure = Structure.from_file(Vac_del_p)
-        return new_structure,V_stru    
-    
+        sorted_state = new_structure.sorted(elements_str_for_vaspkit, self.vac_as)
+        V_stru = sorted_state.to_structure()       #用于存于下一步n.poscar
+        new_structure = sorted_state.to_structure(exclude=self.vac_as)
+        if self.vac_process_files:
+            process = os.path.join(self.vasp_folders_path,'process')
+            if not os.path.exists(process):
+                os.mkdir(process)
+            nvasp = os.path.join(process,str(int(new_structure_index))+".vasp")
+            Poscar(V_stru).write_file(os.path.join(process,str(int(new_structure_index))+"-with_vac.vasp"))
+            Poscar(new_structure).write_file(nvasp)
+            shutil.copy(nvasp, os.path.join(process,'POSCAR'))
+        return new_structure,V_stru
+
     def pos_sort(self,structure,elements_str_for_vaspkit):
         '''
         将元素和坐标按elements_str_for_vaspkit排序
 
-        将空位坐标添加至末尾
+        将空位坐标添加至末尾; structure 为 LatticeState 时先在占据数组上排序, 只生成一次 Structure
         '''
-        new_structure = structure
-        species = new_structure.species
-        coords = new_structure.frac_coords
-        ele_list = elements_str_for_vaspkit.split()
-        sorted_indices=[]
-
-        for ii in range(len(ele_list)):
-            sorted_indices.extend([i for i, specie in enumerate(species) 
-                                if specie.symbol == ele_list[ii]])
-        sorted_indices.extend([i for i, specie in enumerate(species) if self.vac_dope and specie.symbol == self.vac_as])
-
-        sorted_species = [species[i] for i in sorted_indices]
-        sorted_coords = [coords[i] for i in sorted_indices]
-        
-        new_structure = Structure(new_structure.lattice, sorted_species, sorted_coords)
-        return new_structure
+        vac_as = self.vac_as if self.vac_dope else None
+        if isinstance(structure, LatticeState):
+            return structure.sorted(elements_str_for_vaspkit, vac_as).to_structure()
+        return PoscarWriter.sort_structure(structure, elements_str_for_vaspkit, vac_as)
     
-    def vac_path_deal(self):
+    def vacancy_state(self, poscar_path: str) -> LatticeState:
         '''
         Description
         -----------
-        需要准备CONTCAR\n
-        利用CONTCAR -> 空位n.CONTCAR\n
-        用于下一步交换\n
-        return ncon_path
+            1. 含空位的占据状态: 同目录下含空位的 n.POSCAR 给出完整晶格;
+                poscar_path 为 CONTCAR 时, 以其坐标替换非空位位点, 空位保持 n.POSCAR 中的坐标
+            2. CONTCAR 的原子顺序与 n.POSCAR 去除空位后不一致时 (如手动准备的初始文件夹),
+                与原来的 poscar_verse_trans 相同, 将空位坐标补在 CONTCAR 末尾
+            3. 只读取这两个文件; vac_process_files=True 时另外写出 n.CONTCAR
         '''
-        con_path = os.path.join(self.vasp_folder_path,"CONTCAR")
-        ncon_path = os.path.join(self.vasp_folder_path,str(self.structure_index)+".CONTCAR") 
-        npos_name = str(self.structure_index)+'.POSCAR'
-        npos_path = os.path.join(self.vasp_folder_path,npos_name)
-        if not os.path.exists(ncon_path):
-            Vac_del = poscar_convert(npos_path,'poscar')
-            Vac_del.poscar_verse_trans(npos_path,con_path,ncon_path)
-        return ncon_path
-    
-    @staticmethod #useless
-    def new_contcar(npos_path,ncon_path,con_path):
-        Vac_del = poscar_convert(npos_path,'poscar')
-        Vac_del.poscar_verse_trans(npos_path,con_path,ncon_path)
-        return con_path
-    
+        npos_path = os.path.join(self.vasp_folder_path,str(self.structure_index)+'.POSCAR')
+        state = LatticeState.from_structure(Structure.from_file(npos_path))
+        if os.path.basename(poscar_path) != "CONTCAR":
+            return state
+        contcar = Structure.from_file(poscar_path)
+        if [site.species_string for site in contcar] == state.symbols[state.mask(self.vac_as)].tolist():
+            state.set_positions(contcar, exclude=self.vac_as)
+        else:
+            for index in state.indexes_of(self.vac_as):
+                contcar.append(self.vac_as, state.frac_coords[index])
+            state = LatticeState.from_structure(contcar)
+        if self.vac_process_files:
+            Poscar(state.to_structure()).write_file(
+                os.path.join(self.vasp_folder_path,str(self.structure_index)+".CONTCAR"))
+        return state
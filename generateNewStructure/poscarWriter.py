@@ -0,0 +1,79 @@
+import numpy as np
+
+from pymatgen.core import Structure
+
+from utilitys.phaseTimer import PhaseTimer
+
+
+class PoscarWriter(object):
+    '''
+    Description
+    -----------
+        1. 按 elements_str_for_vaspkit 的元素顺序整理原子并写出 POSCAR
+        2. 取代 `echo "107 ..." | vaspkit` (POSCAR -> POSCAR_REV), 不再调用外部程序
+        3. 空位元素(vac_as)排在最后, 未列出的元素被舍去 (与 ExchangeAtoms.pos_sort 一致)
+    '''
+
+    @staticmethod
+    def sort_indices(symbols: list, elements_str_for_vaspkit: str, vac_as: str = None) -> np.ndarray:
+        '''
+        Return
+        ------
+            1. sorted_indices: np.ndarray
+                按元素顺序稳定排序后的原子序号
+        '''
+        ele_list = elements_str_for_vaspkit.split()
+        if (vac_as is not None) and (vac_as not in ele_list):
+            ele_list = ele_list + [vac_as]
+
+        symbols = np.asarray(symbols)
+        codes = np.full(len(symbols), -1, dtype=np.int64)
+        for code, element in enumerate(ele_list):
+            codes[symbols == element] = code
+
+        kept = np.flatnonzero(codes >= 0)
+        return kept[np.argsort(codes[kept], kind="stable")]
+
+    @classmethod
+    def sort_structure(cls, structure: Structure, elements_str_for_vaspkit: str, vac_as: str = None) -> Structure:
+        symbols = [site.specie.symbol for site in structure]
+        sorted_indices = cls.sort_indices(symbols, elements_str_for_vaspkit, vac_as)
+        species = [structure[int(i)].specie for i in sorted_indices]
+        return Structure(structure.lattice, species, structure.frac_coords[sorted_indices])
+
+    @classmethod
+    def to_string(cls, structure: Structure, elements_str_for_vaspkit: str, vac_as: str = None,
+                  comment: str = None) -> str:
+        '''
+        POSCAR_REV 格式: 注释行, 缩放系数, 晶格, 元素行, 数目行, Direct 分数坐标
+        '''
+        structure = cls.sort_structure(structure, elements_str_for_vaspkit, vac_as)
+        symbols = np.array([site.specie.symbol for site in structure])
+
+        # 按排序后相邻的同种元素分组
+        if len(symbols) > 0:
+            starts = np.flatnonzero(np.r_[True, symbols[1:] != symbols[:-1]])
+            counts = np.diff(np.r_[starts, len(symbols)])
+            elements = symbols[starts]
+        else:
+            counts, elements = [], []
+
+        if comment is None:
+            comment = " ".join(elements)
+
+        lines = [comment, "{0:19.14f}".format(1.0)]
+        for vector in structure.lattice.matrix:
+            lines.append("".join("{0:22.16f}".format(x) for x in vector))
+        lines.append("".join("{0:>5s}".format(element) for element in elements))
+        lines.append("".join("{0:>5d}".format(int(count)) for count in counts))
+        lines.append("Direct")
+        for frac_coords in structure.frac_coords:
+            lines.append("".join("{0:20.16f}".format(x) for x in frac_coords))
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    @PhaseTimer.timed("write_poscar")
+    def write_file(cls, structure: Structure, filename: str, elements_str_for_vaspkit: str,
+                   vac_as: str = None, comment: str = None):
+        with open(filename, "w") as f:
+            f.write(cls.to_string(structure, elements_str_for_vaspkit, vac_as, comment))
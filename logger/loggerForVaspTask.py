@@ -1,50 +1,39 @@
 import logging
 
+from logger.runLogger import RunLogger
+
+
 class LoggerForVaspTask:
 
     @staticmethod
     def log_output(**kwargs):
+        '''
+        Description
+        -----------
+            1. 有正在运行的 RunLogger 时, 记录经 "pyMC.vasp" 记录器进入该次搜索的 run.log (见 logger.runLogger)
+            2. 否则直接追加一行到 log_file_path; 不再为每条记录建立并关闭 FileHandler
+        '''
         level = kwargs.pop("level", None)
         log_file_path = kwargs.pop("log_file_path", None)
         FORMAT = kwargs.pop("FORMAT", None)
         DATEFMT = kwargs.pop("DATEFMT", None)
         msg = kwargs.pop("msg", None)
 
-        assert ( type(level) == int )    
-        assert ( type(log_file_path) == str )
-        assert ( type(msg) == str )
-
         if level is None:
             level = logging.DEBUG
+        assert ( type(level) == int )
+        assert ( type(msg) == str )
+
+        logger = logging.getLogger("pyMC.vasp")
+        if RunLogger.is_active():
+            logger.log(level, msg)
+            return
+        if log_file_path is None:
+            return
         if FORMAT is None:
-            FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+            FORMAT = RunLogger.FORMAT
         if DATEFMT is None:
-            DATEFMT = "%Y-%m-%d %H:%M:%S"
-
-        logger = logging.getLogger("VASP_Task_logger")
-        logger.setLevel(level)
-        logger.propagate = False
-
-        formatter = logging.Formatter(FORMAT, DATEFMT)
-        
-        sh = logging.FileHandler(log_file_path)
-        sh.setLevel(level)
-        sh.setFormatter(formatter)
-
-        logger.addHandler(sh)
-
-       
-        if logger.level == logging.DEBUG:
-            logger.debug(msg)
-        elif logger.level == logging.INFO:
-            logger.info(msg)
-        elif logger.level == logging.WARNING:
-            logger.warning(msg)
-        elif logger.level == logging.ERROR:
-            logger.error(msg)
-        elif logger.level == logging.CRITICAL:
-            logger.critical(msg)
-
-        # 关闭 log 文件
-        sh.close()
-        logger.removeHandler(sh)
\ No newline at end of file
+            DATEFMT = RunLogger.DATEFMT
+        record = logging.LogRecord("VASP_Task_logger", level, log_file_path, 0, msg, None, None)
+        with open(log_file_path, "a") as f:
+            f.write(logging.Formatter(FORMAT, DATEFMT).format(record) + "\n")
@@ -0,0 +1,153 @@
+import os
+import json
+import math
+import queue
+import atexit
+import logging
+import logging.handlers
+
+
+class JsonLinesFormatter(logging.Formatter):
+    '''
+    每条记录一行 JSON: {"time": ..., 以及 extra={"fields": {...}} 中的各项}; nan/inf 记为 null
+    '''
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {"time": round(record.created, 6)}
+        for key, value in getattr(record, "fields", {}).items():
+            if hasattr(value, "item"):
+                value = value.item()
+            if isinstance(value, float) and not math.isfinite(value):
+                value = None
+            fields[key] = value
+        return json.dumps(fields, ensure_ascii=False)
+
+
+class RunLogger(object):
+    '''
+    Description
+    -----------
+        1. 一次搜索(Metropolis.run)范围内的日志: "pyMC" 记录器上只挂一个 QueueHandler,
+            由 QueueListener 在后台线程中写入搜索总目录下的两个文件, 文件在整个搜索期间只打开一次:
+            - run.log: 文本日志 (原子交换、VASP 任务等, 原来分散在各步数文件夹的 process.log 中)
+            - steps.jsonl: 每一步一行 JSON (步数、E1、E2、接受概率、是否接受、耗时、能量来源)
+        2. 两个文件均经 MemoryHandler 缓冲, 每 buffer_size 条 (或出现 ERROR) 写出一次;
+            `self.flush` (写检查点时) 与 `self.close` (搜索结束或进程退出时) 写出剩余记录
+        3. verbosity: 'debug' (另外记录每次抽样的原子序号等调试信息), 'info' (默认) 或 'warning'
+        4. 没有正在运行的 RunLogger 时, "pyMC" 记录器不输出任何内容 (LoggerForExchangeAtoms /
+            LoggerForVaspTask 退回到直接追加写入 process.log)
+
+    Attributes
+    ----------
+        1. self.vasp_folders_path: str
+            搜索总目录
+        2. self.log_path / self.steps_path: str
+            run.log / steps.jsonl 的路径
+        3. self.level: int
+            verbosity 对应的 logging 级别
+    '''
+    LOGGER_NAME = "pyMC"
+    STEPS_LOGGER_NAME = "pyMC.steps"
+    LOG_FILENAME = "run.log"
+    STEPS_FILENAME = "steps.jsonl"
+    FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    DATEFMT = "%Y-%m-%d %H:%M:%S"
+    VERBOSITY = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING}
+
+    active = None
+
+    def __init__(self, vasp_folders_path: str, verbosity: str = "info", buffer_size: int = 256,
+                 steps_offset: int = None):
+        '''
+        Parameters
+        ----------
+            1. steps_offset: int
+                续算时将 steps.jsonl 截断到检查点时的长度 (见 `self.checkpoint_state`)
+        '''
+        if verbosity not in self.VERBOSITY:
+            raise ValueError("verbosity must be one of {0}, got {1!r}".format(tuple(self.VERBOSITY), verbosity))
+        if RunLogger.active is not None:
+            #上一次搜索(如被中断的搜索)的记录先写出, 再截断
+            RunLogger.active.close()
+        self.vasp_folders_path = vasp_folders_path
+        self.log_path = os.path.join(vasp_folders_path, self.LOG_FILENAME)
+        self.steps_path = os.path.join(vasp_folders_path, self.STEPS_FILENAME)
+        self.level = self.VERBOSITY[verbosity]
+        if (steps_offset is not None) and os.path.exists(self.steps_path):
+            os.truncate(self.steps_path, min(steps_offset, os.path.getsize(self.steps_path)))
+
+        log_handler = logging.FileHandler(self.log_path, delay=True)
+        log_handler.setFormatter(logging.Formatter(self.FORMAT, self.DATEFMT))
+        steps_handler = logging.FileHandler(self.steps_path, delay=True)
+        steps_handler.setFormatter(JsonLinesFormatter())
+        self.file_handlers = [log_handler, steps_handler]
+
+        is_step = lambda record: record.name == self.STEPS_LOGGER_NAME
+        self.buffers = [logging.handlers.MemoryHandler(buffer_size, flushLevel=logging.ERROR, target=log_handler),
+                        logging.handlers.MemoryHandler(buffer_size, flushLevel=logging.ERROR, target=steps_handler)]
+        self.buffers[0].addFilter(lambda record: not is_step(record))
+        self.buffers[1].addFilter(is_step)
+
+        self.queue = queue.Queue()
+        self.listener = logging.handlers.QueueListener(self.queue, *self.buffers)
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.listener.start()
+
+        logger = logging.getLogger(self.LOGGER_NAME)
+        self._previous_level = logger.level
+        logger.setLevel(self.level)
+        logger.propagate = False
+        logger.addHandler(self.queue_handler)
+        logging.getLogger(self.STEPS_LOGGER_NAME).setLevel(logging.INFO)
+        RunLogger.active = self
+        atexit.register(self.close)
+
+    @classmethod
+    def from_poscar_path(cls, poscar_path: str, **kwargs) -> 'RunLogger':
+        return cls(os.path.dirname(os.path.dirname(poscar_path)), **kwargs)
+
+    @classmethod
+    def is_active(cls) -> bool:
+        return cls.active is not None
+
+    @staticmethod
+    def log_step(**fields):
+        '''
+        记录一步 (写入 steps.jsonl); 没有正在运行的 RunLogger 时不做任何事
+        '''
+        logger = logging.getLogger(RunLogger.STEPS_LOGGER_NAME)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("step", extra={"fields": fields})
+
+    def flush(self):
+        '''
+        等待队列中的记录全部交给缓冲区, 再写出缓冲区
+        '''
+        self.queue.join()
+        for buffer in self.buffers:
+            buffer.flush()
+
+    def checkpoint_state(self) -> int:
+        '''
+        检查点中的 steps.jsonl 长度 (字节)
+        '''
+        self.flush()
+        return os.path.getsize(self.steps_path) if os.path.exists(self.steps_path) else 0
+
+    def close(self):
+        if RunLogger.active is not self:
+            return
+        RunLogger.active = None
+        logger = logging.getLogger(self.LOGGER_NAME)
+        logger.removeHandler(self.queue_handler)
+        logger.setLevel(self._previous_level)
+        logging.getLogger(self.STEPS_LOGGER_NAME).setLevel(logging.CRITICAL + 1)
+        self.listener.stop()
+        for handler in self.buffers + self.file_handlers:
+            handler.flush()
+            handler.close()
+        atexit.unregister(self.close)
+
+
+# 没有正在运行的 RunLogger 时 "pyMC" 记录器不向 stderr 输出
+logging.getLogger(RunLogger.LOGGER_NAME).addHandler(logging.NullHandler())
+logging.getLogger(RunLogger.STEPS_LOGGER_NAME).setLevel(logging.CRITICAL + 1)
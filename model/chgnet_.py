@@ -4,6 +4,9 @@ from pymatgen.io.vasp import Vasprun
 from chgnet.model.model import CHGNet
 import os
 
+from model.modelRegistry import ModelRegistry
+from cores.trajectoryStore import TrajectoryReader
+
 from ase import io
 #from ..批量整理 import find_file
 
@@ -34,16 +37,28 @@ def get_chg_energy(structure:Structure,model:CHGNet):
 def get_prediction_from_vasp(vasp_folder_path: str,from_contcar:bool=True,*,load:str=None,from_:bool=False,from_filename:str=None):
     '''
     从vasp_folder中读取结构使用模型进行预测能量
+    vasp_folder_path 下有 trajectory.bin (或 vasp_folder_path 即为该文件) 时直接读取轨迹文件,
+    from_contcar=True 时使用保存的弛豫坐标, 否则为参考位点上的结构
     Return:
     dir_id , energy_list
     '''
     dir_id=[]
     energy_list=[]
 
-    if load:
-        model = CHGNet.from_file(load)
-    else:
-        model = CHGNet.load()
+    model = ModelRegistry.get_chgnet(load_path=load if load else None)
+
+    if os.path.isfile(vasp_folder_path) or TrajectoryReader.exists(vasp_folder_path):
+        reader = TrajectoryReader(vasp_folder_path) if os.path.isfile(vasp_folder_path) \
+            else TrajectoryReader.from_run_root(vasp_folder_path)
+        for index, step in enumerate(reader.steps):
+            if (reader.occupations[index] < 0).any():
+                print(f'step {step}: 占据未知,跳过')
+                continue
+            print(f"----{step}----")
+            structure = reader.structure(index, relaxed=from_contcar)
+            dir_id.append(int(step))
+            energy_list.append(get_chg_energy(structure, model))
+        return dir_id,energy_list
 
 
     for root, dirs, files in os.walk(vasp_folder_path):
@@ -0,0 +1,356 @@
+from __future__ import annotations
+import os
+import itertools
+import numpy as np
+from prettytable import PrettyTable
+from pymatgen.core import Structure
+
+from calculators.vaspOutputReader import VaspOutputReader
+from cores.trajectoryStore import TrajectoryReader
+from cores.latticeState import LatticeState
+
+
+class ClusterExpansion(object):
+    '''
+    Description
+    -----------
+        1. 参考晶格上的 pair/triplet 团簇展开, 作为交换前的廉价代理模型:
+            E ≈ E_0 + Σ J_point·n_point + Σ_shell Σ J_pair·n_pair + Σ J_triplet·n_triplet
+        2. 特征为各元素的位点数 (point)、前 num_shells 个配位壳层中各元素对的键数 (pair)
+            以及由这些壳层的键构成的三角形中各元素三元组的个数 (triplet), 由占据向量直接 bincount 得到
+        3. 以 numpy.linalg.lstsq (带很小的 ridge 正则) 拟合, 每加入 refit_every 个样本重新拟合一次;
+            拟合误差由留一交叉验证 (LOO, 由 hat matrix 直接给出) 估计
+        4. 只用于 delayed acceptance 的第一阶段 (见 `Exchange.screen_mark`/`Exchange.delayed_mark`),
+            只决定哪些交换不必计算真实能量. 模型固定时两阶段判据满足细致平衡;
+            在线重新拟合时第一阶段依赖链的历史, 链只在模型收敛后渐近地满足细致平衡.
+            freeze_after 不为 None 时, 拟合样本数达到 freeze_after 后不再重新拟合, 此后严格满足细致平衡
+
+    Attributes
+    ----------
+        1. self.reference: pymatgen.core.Structure
+            参考结构(含空位位点), 各结构按最小镜像距离映射到参考位点
+        2. self.species: list
+            占据向量中的元素 (包括 vac_as)
+        3. self.min_samples: int
+            开始使用代理模型所需的最少样本数
+        4. self.confidence: float
+            预测的 ΔE 先向 0 收缩 confidence × LOO RMSE, 只有确信的大幅上坡才会在第一阶段被拒绝
+        5. self.loo_rmse: float
+            最近一次拟合的留一交叉验证均方根误差 (eV)
+        6. self.freeze_after: int
+            拟合样本数达到 freeze_after 后固定模型 (None 时一直在线拟合)
+    '''
+    def __init__(self, reference: Structure, species: list = None, vac_as: str = "V",
+                 num_shells: int = 2, triplets: bool = True, ridge: float = 1e-6,
+                 min_samples: int = 20, confidence: float = 2.0, refit_every: int = 1,
+                 freeze_after: int = None, tolerance: float = None):
+        self.reference = reference
+        self.vac_as = vac_as
+        self.species = sorted(set(species or []) | {site.species_string for site in reference} | {vac_as})
+        self.species_index = {specie: index for index, specie in enumerate(self.species)}
+        self.ridge = ridge
+        self.min_samples = min_samples
+        self.confidence = confidence
+        self.refit_every = refit_every
+        self.freeze_after = freeze_after
+
+        self.reference_frac_coords = reference.frac_coords
+        self.reference_matrix = reference.lattice.matrix
+        distance_matrix = reference.distance_matrix
+        min_distance = distance_matrix[distance_matrix > 1e-8].min(initial=np.inf)
+        self.tolerance = 0.5 * min_distance if tolerance is None else tolerance
+
+        self._build_clusters(num_shells, triplets, min_distance)
+
+        self.samples = []
+        self.energies = []
+        self.num_fitted = 0
+        self.coefficients = None
+        self.feature_mean = None
+        self.energy_mean = None
+        self.loo_rmse = None
+        self.screened = 0
+        self.passed = 0
+
+    def _build_clusters(self, num_shells: int, triplets: bool, min_distance: float):
+        '''
+        配位壳层的键 (i, j) 与三角形 (i, j, k), 以及元素组合到特征序号的查找表
+        '''
+        num_species = len(self.species)
+        centers, points, _, distances = self.reference.get_neighbor_list(r=float(min_distance) * 2.5,
+                                                                         exclude_self=True)
+        shell_distances = np.unique(np.round(distances, 2))[:num_shells]
+        self.shell_pairs = []
+        for shell_distance in shell_distances:
+            mask = np.abs(distances - shell_distance) < 0.01
+            self.shell_pairs.append((centers[mask], points[mask]))
+
+        pairs = list(itertools.combinations_with_replacement(range(num_species), 2))
+        self.pair_table = np.zeros((num_species, num_species), dtype=np.int64)
+        for index, (a, b) in enumerate(pairs):
+            self.pair_table[a, b] = self.pair_table[b, a] = index
+        self.num_pairs = len(pairs)
+
+        self.triangles = np.zeros((0, 3), dtype=np.int64)
+        self.num_triplets = 0
+        if triplets and self.shell_pairs:
+            # 三条边都属于前 num_shells 个壳层的三角形
+            neighbors = [set() for _ in range(len(self.reference))]
+            for shell_centers, shell_points in self.shell_pairs:
+                for i, j in zip(shell_centers, shell_points):
+                    neighbors[i].add(int(j))
+            triangles = [(i, j, k) for i in range(len(neighbors)) for j in neighbors[i] if j > i
+                         for k in neighbors[i] & neighbors[j] if k > j]
+            self.triangles = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+
+            triples = list(itertools.combinations_with_replacement(range(num_species), 3))
+            self.triplet_table = np.zeros((num_species,) * 3, dtype=np.int64)
+            for index, triple in enumerate(triples):
+                for permutation in itertools.permutations(triple):
+                    self.triplet_table[permutation] = index
+            self.num_triplets = len(triples)
+
+    @classmethod
+    def from_run_root(cls, vasp_folders_path: str, vac_dope: bool = False, vac_as: str = "V",
+                      **kwargs) -> ClusterExpansion:
+        '''
+        Description
+        -----------
+            1. 以 0 文件夹中的结构(vac_dope 时为含空位的 0.POSCAR)作为参考晶格
+            2. 由已有的步数文件夹(0 以及含 Accept.txt 的文件夹)中的能量拟合初始模型:
+                OSZICAR (DFT) 或 relaxation_output.txt (chgnet/mattersim);
+                搜索总目录下有 trajectory.bin 时改为读取其中已计算能量的各步
+        '''
+        reference = cls._read_lattice_structure(os.path.join(vasp_folders_path, "0"), vac_dope)
+        surrogate = cls(reference, vac_as=vac_as, **kwargs)
+
+        if TrajectoryReader.exists(vasp_folders_path):
+            reader = TrajectoryReader.from_run_root(vasp_folders_path)
+            energies = np.asarray(reader.records["E2"])
+            known = (reader.occupations >= 0).all(axis=1)
+            for index in np.flatnonzero(np.isfinite(energies) & known):
+                surrogate.add(reader.structure(index, relaxed=False, with_vacancies=True), float(energies[index]),
+                              refit=False)
+            surrogate.fit()
+            return surrogate
+
+        folder_names = sorted((name for name in os.listdir(vasp_folders_path) if name.isdigit()), key=int)
+        for folder_name in folder_names:
+            vasp_folder_path = os.path.join(vasp_folders_path, folder_name)
+            if folder_name != "0" and not os.path.exists(os.path.join(vasp_folder_path, "Accept.txt")):
+                continue
+            energy = cls._read_energy(vasp_folder_path)
+            if energy is None:
+                continue
+            surrogate.add(cls._read_lattice_structure(vasp_folder_path, vac_dope), energy, refit=False)
+        surrogate.fit()
+        return surrogate
+
+    @classmethod
+    def from_checkpoint(cls, vasp_folders_path: str, state: dict, vac_dope: bool = False, vac_as: str = "V",
+                        **kwargs) -> ClusterExpansion:
+        '''
+        以 0 文件夹中的参考晶格与检查点中的样本还原代理模型 (见 `self.restore`)
+        '''
+        reference = cls._read_lattice_structure(os.path.join(vasp_folders_path, "0"), vac_dope)
+        surrogate = cls(reference, vac_as=vac_as, **kwargs)
+        surrogate.restore(state)
+        return surrogate
+
+    @staticmethod
+    def _read_lattice_structure(vasp_folder_path: str, vac_dope: bool) -> Structure:
+        if vac_dope:
+            structure_index = os.path.basename(vasp_folder_path)
+            return Structure.from_file(os.path.join(vasp_folder_path, structure_index+".POSCAR"))
+        return Structure.from_file(os.path.join(vasp_folder_path, "POSCAR"))
+
+    @staticmethod
+    def _read_energy(vasp_folder_path: str) -> float:
+        oszicar_path = os.path.join(vasp_folder_path, "OSZICAR")
+        output_path = os.path.join(vasp_folder_path, "relaxation_output.txt")
+        try:
+            if os.path.exists(oszicar_path):
+                return VaspOutputReader.read_final_energy(oszicar_path)
+            if os.path.exists(output_path):
+                with open(output_path, "r") as f:
+                    return float(f.readlines()[-1].split(":")[-1])
+        except (ValueError, IndexError):
+            pass
+        return None
+
+    def __repr__(self):
+        table = PrettyTable(["Samples", "Features", "LOO_RMSE", "Screened", "Passed"])
+        loo_rmse = "-" if self.loo_rmse is None else "{0:.4f}".format(self.loo_rmse)
+        table.add_row([len(self.samples), self.num_features, loo_rmse, self.screened, self.passed])
+        print(table)
+        return ""
+
+    def __str__(self):
+        return self.__repr__()
+
+    def report(self):
+        print(self)
+
+    @property
+    def num_features(self) -> int:
+        return len(self.species) + len(self.shell_pairs) * self.num_pairs + self.num_triplets
+
+    @property
+    def ready(self) -> bool:
+        return self.coefficients is not None
+
+    @property
+    def frozen(self) -> bool:
+        return self.ready and (self.freeze_after is not None) and (self.num_fitted >= self.freeze_after)
+
+    def assign(self, structure: Structure) -> np.ndarray:
+        '''
+        第 i 个原子对应的参考位点; 位移超过 tolerance 或两个原子映射到同一位点时返回 None
+        '''
+        diff = structure.frac_coords[:, None, :] - self.reference_frac_coords[None, :, :]
+        diff -= np.round(diff)
+        distances = np.sqrt(((diff @ self.reference_matrix) ** 2).sum(axis=-1))
+        mapping = distances.argmin(axis=1)
+        if distances[np.arange(len(mapping)), mapping].max(initial=0.0) > self.tolerance:
+            return None
+        if len(np.unique(mapping)) != len(mapping):
+            return None
+        return mapping
+
+    def occupations(self, structure: Structure, mapping: np.ndarray = None) -> np.ndarray:
+        '''
+        参考位点上的元素序号; 无法映射或出现未知元素时返回 None
+        (structure 为 LatticeState 时直接转换其占据数组)
+        '''
+        if mapping is None:
+            mapping = self.assign(structure)
+        if mapping is None:
+            return None
+        occupations = np.full(len(self.reference), self.species_index[self.vac_as], dtype=np.int64)
+        try:
+            if isinstance(structure, LatticeState):
+                occupations[mapping] = structure.codes_in(self.species_index)
+            else:
+                occupations[mapping] = [self.species_index[site.species_string] for site in structure]
+        except KeyError:
+            return None
+        return occupations
+
+    def features(self, occupations: np.ndarray) -> np.ndarray:
+        blocks = [np.bincount(occupations, minlength=len(self.species))]
+        for centers, points in self.shell_pairs:
+            blocks.append(np.bincount(self.pair_table[occupations[centers], occupations[points]],
+                                      minlength=self.num_pairs))
+        if self.num_triplets:
+            triangle_occupations = occupations[self.triangles]
+            blocks.append(np.bincount(self.triplet_table[triangle_occupations[:, 0],
+                                                         triangle_occupations[:, 1],
+                                                         triangle_occupations[:, 2]],
+                                      minlength=self.num_triplets))
+        return np.concatenate(blocks).astype(float)
+
+    def add(self, structure: Structure, energy: float, mapping: np.ndarray = None, refit: bool = True):
+        '''
+        加入一个已计算真实能量的结构, 每 refit_every 个新样本重新拟合 (模型固定后只保存样本)
+        '''
+        occupations = self.occupations(structure, mapping)
+        if occupations is None:
+            return
+        self.samples.append(self.features(occupations))
+        self.energies.append(float(energy))
+        if refit and (not self.frozen) and (len(self.samples) - self.num_fitted >= self.refit_every):
+            self.fit()
+
+    def fit(self):
+        '''
+        中心化后的 ridge 最小二乘; LOO 残差 r_i / (1 - H_ii)
+        '''
+        num_samples = len(self.samples)
+        if num_samples < self.min_samples:
+            return
+        X = np.array(self.samples)
+        y = np.array(self.energies)
+        feature_mean = X.mean(axis=0)
+        energy_mean = y.mean()
+        Xc = X - feature_mean
+        yc = y - energy_mean
+
+        gram = Xc.T @ Xc
+        penalty = self.ridge * max(np.trace(gram) / gram.shape[0], 1.0)
+        augmented_X = np.vstack([Xc, np.sqrt(penalty) * np.eye(gram.shape[0])])
+        augmented_y = np.concatenate([yc, np.zeros(gram.shape[0])])
+        coefficients = np.linalg.lstsq(augmented_X, augmented_y, rcond=None)[0]
+
+        hat_diagonal = np.einsum('ij,ji->i', Xc, np.linalg.solve(gram + penalty * np.eye(gram.shape[0]), Xc.T))
+        hat_diagonal += 1.0 / num_samples
+        residuals = (yc - Xc @ coefficients) / np.clip(1.0 - hat_diagonal, 1e-6, None)
+
+        self.coefficients = coefficients
+        self.feature_mean = feature_mean
+        self.energy_mean = energy_mean
+        self.loo_rmse = float(np.sqrt(np.mean(residuals ** 2)))
+        self.num_fitted = num_samples
+
+    def predict(self, structure: Structure, mapping: np.ndarray = None) -> float:
+        '''
+        代理能量; 模型尚未拟合或结构无法映射时返回 None
+        '''
+        if not self.ready:
+            return None
+        occupations = self.occupations(structure, mapping)
+        if occupations is None:
+            return None
+        return float(self.energy_mean + (self.features(occupations) - self.feature_mean) @ self.coefficients)
+
+    def shrink(self, delta_E: float) -> float:
+        '''
+        将预测的 ΔE 向 0 收缩 confidence × LOO RMSE (仍是反对称的, 固定的模型仍满足细致平衡)
+        '''
+        margin = self.confidence * (self.loo_rmse or 0.0)
+        return float(np.sign(delta_E) * max(abs(delta_E) - margin, 0.0))
+
+    def screen_delta(self, structure: Structure, trial_structure: Structure) -> float:
+        '''
+        delayed acceptance 第一阶段使用的 ΔE (已收缩); 无法预测时返回 None
+        '''
+        E_1 = self.predict(structure)
+        E_2 = self.predict(trial_structure)
+        if (E_1 is None) or (E_2 is None):
+            return None
+        return self.shrink(E_2 - E_1)
+
+    def checkpoint_state(self) -> dict:
+        '''
+        检查点中的代理模型状态: 全部样本、已拟合的样本数与第一阶段统计
+        '''
+        return {"samples": [sample.tolist() for sample in self.samples],
+                "energies": list(self.energies),
+                "num_fitted": self.num_fitted,
+                "screened": self.screened,
+                "passed": self.passed}
+
+    def restore(self, state: dict):
+        '''
+        由检查点还原: 以前 num_fitted 个样本重新拟合 (与中断前的系数相同), 再加入其余样本
+        '''
+        samples = [np.asarray(sample) for sample in state["samples"]]
+        num_fitted = state["num_fitted"]
+        self.samples = samples[:num_fitted]
+        self.energies = list(state["energies"][:num_fitted])
+        self.num_fitted = 0
+        self.coefficients = None
+        self.loo_rmse = None
+        self.fit()
+        self.samples.extend(samples[num_fitted:])
+        self.energies.extend(state["energies"][num_fitted:])
+        self.screened = state["screened"]
+        self.passed = state["passed"]
+
+    def record(self, passed: bool):
+        '''
+        统计第一阶段通过/拒绝的次数
+        '''
+        if passed:
+            self.passed += 1
+        else:
+            self.screened += 1
@@ -0,0 +1,277 @@
+import os
+import numpy as np
+
+from ase.constraints import FixAtoms
+from pymatgen.core import Structure
+from mattersim.datasets.utils.build import build_dataloader
+
+from model.modelRegistry import ModelRegistry
+from utilitys.phaseTimer import PhaseTimer
+
+
+class EnergyBackend(object):
+    '''
+    Description
+    -----------
+        1. 内存模式下的能量计算接口, 输入 pymatgen.Structure, 不读写任何文件
+        2. 模型统一由 ModelRegistry 提供, 每个进程只加载一次
+
+    Attributes
+    ----------
+        1. self.load_path: str
+            训练模型路径(若有)
+        2. self.device: str
+            计算设备, None 时由各模型自行决定
+        3. self.max_relax_steps: int
+            relax_policy='converge' 时的弛豫步数上限
+        4. self.fmax: float
+            弛豫收敛判据
+        5. self.batch_size: int
+            predict_batch 每次前向计算的结构数
+        6. self.relax_mode: str
+            'full': 弛豫全部原子与晶胞;
+            'local': 只弛豫交换位点 local_radius 内的原子 (其余原子以 ASE FixAtoms 固定), 不弛豫晶胞
+        7. self.local_radius: float
+            局部弛豫半径 (Å)
+        8. self.relax_policy: str
+            'none': 不弛豫, 直接计算交换后晶格的单点能;
+            'fixed_steps': 弛豫最多 relax_steps 步;
+            'converge': 弛豫至收敛 (最多 max_relax_steps 步)
+        9. self.relax_steps: int
+            relax_policy='fixed_steps' 时的弛豫步数上限
+    '''
+    name = None
+    RELAX_MODES = ('full', 'local')
+    RELAX_POLICIES = ('none', 'fixed_steps', 'converge')
+
+    def __init__(self, load_path: str = None, device: str = None,
+                 max_relax_steps: int = 500, fmax: float = 0.1, batch_size: int = 16,
+                 relax_mode: str = 'full', local_radius: float = 6.0,
+                 relax_policy: str = 'converge', relax_steps: int = 50):
+        assert (relax_mode in self.RELAX_MODES)
+        assert (relax_policy in self.RELAX_POLICIES)
+        self.load_path = load_path
+        self.device = device
+        self.max_relax_steps = max_relax_steps
+        self.fmax = fmax
+        self.batch_size = batch_size
+        self.relax_mode = relax_mode
+        self.local_radius = local_radius
+        self.relax_policy = relax_policy
+        self.relax_steps = relax_steps
+
+    @classmethod
+    def from_name(cls, load_model: str, load_path: str = None, device: str = None, **kwargs) -> 'EnergyBackend':
+        for backend_cls in (CHGNetBackend, MatterSimBackend):
+            if backend_cls.name == load_model:
+                return backend_cls(load_path=load_path, device=device, **kwargs)
+        raise ValueError("Unsupported load_model for in-memory mode: {0}".format(load_model))
+
+    def preload(self):
+        ModelRegistry.preload(self.name, load_path=self.load_path, device=self.device)
+
+    def evaluate(self, structure: Structure, rng: np.random.Generator = None, local_centers: np.ndarray = None,
+                 relax_policy: str = None):
+        '''
+        Parameters
+        ----------
+            1. rng: np.random.Generator
+                弛豫前随机扰动所用的随机数生成器, None 时为 np.random 的全局状态
+            2. local_centers: np.ndarray
+                被交换位点的笛卡尔坐标; relax_mode='local' 且给出时只做局部弛豫, 否则完整弛豫
+            3. relax_policy: str
+                None 时为 self.relax_policy
+
+        Return
+        ------
+            1. energy: float
+                弛豫后结构的总能量 (eV)
+            2. relaxed_structure: pymatgen.core.Structure
+                弛豫后结构, 原子顺序与输入一致 (relax_policy='none' 时为输入结构的副本)
+        '''
+        relax_policy = self.relax_policy if relax_policy is None else relax_policy
+        if relax_policy == 'none':
+            with PhaseTimer.phase(self.name + "_predict"):
+                return float(self.predict_batch([structure])[0]), structure.copy()
+        steps = self.relax_steps if relax_policy == 'fixed_steps' else self.max_relax_steps
+        with PhaseTimer.phase(self.name + "_relax"):
+            return self._relax(structure, rng=rng, local_centers=local_centers, steps=steps)
+
+    def _relax(self, structure: Structure, rng: np.random.Generator = None, local_centers: np.ndarray = None,
+               steps: int = 500):
+        raise NotImplementedError
+
+    def provenance(self, relax_policy: str = None, local_centers: np.ndarray = None) -> str:
+        '''
+        能量来源, 记录在 mc_record.txt 与各步数文件夹的 energy_provenance.txt 中:
+            'single_point', 'fixed_steps:<relax_steps>' 或 'converge', 局部弛豫时加 ':local'
+        '''
+        relax_policy = self.relax_policy if relax_policy is None else relax_policy
+        return self.describe_policy(relax_policy, self.relax_steps,
+                                    local=(self.relax_mode == 'local') and (local_centers is not None))
+
+    @staticmethod
+    def record_provenance(vasp_folder_path: str, provenance: str):
+        '''
+        在步数文件夹的 energy_provenance.txt 中追加一行能量来源 (同一结构重新计算时逐行追加)
+        '''
+        with open(os.path.join(vasp_folder_path, "energy_provenance.txt"), "a") as f:
+            f.write(provenance + "\n")
+
+    @staticmethod
+    def describe_policy(relax_policy: str, relax_steps: int = None, local: bool = False) -> str:
+        if relax_policy == 'none':
+            return 'single_point'
+        provenance = 'fixed_steps:{0}'.format(relax_steps) if relax_policy == 'fixed_steps' else relax_policy
+        return provenance + (':local' if local else '')
+
+    @staticmethod
+    def _rng(rng: np.random.Generator = None):
+        return np.random if rng is None else rng
+
+    def _free_mask(self, structure: Structure, local_centers: np.ndarray = None) -> np.ndarray:
+        '''
+        参与弛豫的原子; 完整弛豫时为 None
+        '''
+        if (self.relax_mode != 'local') or (local_centers is None):
+            return None
+        return self.local_free_mask(structure, local_centers, self.local_radius)
+
+    @staticmethod
+    def local_free_mask(structure: Structure, local_centers: np.ndarray, radius: float) -> np.ndarray:
+        '''
+        与任一中心的最小镜像距离不超过 radius 的原子
+        '''
+        center_frac_coords = structure.lattice.get_fractional_coords(np.atleast_2d(local_centers))
+        diff = structure.frac_coords[:, None, :] - center_frac_coords[None, :, :]
+        diff -= np.round(diff)
+        images = np.array(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1])).reshape(3, -1).T
+        cart = (diff[:, :, None, :] + images[None, None, :, :]) @ structure.lattice.matrix
+        distances = np.sqrt((cart ** 2).sum(axis=-1)).min(axis=(1, 2))
+        return distances <= radius
+
+    @staticmethod
+    def fix_outside(atoms, free_mask: np.ndarray):
+        '''
+        以 ASE FixAtoms 固定 free_mask 以外的原子
+        '''
+        atoms.set_constraint(FixAtoms(indices=np.flatnonzero(~free_mask)))
+        return atoms
+
+    def predict_batch(self, structures: list) -> np.ndarray:
+        '''
+        Description
+        -----------
+            1. 不弛豫, 对一组结构做批量单点能计算 (一次前向计算 batch_size 个图)
+
+        Return
+        ------
+            1. energies: np.ndarray
+                各结构的总能量 (eV)
+        '''
+        raise NotImplementedError
+
+
+class CHGNetBackend(EnergyBackend):
+    name = 'chgnet'
+
+    def __init__(self, load_path: str = None, device: str = None,
+                 max_relax_steps: int = 500, fmax: float = 0.1, perturb: float = 0.1, batch_size: int = 16,
+                 relax_mode: str = 'full', local_radius: float = 6.0,
+                 relax_policy: str = 'converge', relax_steps: int = 50):
+        super().__init__(load_path=load_path, device=device, max_relax_steps=max_relax_steps, fmax=fmax,
+                         batch_size=batch_size, relax_mode=relax_mode, local_radius=local_radius,
+                         relax_policy=relax_policy, relax_steps=relax_steps)
+        self.perturb = perturb
+
+    def _relax(self, structure: Structure, rng: np.random.Generator = None, local_centers: np.ndarray = None,
+               steps: int = 500):
+        structure = structure.copy()
+        free_mask = self._free_mask(structure, local_centers)
+        # 与 Structure.perturb 相同: 每个(参与弛豫的)位点沿随机方向移动 perturb (Å)
+        vectors = self._rng(rng).standard_normal((len(structure), 3))
+        vectors *= self.perturb / np.linalg.norm(vectors, axis=1, keepdims=True)
+        for index, vector in enumerate(vectors):
+            if (free_mask is None) or free_mask[index]:
+                structure.translate_sites([index], vector, frac_coords=False)
+
+        relaxer = ModelRegistry.get_struct_optimizer(load_path=self.load_path, device=self.device)
+        if free_mask is None:
+            result = relaxer.relax(structure, steps=steps, fmax=self.fmax, verbose=False)
+        else:
+            atoms = self.fix_outside(structure.to_ase_atoms(), free_mask)
+            result = relaxer.relax(atoms, steps=steps, fmax=self.fmax, relax_cell=False, verbose=False)
+        relaxed_structure = result["final_structure"]
+        if "selective_dynamics" in relaxed_structure.site_properties:
+            # FixAtoms 会被转换为 selective_dynamics, 不写入 POSCAR
+            relaxed_structure.remove_site_property("selective_dynamics")
+
+        model = ModelRegistry.get_chgnet(load_path=self.load_path, device=self.device)
+        energy = float(model.predict_structure(relaxed_structure)['e']) * relaxed_structure.num_sites
+        return energy, relaxed_structure
+
+    def predict_batch(self, structures: list) -> np.ndarray:
+        model = ModelRegistry.get_chgnet(load_path=self.load_path, device=self.device)
+        predictions = model.predict_structure(list(structures), task='e', batch_size=self.batch_size)
+        if isinstance(predictions, dict):
+            predictions = [predictions]
+        return np.array([float(prediction['e']) * structure.num_sites
+                         for prediction, structure in zip(predictions, structures)])
+
+
+class MatterSimBackend(EnergyBackend):
+    name = 'mattersim'
+
+    def __init__(self, load_path: str = None, device: str = None,
+                 max_relax_steps: int = 500, fmax: float = 0.01, perturb: float = 0.01, batch_size: int = 16,
+                 relax_mode: str = 'full', local_radius: float = 6.0,
+                 relax_policy: str = 'converge', relax_steps: int = 50,
+                 *,
+                 optimizer: str = "FIRE",
+                 filter: str = "FrechetCellFilter",
+                 constrain_symmetry: bool = True):
+        super().__init__(load_path=load_path, device=device, max_relax_steps=max_relax_steps, fmax=fmax,
+                         batch_size=batch_size, relax_mode=relax_mode, local_radius=local_radius,
+                         relax_policy=relax_policy, relax_steps=relax_steps)
+        self.perturb = perturb
+        self.optimizer = optimizer
+        self.filter = filter
+        self.constrain_symmetry = constrain_symmetry
+
+    def _relax(self, structure: Structure, rng: np.random.Generator = None, local_centers: np.ndarray = None,
+               steps: int = 500):
+        atoms = structure.to_ase_atoms()
+        free_mask = self._free_mask(structure, local_centers)
+        displacements = self.perturb * 10 * self._rng(rng).standard_normal((len(atoms), 3))
+        if free_mask is not None:
+            displacements[~free_mask] = 0.0
+        atoms.positions += displacements
+        atoms.calc = ModelRegistry.get_mattersim_calculator(load_path=self.load_path, device=self.device)
+
+        if free_mask is None:
+            relaxer = ModelRegistry.get_relaxer(optimizer=self.optimizer,
+                                                filter=self.filter,
+                                                constrain_symmetry=self.constrain_symmetry)
+        else:
+            # 局部弛豫: 不弛豫晶胞, 不使用 FixSymmetry (会覆盖 FixAtoms)
+            relaxer = ModelRegistry.get_relaxer(optimizer=self.optimizer, filter=None, constrain_symmetry=False)
+            self.fix_outside(atoms, free_mask)
+        relax_result = relaxer.relax(atoms, steps=steps, fmax=self.fmax, verbose=False)
+        relaxed_atoms = relax_result[1]
+        relaxed_atoms.set_constraint(None)
+
+        energy = float(relaxed_atoms.get_potential_energy())
+        relaxed_structure = Structure.from_ase_atoms(relaxed_atoms)
+        return energy, relaxed_structure
+
+    def predict_batch(self, structures: list) -> np.ndarray:
+        potential = ModelRegistry.get_mattersim_potential(load_path=self.load_path, device=self.device)
+        model_args = potential.model.model_args if potential.model_name == "m3gnet" else {}
+        dataloader = build_dataloader([structure.to_ase_atoms() for structure in structures],
+                                      model_type=potential.model_name,
+                                      cutoff=model_args.get("cutoff", 5.0),
+                                      threebody_cutoff=model_args.get("threebody_cutoff", 4.0),
+                                      batch_size=self.batch_size,
+                                      only_inference=True)
+        energies, _, _ = potential.predict_properties(dataloader, include_forces=False, include_stresses=False)
+        return np.array(energies, dtype=float)
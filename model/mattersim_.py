@@ -15,9 +15,12 @@ from mattersim.applications.relax import Relaxer
 from mattersim.forcefield.potential import Potential
 from mattersim.datasets.utils.build import build_dataloader
 
-from chgnet.model import StructOptimizer
 from pymatgen.core import Structure
 
+from model.modelRegistry import ModelRegistry
+from model.energyBackend import EnergyBackend
+from utilitys.phaseTimer import PhaseTimer
+
 class mattersim_predict():
     def __init__(self,
                  poscar_path,
@@ -35,17 +38,81 @@ class mattersim_predict():
     @classmethod
     def load(self,poscar_path,
              load_path:str=None,
-             device:str="cuda" if torch.cuda.is_available() else "cpu"):
+             device:str="cuda" if torch.cuda.is_available() else "cpu",
+             energy_cache=None,
+             local_centers=None,
+             local_radius:float=6.0,
+             relax_policy:str='converge',
+             relax_steps:int=50,
+             max_relax_steps:int=500,
+             rng:np.random.Generator=None):
+        '''
+        energy_cache: cores.energyCache.EnergyCache, 命中时以缓存的 CONTCAR 代替弛豫
+        local_centers: 被交换位点的笛卡尔坐标, 给出时只弛豫其 local_radius (Å) 内的原子 (见 `self.relax`)
+        relax_policy: 'none' 时直接计算 POSCAR 的单点能(CONTCAR 即 POSCAR), 'fixed_steps' 时最多弛豫 relax_steps 步,
+            'converge' 时最多弛豫 max_relax_steps 步
+        rng: 弛豫前随机扰动所用的 np.random.Generator, None 时使用 np.random 的全局状态
+        '''
         mattersim = mattersim_predict(poscar_path,device,load_path)
+        cached = None
+        provenance = None
         if os.path.exists(mattersim.contcar_path):
             atom = io.read(mattersim.contcar_path)
         else:
-            atom = mattersim.relax(mattersim.load_path)
+            if energy_cache is not None:
+                cached = energy_cache.lookup(Structure.from_file(poscar_path))
+            if cached is not None:
+                atom = cached[1].to_ase_atoms()
+                mattersim.atom_save(atom,mattersim.contcar_path)
+                provenance = 'cache'
+            elif relax_policy == 'none':
+                atom = mattersim.atom
+                mattersim.atom_save(atom,mattersim.contcar_path)
+                provenance = EnergyBackend.describe_policy(relax_policy)
+            else:
+                atom = mattersim.relax(mattersim.load_path,
+                                       relax_step=relax_steps if relax_policy == 'fixed_steps' else max_relax_steps,
+                                       local_centers=local_centers,
+                                       local_radius=local_radius,
+                                       rng=rng)
+                provenance = EnergyBackend.describe_policy(relax_policy, relax_steps,
+                                                           local=local_centers is not None)
         energy = mattersim.predict(atom,mattersim.load_path)
+        if provenance is not None:
+            EnergyBackend.record_provenance(mattersim.folder_path, provenance)
+        if (energy_cache is not None) and (cached is None):
+            energy_cache.store(Structure.from_file(poscar_path), energy, Structure.from_ase_atoms(atom))
         mattersim.contcar_atom = atom
         mattersim.energy = energy
         return mattersim
+
+    @classmethod
+    def full_relax(cls,poscar_path,
+                   load_path:str=None,
+                   device:str="cuda" if torch.cuda.is_available() else "cpu",
+                   relax_policy:str='converge',
+                   relax_steps:int=50,
+                   max_relax_steps:int=500,
+                   rng:np.random.Generator=None):
+        '''
+        由已有的 CONTCAR 出发以 relax_policy 完整弛豫(含晶胞), 覆盖 CONTCAR 并追加能量
+        (局部弛豫模式下的定期完整弛豫, 以及被接受结构的重新计算)
+        '''
+        mattersim = mattersim_predict(poscar_path,device,load_path)
+        mattersim.atom = io.read(mattersim.contcar_path)
+        if relax_policy == 'none':
+            atom = mattersim.atom
+            mattersim.predict(atom,mattersim.load_path)
+        else:
+            atom = mattersim.relax(mattersim.load_path,
+                                   relax_step=relax_steps if relax_policy == 'fixed_steps' else max_relax_steps,
+                                   rng=rng)
+        EnergyBackend.record_provenance(mattersim.folder_path, EnergyBackend.describe_policy(relax_policy, relax_steps))
+        mattersim.contcar_atom = atom
+        mattersim.energy = float(atom.get_potential_energy())
+        return mattersim
     
+    @PhaseTimer.timed("mattersim_relax")
     def relax(self,
               load_path=None,
               perturb:float=0.01,
@@ -56,7 +123,17 @@ class mattersim_predict():
               filter:str="FrechetCellFilter",
               constrain_symmetry:bool=True,
               relax_model:str='mattersim',
-              max_retries:int=5) -> Atom :
+              max_retries:int=5,
+              local_centers=None,
+              local_radius:float=6.0,
+              rng:np.random.Generator=None) -> Atom :
+        '''
+        local_centers 不为 None 时为局部弛豫: 只扰动并弛豫交换位点 local_radius (Å) 内的原子,
+        其余原子以 ASE FixAtoms 固定, 不使用晶胞 filter 与 FixSymmetry
+        '''
+        free_mask = None
+        if local_centers is not None:
+            free_mask = EnergyBackend.local_free_mask(Structure.from_ase_atoms(self.atom), local_centers, local_radius)
         if relax_model=='mattersim':
             attempt=0
             while True:
@@ -64,15 +141,22 @@ class mattersim_predict():
                     # mattersim_relax
                     contcar_path = self.contcar_path
                     contcar = self.atom
-                    contcar.positions += perturb * 10 * np.random.randn(len(contcar), 3)#
-                    potential=Potential.from_checkpoint(load_path=load_path,device=self.device)
-                    contcar.calc = MatterSimCalculator(potential=potential,device=self.device)
+                    displacements = perturb * 10 * EnergyBackend._rng(rng).standard_normal((len(contcar), 3))
+                    if free_mask is not None:
+                        displacements[~free_mask] = 0.0
+                    contcar.positions += displacements#
+                    contcar.calc = ModelRegistry.get_mattersim_calculator(load_path=load_path,
+                                                                          device=self.device)
 
-                    relaxer = Relaxer(
-                       optimizer=optimizer,
-                       filter=filter,
-                       constrain_symmetry=constrain_symmetry,
-                    )
+                    if free_mask is None:
+                        relaxer = ModelRegistry.get_relaxer(
+                           optimizer=optimizer,
+                           filter=filter,
+                           constrain_symmetry=constrain_symmetry,
+                        )
+                    else:
+                        relaxer = ModelRegistry.get_relaxer(optimizer=optimizer, filter=None, constrain_symmetry=False)
+                        EnergyBackend.fix_outside(contcar, free_mask)
                     
                     original_stdout = sys.stdout
                     output_buffer = StringIO()
@@ -82,6 +166,7 @@ class mattersim_predict():
                     
                     sys.stdout = original_stdout  
                     relaxed_atoms = relax_result[1]
+                    relaxed_atoms.set_constraint(None)
                     break  
                 except Exception as e:
                     sys.stdout = original_stdout  
@@ -92,7 +177,7 @@ class mattersim_predict():
         elif relax_model=='chgnet':
             #chgnet_relax
             structure = Structure.from_file(self.poscar_path)
-            relaxer = StructOptimizer()
+            relaxer = ModelRegistry.get_struct_optimizer()
             structure.perturb(perturb)
             original_stdout = sys.stdout
             output_buffer = StringIO()
@@ -110,19 +195,16 @@ class mattersim_predict():
 
         return relaxed_atoms
     
+    @PhaseTimer.timed("mattersim_predict")
     def predict(self,
                 Atom:Atom,
                 load_path:str=None,
                 property:list[str]=['energy','energy_per_atom']
                 ) -> float:
         '''property=['energy','energy_per_atom','']'''
-        if load_path:
-            potential=Potential.from_checkpoint(load_path=load_path,device=self.device)
-        else:
-            potential=None
-        
         atom = Atom
-        atom.calc = MatterSimCalculator(potential=potential,device=self.device)
+        atom.calc = ModelRegistry.get_mattersim_calculator(load_path=load_path,
+                                                           device=self.device)
         energy = atom.get_potential_energy()
         energy_per_atom = energy/len(atom)
         with open(self.output_path, "a+") as f:
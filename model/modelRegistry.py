@@ -0,0 +1,165 @@
+import torch
+from prettytable import PrettyTable
+
+from utilitys.phaseTimer import PhaseTimer
+
+from chgnet.model import CHGNet
+from chgnet.model import StructOptimizer
+
+from mattersim.forcefield import MatterSimCalculator
+from mattersim.applications.relax import Relaxer
+from mattersim.forcefield.potential import Potential
+
+
+class ModelRegistry(object):
+    '''
+    Description
+    -----------
+        1. 进程级的模型注册表, 同一个 (backend, checkpoint 路径, device) 只加载一次
+        2. StructOptimizer / Relaxer / MatterSimCalculator 等对象同样缓存复用
+
+    Attributes
+    ----------
+        1. _objects: dict
+            (类型, backend, load_path, device, ...) -> 已创建的对象
+        2. load_counts: dict
+            (backend, load_path, device) -> checkpoint 实际加载次数
+        3. hit_counts: dict
+            (类型, backend, load_path, device, ...) -> 命中缓存次数
+    '''
+    _objects = {}
+    load_counts = {}
+    hit_counts = {}
+
+    @staticmethod
+    def default_device() -> str:
+        return "cuda" if torch.cuda.is_available() else "cpu"
+
+    @classmethod
+    def _get(cls, key: tuple, factory):
+        if key in cls._objects:
+            cls.hit_counts[key] = cls.hit_counts.get(key, 0) + 1
+            return cls._objects[key]
+        with PhaseTimer.phase("model_load"):
+            obj = factory()
+        cls._objects[key] = obj
+        return obj
+
+    @classmethod
+    def _count_load(cls, backend: str, load_path: str, device: str):
+        key = (backend, load_path, device)
+        cls.load_counts[key] = cls.load_counts.get(key, 0) + 1
+
+    @classmethod
+    def get_chgnet(cls, load_path: str = None, device: str = None) -> CHGNet:
+        '''
+        load_path 为 None 时加载 CHGNet 预训练模型, 否则加载训练后的模型文件
+        '''
+        def factory():
+            if load_path is not None:
+                model = CHGNet.from_file(load_path)
+                if device is not None:
+                    model = model.to(device)
+                print('load trained model')
+            else:
+                model = CHGNet.load(use_device=device)
+                print('load initial model')
+            cls._count_load("chgnet", load_path, device)
+            return model
+
+        return cls._get(("model", "chgnet", load_path, device), factory)
+
+    @classmethod
+    def get_struct_optimizer(cls, load_path: str = None, device: str = None) -> StructOptimizer:
+        def factory():
+            model = cls.get_chgnet(load_path=load_path, device=device)
+            return StructOptimizer(model=model, use_device=device)
+
+        return cls._get(("optimizer", "chgnet", load_path, device), factory)
+
+    @classmethod
+    def get_mattersim_potential(cls, load_path: str = None, device: str = None) -> Potential:
+        '''
+        load_path 为 None 时由 mattersim 加载默认 checkpoint
+        '''
+        if device is None:
+            device = cls.default_device()
+
+        def factory():
+            potential = Potential.from_checkpoint(load_path=load_path, device=device)
+            cls._count_load("mattersim", load_path, device)
+            return potential
+
+        return cls._get(("model", "mattersim", load_path, device), factory)
+
+    @classmethod
+    def get_mattersim_calculator(cls, load_path: str = None, device: str = None) -> MatterSimCalculator:
+        if device is None:
+            device = cls.default_device()
+
+        def factory():
+            potential = cls.get_mattersim_potential(load_path=load_path, device=device)
+            return MatterSimCalculator(potential=potential, device=device)
+
+        return cls._get(("calculator", "mattersim", load_path, device), factory)
+
+    @classmethod
+    def get_relaxer(cls, optimizer: str = "FIRE", filter: str = "FrechetCellFilter",
+                    constrain_symmetry: bool = True) -> Relaxer:
+        def factory():
+            return Relaxer(optimizer=optimizer,
+                           filter=filter,
+                           constrain_symmetry=constrain_symmetry)
+
+        return cls._get(("relaxer", "mattersim", optimizer, filter, constrain_symmetry), factory)
+
+    @classmethod
+    def preload(cls, load_model: str, load_path: str = None, device: str = None):
+        '''
+        Description
+        -----------
+            1. 在 Metropolis.run 开始时预先加载模型, 后续各步直接复用
+        '''
+        if load_model == 'chgnet':
+            cls.get_struct_optimizer(load_path=load_path, device=device)
+        elif load_model == 'mattersim':
+            cls.get_mattersim_calculator(load_path=load_path, device=device)
+
+    @classmethod
+    def counts(cls) -> dict:
+        '''
+        本进程的模型加载与复用次数: (backend, load_path, device) -> [loads, reuses];
+        工作进程随结果返回, 由主进程以 `self.merge_counts` 汇总
+        '''
+        return {key: [loads, cls.hit_counts.get(("model",) + key, 0)] for key, loads in cls.load_counts.items()}
+
+    @staticmethod
+    def merge_counts(counts_lst) -> dict:
+        '''
+        将多个进程的 `counts()` 按 (backend, load_path, device) 相加
+        '''
+        merged = {}
+        for counts in counts_lst:
+            for key, (loads, reuses) in counts.items():
+                total = merged.setdefault(key, [0, 0])
+                total[0] += loads
+                total[1] += reuses
+        return merged
+
+    @classmethod
+    def report(cls, counts: dict = None):
+        '''
+        counts 为 None 时报告本进程的统计, 否则报告给定的 (汇总后的) 统计
+        '''
+        counts = cls.counts() if counts is None else counts
+        table = PrettyTable(["Backend", "Checkpoint", "Device", "Loads", "Reuses"])
+        for (backend, load_path, device), (loads, reuses) in counts.items():
+            table.add_row([backend, load_path, device, loads, reuses])
+        print(table)
+        return table
+
+    @classmethod
+    def clear(cls):
+        cls._objects.clear()
+        cls.load_counts.clear()
+        cls.hit_counts.clear()
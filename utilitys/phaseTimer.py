@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import functools
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from prettytable import PrettyTable
+
+
+class PhaseTimer(object):
+    '''
+    Description
+    -----------
+        1. 进程级的分阶段计时: `with PhaseTimer.phase("chgnet_relax"):` 或以 `@PhaseTimer.timed("...")`
+            修饰方法, 记录每次调用的耗时 (time.perf_counter)
+        2. `self.report()` 以 prettytable 输出各阶段的调用次数、总耗时、分位数以及按数量级分桶的直方图
+        3. 可选导出:
+            - cProfile: `self.start_profile()` ... `self.stop_profile(path)` 写出 pstats 文件
+            - Chrome trace: `self.start_trace()` 之后的各阶段记为 trace 事件, `self.write_trace(path)`
+                写出 JSON (chrome://tracing 或 Perfetto 打开), 嵌套的阶段显示为调用栈
+
+    Attributes
+    ----------
+        1. durations: dict
+            阶段名 -> 各次耗时 (s) 的列表
+        2. trace_events: list
+            Chrome trace 事件, None 时不记录
+        3. BINS: tuple
+            直方图的分桶边界 (s)
+    '''
+    durations = {}
+    trace_events = None
+    _trace_origin = 0.0
+    _profiler = None
+    BINS = (1e-3, 1e-2, 1e-1, 1.0, 10.0, 100.0)
+    BIN_LABELS = ("<1ms", "1-10ms", "10-100ms", "0.1-1s", "1-10s", "10-100s", ">100s")
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            cls.durations.setdefault(name, []).append(end - start)
+            if cls.trace_events is not None:
+                cls.trace_events.append({"name": name, "ph": "X", "pid": os.getpid(),
+                                         "tid": threading.get_ident(),
+                                         "ts": (start - cls._trace_origin) * 1e6,
+                                         "dur": (end - start) * 1e6})
+
+    @classmethod
+    def timed(cls, name: str):
+        '''
+        方法修饰器: 每次调用记为阶段 name
+        '''
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with cls.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @classmethod
+    def histogram(cls, name: str) -> np.ndarray:
+        return np.bincount(np.searchsorted(cls.BINS, cls.durations.get(name, [])),
+                           minlength=len(cls.BINS)+1)
+
+    @classmethod
+    def summary(cls) -> dict:
+        '''
+        阶段名 -> {calls, total, mean, p50, p95, max}
+        '''
+        result = {}
+        for name, durations in cls.durations.items():
+            durations = np.asarray(durations)
+            result[name] = {"calls": int(len(durations)),
+                            "total": float(durations.sum()),
+                            "mean": float(durations.mean()),
+                            "p50": float(np.percentile(durations, 50)),
+                            "p95": float(np.percentile(durations, 95)),
+                            "max": float(durations.max())}
+        return result
+
+    @classmethod
+    def report(cls):
+        table = PrettyTable(["Phase", "Calls", "Total(s)", "Mean(s)", "P50(s)", "P95(s)", "Max(s)",
+                             *cls.BIN_LABELS])
+        summary = cls.summary()
+        for name in sorted(summary, key=lambda name: -summary[name]["total"]):
+            row = summary[name]
+            table.add_row([name, row["calls"],
+                           *("{0:.4f}".format(row[key]) for key in ("total", "mean", "p50", "p95", "max")),
+                           *cls.histogram(name)])
+        print(table)
+        return table
+
+    @classmethod
+    def start_trace(cls):
+        cls.trace_events = []
+        cls._trace_origin = time.perf_counter()
+
+    @classmethod
+    def write_trace(cls, path: str):
+        '''
+        写出 Chrome trace (JSON), 之后不再记录 trace 事件
+        '''
+        with open(path, "w") as f:
+            json.dump({"traceEvents": cls.trace_events or [], "displayTimeUnit": "ms"}, f)
+        cls.trace_events = None
+
+    @classmethod
+    def start_profile(cls):
+        cls._profiler = cProfile.Profile()
+        cls._profiler.enable()
+
+    @classmethod
+    def stop_profile(cls, path: str) -> pstats.Stats:
+        '''
+        写出 pstats 文件 (`python -m pstats path` 或 snakeviz 查看)
+        '''
+        profiler, cls._profiler = cls._profiler, None
+        profiler.disable()
+        profiler.dump_stats(path)
+        return pstats.Stats(profiler)
+
+    @classmethod
+    def clear(cls):
+        cls.durations.clear()
+        cls.trace_events = None
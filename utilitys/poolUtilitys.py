@@ -0,0 +1,33 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import torch
+
+
+class PoolFunctions(object):
+    '''
+    副本交换/多链搜索共用的进程池
+    '''
+    @staticmethod
+    def init_worker(num_threads:int=None):
+        '''
+        每个工作进程只使用 num_threads 个 torch 线程, 避免多条链争抢同一批核
+        '''
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    @classmethod
+    def get_executor(cls, num_workers:int, num_threads:int=None, mp_context:str=None) -> ProcessPoolExecutor:
+        '''
+        mp_context: 'fork'/'spawn'/'forkserver', None 时使用平台默认
+        '''
+        context = multiprocessing.get_context(mp_context) if mp_context else None
+        return ProcessPoolExecutor(max_workers=num_workers, mp_context=context,
+                                   initializer=cls.init_worker, initargs=(num_threads,))
+
+    @classmethod
+    def get_pinned_executors(cls, num_workers:int, num_threads:int=None, mp_context:str=None) -> list:
+        '''
+        num_workers 个单进程的进程池: 第 k 个任务总是提交给第 k % num_workers 个, 工作进程中的状态
+        (如副本的模型与 MemoryStepObject) 在各轮之间保留
+        '''
+        return [cls.get_executor(1, num_threads, mp_context) for _ in range(num_workers)]